@@ -6,9 +6,14 @@ from cartesi.abi import Address, Bool, Bytes, UInt
 from cartesapp.context import get_metadata
 from cartesapp.input import query, mutation
 from cartesapp.output import add_output
-
-from .core_settings import CoreSettings
-from .riv import install_riv_version
+from cartesapp.storage import helpers
+
+from .core_settings import CoreSettings, format_cartridge_id_from_bytes
+from .riv import install_riv_version, resolve_cartridge_emulator, staged_cartridge
+from .blob_store import get_cartridge_blob_store
+from .model import Cartridge, Bytes32List, rebuild_activity_counters
+from .replay_cache import get_replay_cache
+from .riv_stats import get_emulator_stats
 LOGGER = logging.getLogger(__name__)
 
 
@@ -27,6 +32,9 @@ class UpdateRivosPayload(BaseModel):
 class SetMaxLockedCartridges(BaseModel):
     max_locked_cartridges: UInt
 
+class RebuildActivityCountersPayload(BaseModel):
+    cartridge_ids: Bytes32List # all cartridges when empty
+
 
 ###
 # Mutations
@@ -65,6 +73,8 @@ def update_rivos(payload: UpdateRivosPayload) -> bool:
     LOGGER.info(f"updating riv...")
     try:
         install_riv_version(payload.data)
+        # replays may change with the new emulator
+        get_replay_cache().clear()
     except Exception as e:
         msg = f"Couldn't update riv: {e}"
         LOGGER.error(msg)
@@ -73,6 +83,14 @@ def update_rivos(payload: UpdateRivosPayload) -> bool:
 
     return True
 
+@mutation(msg_sender=CoreSettings().admin_address)
+def rebuild_counters(payload: RebuildActivityCountersPayload) -> bool:
+    cartridge_ids = [format_cartridge_id_from_bytes(c) for c in payload.cartridge_ids] if len(payload.cartridge_ids) > 0 else None
+    LOGGER.info(f"rebuilding activity counters...")
+    n_tapes = rebuild_activity_counters(cartridge_ids)
+    LOGGER.info(f"rebuilt activity counters from {n_tapes} tapes")
+    return True
+
 
 ###
 # Queries
@@ -102,3 +120,46 @@ def config() -> bool:
     }
     add_output(config)
     return True
+
+@query()
+def emulator_builds() -> bool:
+    # cartridges grouped by the riv version and emulator they resolve to
+    builds = {}
+    for cartridge_id in helpers.select(c.id for c in Cartridge if c.active and c.unlocked).fetch():
+        try:
+            with staged_cartridge(cartridge_id) as cartridge_path:
+                emulator = resolve_cartridge_emulator(cartridge_id,cartridge_path)
+            build_key = (emulator['version'],emulator['rivemu_path'])
+        except Exception as e:
+            LOGGER.warning(f"Couldn't resolve emulator for cartridge {cartridge_id}: {e}")
+            build_key = (None,None)
+        if builds.get(build_key) is None:
+            builds[build_key] = {"riv_version": build_key[0], "emulator": build_key[1], "cartridges": []}
+        builds[build_key]["cartridges"].append(cartridge_id)
+
+    add_output({"builds": list(builds.values())})
+    return True
+
+@query()
+def replay_cache_stats() -> bool:
+    add_output(get_replay_cache().stats())
+    return True
+
+@query()
+def emulator_stats() -> bool:
+    # p50/p95/p99 emulator cost per cartridge and per rule (since the node started)
+    add_output({
+        "cartridges": get_emulator_stats().report("cartridge"),
+        "rules": get_emulator_stats().report("rule"),
+    })
+    return True
+
+@query()
+def cartridge_store_stats() -> bool:
+    # stored vs logical bytes of all cartridges and of each cartridge with its versions
+    store = get_cartridge_blob_store()
+    cartridges = []
+    for cartridge_id, name, versions in helpers.select((c.id, c.name, c.versions) for c in Cartridge if c.primary).fetch():
+        cartridges.append({"id": cartridge_id, "name": name, **store.stats(list(versions or [cartridge_id]))})
+    add_output({"total": store.stats(), "cartridges": cartridges})
+    return True
@@ -0,0 +1,296 @@
+import os
+import io
+import re
+import mmap
+import json
+import shutil
+import threading
+import logging
+from hashlib import sha256
+from contextlib import contextmanager
+from Crypto.Hash import keccak
+
+from .core_settings import get_cartridges_path, format_cartridge_id_from_bytes
+
+LOGGER = logging.getLogger(__name__)
+
+CHUNK_MIN_SIZE = 4*1024
+CHUNK_MAX_SIZE = 64*1024
+# chunks are cut before any of these byte pairs, about once every 16KB of compressed data
+CHUNK_ANCHORS = [b'\x8f\x3a', b'\x15\xd2', b'\xe7\x61', b'\x4c\xb9']
+CHUNK_ANCHOR_PATTERN = re.compile(b'|'.join(re.escape(a) for a in CHUNK_ANCHORS))
+
+
+###
+# Chunking
+
+def chunk_boundaries(data: bytes) -> list[tuple[int,int]]:
+    # content defined, so an insertion only changes the chunks around it
+    boundaries = []
+    start = 0
+    size = len(data)
+    while start < size:
+        end = min(start + CHUNK_MAX_SIZE, size)
+        if end - start > CHUNK_MIN_SIZE:
+            match = CHUNK_ANCHOR_PATTERN.search(data, start + CHUNK_MIN_SIZE, end)
+            if match is not None: end = match.start()
+        boundaries.append((start, end))
+        start = end
+    return boundaries
+
+
+###
+# Reader
+
+class CartridgeReader(io.RawIOBase):
+    """
+    Reads a stored cartridge through memory mapped views over its parts, the parts
+    are never joined. The maps stay valid after the files are removed, until closed
+    """
+    size = None
+    views = None
+
+    def __init__(self, paths: list[str]):
+        self.maps = []
+        self.views = []
+        try:
+            for path in paths:
+                with open(path,'rb') as f:
+                    self.maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                self.views.append(memoryview(self.maps[-1]))
+        except:
+            self.close()
+            raise
+        self.size = sum(len(view) for view in self.views)
+        self.view_index = 0
+        self.view_pos = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self.closed: raise ValueError("I/O operation on closed reader")
+        out = memoryview(b).cast('B')
+        n = 0
+        while n < len(out) and self.view_index < len(self.views):
+            view = self.views[self.view_index]
+            length = min(len(out) - n, len(view) - self.view_pos)
+            out[n:n + length] = view[self.view_pos:self.view_pos + length]
+            n += length
+            self.view_pos += length
+            if self.view_pos == len(view):
+                self.view_index += 1
+                self.view_pos = 0
+        return n
+
+    def readall(self) -> bytes:
+        # the rest of the cartridge in a single buffer
+        remaining = self.size - sum(len(view) for view in self.views[:self.view_index]) - self.view_pos
+        data = bytearray(remaining)
+        self.readinto(data)
+        return bytes(data)
+
+    def close(self):
+        if self.views is not None:
+            for view in self.views: view.release()
+        for m in self.maps: m.close()
+        self.views = []
+        self.maps = []
+        super().close()
+
+
+###
+# Store
+
+class CartridgeBlobStore:
+    """
+    Cartridge images split in content defined chunks, each chunk stored once by
+    its hash under chunks/ and a manifest per cartridge under manifests/. Whole
+    image files left by older versions in the root dir are still readable. Chunks
+    are refcounted by the manifests using them, the counts are rebuilt from the
+    manifests when first needed
+    """
+    root = None
+
+    def __init__(self, root: str):
+        self.root = root
+        self.lock = threading.Lock()
+        self.refcounts = None
+        for d in (f"{self.root}/chunks", f"{self.root}/manifests"):
+            if not os.path.exists(d):
+                os.makedirs(d)
+
+    def chunk_path(self, chunk_hash: str) -> str:
+        return f"{self.root}/chunks/{chunk_hash[:2]}/{chunk_hash}"
+
+    def manifest_path(self, cartridge_id: str) -> str:
+        return f"{self.root}/manifests/{cartridge_id}"
+
+    def legacy_path(self, cartridge_id: str) -> str:
+        return f"{self.root}/{cartridge_id}"
+
+    def exists(self, cartridge_id: str) -> bool:
+        return os.path.isfile(self.manifest_path(cartridge_id)) or os.path.isfile(self.legacy_path(cartridge_id))
+
+    def get_manifest(self, cartridge_id: str) -> dict | None:
+        if not os.path.isfile(self.manifest_path(cartridge_id)): return None
+        with open(self.manifest_path(cartridge_id),'r') as f:
+            return json.load(f)
+
+    def put(self, cartridge_id: str, data: bytes) -> dict:
+        view = memoryview(data)
+        chunks = []
+        boundaries = chunk_boundaries(view)
+        for start, end in boundaries:
+            chunk = view[start:end]
+            chunk_hash = sha256(chunk).hexdigest()
+            path = self.chunk_path(chunk_hash)
+            if not os.path.exists(path):
+                self._write_file(path, chunk)
+            chunks.append([chunk_hash, end - start])
+        manifest = {"size": len(view), "chunks": chunks}
+        with self.lock:
+            refcounts = self._get_refcounts()
+            # a remove may have released the chunks written before taking the lock
+            for (chunk_hash, _), (start, end) in zip(chunks, boundaries):
+                if chunk_hash not in refcounts and not os.path.exists(self.chunk_path(chunk_hash)):
+                    self._write_file(self.chunk_path(chunk_hash), view[start:end])
+            previous = self.get_manifest(cartridge_id)
+            self._write_file(self.manifest_path(cartridge_id), json.dumps(manifest).encode('utf-8'))
+            if os.path.exists(self.legacy_path(cartridge_id)): os.remove(self.legacy_path(cartridge_id))
+            for chunk_hash in manifest_chunks(manifest):
+                refcounts[chunk_hash] = refcounts.get(chunk_hash, 0) + 1
+            if previous is not None: self._release_chunks(previous)
+        return manifest
+
+    def read(self, cartridge_id: str) -> CartridgeReader:
+        # the caller closes the reader
+        manifest = self.get_manifest(cartridge_id)
+        if manifest is not None:
+            paths = [self.chunk_path(chunk_hash) for chunk_hash, _ in manifest['chunks']]
+        elif os.path.isfile(self.legacy_path(cartridge_id)):
+            paths = [self.legacy_path(cartridge_id)]
+        else:
+            raise Exception(f"Cartridge {cartridge_id} not found")
+        return CartridgeReader(paths)
+
+    @contextmanager
+    def open(self, cartridge_id: str):
+        # memory mapped views over the cartridge parts, only valid inside the block
+        with self.read(cartridge_id) as reader:
+            yield reader.views
+
+    def materialize(self, cartridge_id: str, path: str):
+        # writes the whole image to path, e.g. to pass it to the emulator
+        if self.get_manifest(cartridge_id) is None and os.path.isfile(self.legacy_path(cartridge_id)):
+            try:
+                os.link(self.legacy_path(cartridge_id), path)
+            except OSError:
+                shutil.copyfile(self.legacy_path(cartridge_id), path)
+            return
+        with self.open(cartridge_id) as views, open(path,'wb') as f:
+            for view in views: f.write(view)
+
+    def verify(self, cartridge_id: str) -> bool:
+        # chunk hashes and sizes and the cartridge id (hash of the whole image)
+        try:
+            manifest = self.get_manifest(cartridge_id)
+            cartridge_hash = keccak.new(digest_bits=256)
+            with self.open(cartridge_id) as views:
+                if manifest is not None:
+                    for (chunk_hash, size), view in zip(manifest['chunks'], views):
+                        if len(view) != size or sha256(view).hexdigest() != chunk_hash:
+                            LOGGER.error(f"Cartridge {cartridge_id} chunk {chunk_hash} is corrupted")
+                            return False
+                for view in views: cartridge_hash.update(view)
+            if format_cartridge_id_from_bytes(cartridge_hash.digest()) != cartridge_id:
+                LOGGER.error(f"Cartridge {cartridge_id} doesn't match its id")
+                return False
+            return True
+        except Exception as e:
+            LOGGER.error(f"Couldn't verify cartridge {cartridge_id}: {e}")
+            return False
+
+    def remove(self, cartridge_id: str):
+        with self.lock:
+            if os.path.exists(self.legacy_path(cartridge_id)): os.remove(self.legacy_path(cartridge_id))
+            manifest = self.get_manifest(cartridge_id)
+            if manifest is None: return
+            self._get_refcounts()
+            os.remove(self.manifest_path(cartridge_id))
+            self._release_chunks(manifest)
+
+    def stats(self, cartridge_ids: list[str] | None = None) -> dict:
+        # logical bytes are the image sizes, stored bytes the unique chunks they use
+        if cartridge_ids is None:
+            cartridge_ids = os.listdir(f"{self.root}/manifests")
+        logical_bytes = 0
+        chunks = {}
+        n_cartridges = 0
+        for cartridge_id in cartridge_ids:
+            manifest = self.get_manifest(cartridge_id)
+            if manifest is None: continue
+            n_cartridges += 1
+            logical_bytes += manifest['size']
+            for chunk_hash, size in manifest['chunks']: chunks[chunk_hash] = size
+        stored_bytes = sum(chunks.values())
+        return {
+            "cartridges": n_cartridges,
+            "chunks": len(chunks),
+            "logical_bytes": logical_bytes,
+            "stored_bytes": stored_bytes,
+            "dedup_ratio": logical_bytes / stored_bytes if stored_bytes > 0 else None,
+        }
+
+    def _get_refcounts(self) -> dict[str,int]:
+        # number of manifests using each chunk, called with the lock held
+        if self.refcounts is None:
+            refcounts = {}
+            for cartridge_id in os.listdir(f"{self.root}/manifests"):
+                if cartridge_id.endswith('.tmp'): continue
+                manifest = self.get_manifest(cartridge_id)
+                if manifest is None: continue
+                for chunk_hash in manifest_chunks(manifest):
+                    refcounts[chunk_hash] = refcounts.get(chunk_hash, 0) + 1
+            self.refcounts = refcounts
+        return self.refcounts
+
+    def _release_chunks(self, manifest: dict):
+        # called with the lock held, removes the chunks no other manifest uses
+        for chunk_hash in manifest_chunks(manifest):
+            count = self.refcounts.get(chunk_hash, 0) - 1
+            if count > 0:
+                self.refcounts[chunk_hash] = count
+                continue
+            self.refcounts.pop(chunk_hash, None)
+            if os.path.exists(self.chunk_path(chunk_hash)): os.remove(self.chunk_path(chunk_hash))
+
+    def _write_file(self, path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path,'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+def manifest_chunks(manifest: dict) -> set[str]:
+    # a chunk repeated in a cartridge counts once
+    return set(chunk_hash for chunk_hash, _ in manifest['chunks'])
+
+
+###
+# Default store
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+def get_cartridge_blob_store() -> CartridgeBlobStore:
+    global _default_store
+    with _default_store_lock:
+        # the storage path is only known after setup
+        if _default_store is None or _default_store.root != get_cartridges_path():
+            _default_store = CartridgeBlobStore(get_cartridges_path())
+        return _default_store
@@ -1,7 +1,6 @@
 from pydantic import BaseModel
 import logging
 from typing import Optional, List
-import base64
 
 import traceback
 
@@ -14,8 +13,13 @@ from cartesapp.output import event, output, add_output, emit_event, index_input
 from cartesapp.utils import hex2bytes
 
 from .model import Cartridge, CartridgeTag, CartridgeAuthor, InfoCartridge, Bytes32List, BoolList, \
-    create_cartridge, delete_cartridge, change_cartridge_user_address, StringList, unlock_and_test_cartridge, create_and_unlock_cartridge
-from .core_settings import CoreSettings, get_cartridges_path, get_version, format_cartridge_id_from_bytes
+    create_cartridge, delete_cartridge, change_cartridge_user_address, StringList, unlock_and_test_cartridge, create_and_unlock_cartridge, \
+    verify_cartridge_test_tapes, get_encoded_covers, filter_cartridges_by_tags, get_name_index, name_candidates
+from .core_settings import CoreSettings, get_version, format_cartridge_id_from_bytes
+from .riv import riv_mount_session
+from .blob_store import get_cartridge_blob_store
+from .pagination import parse_order, keyset_page
+from .projection import parse_fields, field_columns, select_columns, column_rows, project
 
 LOGGER = logging.getLogger(__name__)
 
@@ -39,6 +43,14 @@ class TransferCartridgePayload(BaseModel):
 class CartridgePayload(BaseModel):
     id: String
 
+class CartridgeInfoPayload(BaseModel):
+    id: String
+    cover_format:   Optional[str] # full (default), thumbnail or id
+
+class CartridgeCoverPayload(BaseModel):
+    id: String # cover id
+    thumbnail:      Optional[bool]
+
 # TODO: TypeError: unhashable type: 'ABIType' allow python cartesi types
 class CartridgesPayload(BaseModel):
     name:           Optional[str]
@@ -51,6 +63,10 @@ class CartridgesPayload(BaseModel):
     order_by:       Optional[str]
     order_dir:      Optional[str]
     get_cover:      Optional[bool]
+    cursor:         Optional[str] # keyset pagination instead of page, empty for the first page
+    with_total:     Optional[bool]
+    fields:         Optional[List[str]] # only these fields, in a CartridgeFieldsOutput
+    cover_format:   Optional[str] # full (default), thumbnail or id
     tags_or:        Optional[bool]
     full:           Optional[bool]
     enable_inactive:Optional[bool]
@@ -91,6 +107,7 @@ class CartridgeInfo(BaseModel):
     created_at: UInt
     updated_at: UInt
     cover: Optional[str] # encode to base64
+    cover_id: Optional[String]
     active: Optional[Bool]
     unlocked: Optional[Bool]
     primary: Optional[Bool]
@@ -99,12 +116,25 @@ class CartridgeInfo(BaseModel):
     versions: Optional[StringList]
     tapes: Optional[StringList]
     tags:  Optional[StringList]
+    n_tapes: Optional[UInt]
+    n_verified: Optional[UInt]
+    n_failed: Optional[UInt]
+    n_players: Optional[UInt]
+    best_score: Optional[Int]
 
 @output()
 class CartridgesOutput(BaseModel):
     data:   List[CartridgeInfo]
-    total:  UInt
+    total:  Optional[UInt]
     page:   UInt
+    next_cursor: Optional[str]
+
+@output()
+class CartridgeFieldsOutput(BaseModel):
+    data:   List[dict]
+    total:  Optional[UInt]
+    page:   UInt
+    next_cursor: Optional[str]
 
 @output()
 class CartridgeTagsOutput(BaseModel):
@@ -165,46 +195,55 @@ def set_unlock_cartridge(payload: SetUnlockedCartridgePayload) -> bool:
         return False
     
     LOGGER.info(f"Received batch of cartridge unlocks")
-    for ind in range(len(payload.ids)):
-        payload_id = format_cartridge_id_from_bytes(payload.ids[ind])
-
-        LOGGER.info("Unlocking cartridge...")
-        
-        try:
-            if payload.unlocks[ind]:
-                cartridge = unlock_and_test_cartridge(payload_id,**metadata.dict())
-
-                if cartridge is not None:
-                    cartridge_event = CartridgeEvent(
-                        version=get_version(),
-                        cartridge_id = hex2bytes(cartridge.id),
-                        cartridge_user_address = cartridge.user_address,
-                        cartridge_input_index = cartridge.input_index,
-                        timestamp = cartridge.created_at
-                    )
-                    tags = ['cartridge','cartridge_inserted',cartridge.id]
-                    emit_event(cartridge_event,tags=tags)
-            else:
-                cartridges_deleted = delete_cartridge(payload_id,**metadata.dict())
-                for cart in cartridges_deleted:
-                    cartridge = cart[0]
-                    cartridge.unlocked = False
-                    cartridge.name = f"rejected_{payload_id}"
-        except Exception as e:
-            msg = f"Error while trying to unlock cartridge: {e}"
-            LOGGER.error(msg)
-            add_output(msg)
-            LOGGER.info("Removing cartridge...")
+    # keep riv os mounted across the batch
+    with riv_mount_session():
+        # test tapes of the cartridges to unlock run in one batch
+        test_results = verify_cartridge_test_tapes(
+            [format_cartridge_id_from_bytes(payload.ids[ind]) for ind in range(len(payload.ids)) if payload.unlocks[ind]])
+        for ind in range(len(payload.ids)):
+            payload_id = format_cartridge_id_from_bytes(payload.ids[ind])
+
+            LOGGER.info("Unlocking cartridge...")
+            
             try:
-                cartridges_deleted = delete_cartridge(payload_id,**metadata.dict())
-                for cart in cartridges_deleted:
-                    cartridge = cart[0]
-                    cartridge.unlocked = False
-                    cartridge.name = f"rejected_{payload_id}"
+                if payload.unlocks[ind]:
+                    cartridge = unlock_and_test_cartridge(payload_id,test_results.get(payload_id),**metadata.dict())
+
+                    if cartridge is not None:
+                        cartridge_event = CartridgeEvent(
+                            version=get_version(),
+                            cartridge_id = hex2bytes(cartridge.id),
+                            cartridge_user_address = cartridge.user_address,
+                            cartridge_input_index = cartridge.input_index,
+                            timestamp = cartridge.created_at
+                        )
+                        tags = ['cartridge','cartridge_inserted',cartridge.id]
+                        emit_event(cartridge_event,tags=tags)
+                else:
+                    cartridges_deleted = delete_cartridge(payload_id,**metadata.dict())
+                    for cart in cartridges_deleted:
+                        cartridge = cart[0]
+                        cart[1].close()
+                        cartridge.unlocked = False
+                        cartridge.name = f"rejected_{payload_id}"
+                        get_name_index('cartridge').update(cartridge.id)
             except Exception as e:
-                msg = f"Couldn't remove cartridge (id={payload_id}): {e}"
+                msg = f"Error while trying to unlock cartridge: {e}"
                 LOGGER.error(msg)
                 add_output(msg)
+                LOGGER.info("Removing cartridge...")
+                try:
+                    cartridges_deleted = delete_cartridge(payload_id,**metadata.dict())
+                    for cart in cartridges_deleted:
+                        cartridge = cart[0]
+                        cart[1].close()
+                        cartridge.unlocked = False
+                        cartridge.name = f"rejected_{payload_id}"
+                        get_name_index('cartridge').update(cartridge.id)
+                except Exception as e:
+                    msg = f"Couldn't remove cartridge (id={payload_id}): {e}"
+                    LOGGER.error(msg)
+                    add_output(msg)
 
     return True
 
@@ -258,7 +297,8 @@ def remove_cartridge(payload: RemoveCartridgePayload) -> bool:
 
     for cart in cartridges_deleted:
         cartridge = cart[0]
-        cartridge_data = cart[1]
+        with cart[1] as cartridge_reader:
+            cartridge_data = cartridge_reader.read()
         cartridge_event = CartridgeRemoved(
             cartridge_id = cartridge.id,
             timestamp = metadata.timestamp
@@ -306,8 +346,8 @@ def cartridge(payload: CartridgePayload) -> bool:
 
     cartridge_data = b''
     if query.count() > 0:
-        with open(f"{get_cartridges_path()}/{payload.id}",'rb')as cartridge_file:
-            cartridge_data = cartridge_file.read()
+        with get_cartridge_blob_store().read(payload.id) as cartridge_reader:
+            cartridge_data = cartridge_reader.read()
 
     add_output(cartridge_data)
 
@@ -316,13 +356,13 @@ def cartridge(payload: CartridgePayload) -> bool:
     return True
 
 @query()
-def cartridge_info(payload: CartridgePayload) -> bool:
+def cartridge_info(payload: CartridgeInfoPayload) -> bool:
     cartridge = Cartridge.get(lambda c: c.id == payload.id)
 
     if cartridge is not None:
         cartridge_dict = cartridge.to_dict(with_lazy=True, with_collections=True)
-        if cartridge.cover is not None and len(cartridge.cover) > 0:
-            cartridge_dict['cover'] = base64.b64encode(cartridge_dict['cover'])
+        if payload.cover_format != 'id' and cartridge.cover_id:
+            cartridge_dict['cover'] = get_encoded_covers([cartridge.cover_id],payload.cover_format == 'thumbnail').get(cartridge.cover_id)
         if len(cartridge.original_info.keys()) == 0:
             del cartridge_dict['original_info']
         out = CartridgeInfo.parse_obj(cartridge_dict)
@@ -334,6 +374,15 @@ def cartridge_info(payload: CartridgePayload) -> bool:
 
     return True
 
+@query()
+def cartridge_cover(payload: CartridgeCoverPayload) -> bool:
+    covers = get_encoded_covers([payload.id],payload.thumbnail is not None and payload.thumbnail)
+    add_output(covers.get(payload.id) or "")
+
+    LOGGER.info(f"Returning cover {payload.id}")
+
+    return True
+
 @query()
 def cartridges(payload: CartridgesPayload) -> bool:
     cartridges_query = Cartridge.select() # lambda c: c.active and c.primary)
@@ -353,13 +402,20 @@ def cartridges(payload: CartridgesPayload) -> bool:
         cartridges_query = cartridges_query.filter(lambda c: c.unlocked)
 
     if payload.name is not None:
+        candidate_ids = name_candidates('cartridge', payload.name)
+        if candidate_ids is not None:
+            cartridges_query = cartridges_query.filter(lambda c: c.id in candidate_ids)
         cartridges_query = cartridges_query.filter(lambda c: payload.name in c.name)
 
     if payload.user_address is not None:
         cartridges_query = cartridges_query.filter(lambda c: payload.user_address.lower() == c.user_address)
 
     if payload.author is not None:
-        cartridges_query = helpers.select(c for c in cartridges_query for a in c.authors if payload.author in a.name)
+        candidate_names = name_candidates('cartridge_author', payload.author)
+        if candidate_names is not None:
+            cartridges_query = helpers.select(c for c in cartridges_query for a in c.authors if a.name in candidate_names and payload.author in a.name)
+        else:
+            cartridges_query = helpers.select(c for c in cartridges_query for a in c.authors if payload.author in a.name)
 
     # if payload.tags is not None and len(payload.tags) > 0:
     #     for tag in payload.tags:
@@ -370,53 +426,91 @@ def cartridges(payload: CartridgesPayload) -> bool:
 
     # TAGS
     if payload.tags is not None and len(payload.tags) > 0:
-        if payload.tags_or is not None and payload.tags_or:
-            tags_fn = lambda t: t.name in payload.tags
-        else:
-            tags_fn = lambda t: t.name in payload.tags and helpers.count(t) == len(payload.tags)
-        cartridges_query = helpers.distinct(
-            r for r in cartridges_query for t in CartridgeTag if r in t.cartridges and tags_fn(t)
-        )
-    else:
-        cartridges_query = helpers.distinct(
-            o for o in cartridges_query
-        )
+        cartridges_query = filter_cartridges_by_tags(cartridges_query, payload.tags, match_any=payload.tags_or is not None and payload.tags_or)
+    cartridges_query = helpers.distinct(
+        o for o in cartridges_query
+    )
 
-    total = cartridges_query.count()
+    total = cartridges_query.count() if payload.with_total is None or payload.with_total else None
 
-    if payload.order_by is not None:
-        order_dict = {"asc":lambda d: d,"desc":helpers.desc}
-        order_dir_list = []
-        order_by_list = payload.order_by.split(',')
-        if payload.order_dir is not None:
-            order_dir_list = payload.order_dir.split(',')
-        for idx,ord in enumerate(order_by_list):
-            if idx < len(order_dir_list): dir_order = order_dict[order_dir_list[idx]]
-            else: dir_order = order_dict["asc"]
-            cartridges_query = cartridges_query.order_by(dir_order(getattr(Cartridge,ord)))
+    columns = None
+    if payload.fields is not None:
+        try:
+            fields = parse_fields(Cartridge,payload.fields,['cover'])
+        except Exception as e:
+            msg = f"Couldn't get cartridges fields: {e}"
+            LOGGER.error(msg)
+            add_output(msg)
+            return False
+        columns = field_columns(Cartridge,fields,['cover_id'] if 'cover' in fields else [])
 
     page = 1
-    if payload.page is not None:
-        page = payload.page
-        if payload.page_size is not None:
-            cartridges = cartridges_query.page(payload.page,payload.page_size)
-        else:
-            cartridges = cartridges_query.page(payload.page)
+    next_cursor = None
+    if payload.cursor is not None:
+        # keyset pagination, an empty cursor is the first page
+        try:
+            order = parse_order(Cartridge,payload.order_by,payload.order_dir)
+            cartridges, next_cursor = keyset_page(cartridges_query,Cartridge,order,payload.cursor,payload.page_size,columns)
+        except Exception as e:
+            msg = f"Couldn't get cartridges page: {e}"
+            LOGGER.error(msg)
+            add_output(msg)
+            return False
     else:
-        cartridges = cartridges_query.fetch()
+        if payload.order_by is not None:
+            order_dict = {"asc":lambda d: d,"desc":helpers.desc}
+            order_dir_list = []
+            order_by_list = payload.order_by.split(',')
+            if payload.order_dir is not None:
+                order_dir_list = payload.order_dir.split(',')
+            for idx,ord in enumerate(order_by_list):
+                if idx < len(order_dir_list): dir_order = order_dict[order_dir_list[idx]]
+                else: dir_order = order_dict["asc"]
+                cartridges_query = cartridges_query.order_by(dir_order(getattr(Cartridge,ord)))
+        if columns is not None:
+            cartridges_query = select_columns(cartridges_query,columns)
+
+        if payload.page is not None:
+            page = payload.page
+            if payload.page_size is not None:
+                cartridges = cartridges_query.page(payload.page,payload.page_size)
+            else:
+                cartridges = cartridges_query.page(payload.page)
+        else:
+            cartridges = cartridges_query.fetch()
+        if columns is not None:
+            cartridges = column_rows(list(cartridges),columns)
+
+    if payload.fields is not None:
+        if 'cover' in fields:
+            covers = {}
+            if payload.cover_format != 'id':
+                covers = get_encoded_covers([c['cover_id'] for c in cartridges],payload.cover_format == 'thumbnail')
+            for c in cartridges:
+                c['cover'] = covers.get(c['cover_id']) if payload.cover_format != 'id' else c['cover_id']
+        dict_list_result = project(cartridges,fields)
+
+        LOGGER.info(f"Returning {len(dict_list_result)} of {total} cartridges")
+
+        out = CartridgeFieldsOutput.parse_obj({'data':dict_list_result,'total':total,'page':page,'next_cursor':next_cursor})
+        add_output(out)
+        return True
 
     full = payload.full is not None and payload.full
+    # covers are fetched pre encoded in a single query for the page
+    covers = {}
+    if (full or payload.get_cover is not None and payload.get_cover) and payload.cover_format != 'id':
+        covers = get_encoded_covers([c.cover_id for c in cartridges],payload.cover_format == 'thumbnail')
     dict_list_result = []
     for cartridge in cartridges:
         cartridge_dict = cartridge.to_dict(with_lazy=full, with_collections=full)
-        if (full or payload.get_cover is not None and payload.get_cover) and \
-                cartridge.cover is not None and len(cartridge.cover) > 0:
-            cartridge_dict['cover'] = base64.b64encode(cartridge.cover)
+        if covers.get(cartridge.cover_id) is not None:
+            cartridge_dict['cover'] = covers[cartridge.cover_id]
         dict_list_result.append(cartridge_dict)
 
     LOGGER.info(f"Returning {len(dict_list_result)} of {total} cartridges")
     
-    out = CartridgesOutput.parse_obj({'data':dict_list_result,'total':total,'page':page})
+    out = CartridgesOutput.parse_obj({'data':dict_list_result,'total':total,'page':page,'next_cursor':next_cursor})
     
     add_output(out)
 
@@ -426,6 +520,9 @@ def cartridges(payload: CartridgesPayload) -> bool:
 def cartridge_tags(payload: GetCartridgeTagsPayload) -> bool:
     tags_query = CartridgeTag.select()
     if payload.name is not None:
+        candidate_names = name_candidates('cartridge_tag', payload.name)
+        if candidate_names is not None:
+            tags_query = tags_query.filter(lambda r: r.name in candidate_names)
         tags_query = tags_query.filter(lambda r: payload.name in r.name)
 
     tag_names = helpers.select(r.name for r in tags_query).fetch()
@@ -438,6 +535,9 @@ def cartridge_tags(payload: GetCartridgeTagsPayload) -> bool:
 def cartridge_authors(payload: GetCartridgeAuthorsPayload) -> bool:
     authors_query = CartridgeAuthor.select()
     if payload.name is not None:
+        candidate_names = name_candidates('cartridge_author', payload.name)
+        if candidate_names is not None:
+            authors_query = authors_query.filter(lambda r: r.name in candidate_names)
         authors_query = authors_query.filter(lambda r: payload.name in r.name)
 
     names = helpers.select(r.name for r in authors_query).fetch()
@@ -0,0 +1,194 @@
+import os
+import shutil
+import tempfile
+import threading
+import atexit
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .core_settings import CoreSettings, is_inside_cm
+
+LOGGER = logging.getLogger(__name__)
+
+STAGE_DIR_PREFIX = "rives-cartridges-"
+
+
+###
+# Stage
+
+class StagedCartridge:
+    path = None
+    size = 0
+    refs = 0
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self.refs = 0
+
+class CartridgeStage:
+    """
+    Cartridge files ready to be passed to the emulator, keyed by cartridge id.
+    Entries in use are reference counted, unused ones are evicted in lru order
+    when the stage grows over max_bytes. Files are written outside the lock, other
+    acquires of a key being staged wait for it
+    """
+    stage_dir = None
+    max_bytes = None
+    total_bytes = 0
+    entries = None
+    staging = None
+    lock = None
+
+    def __init__(self, stage_dir: str, max_bytes: int):
+        self.stage_dir = stage_dir
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict()
+        self.staging = {}
+        self.lock = threading.Lock()
+        if not os.path.exists(self.stage_dir):
+            os.makedirs(self.stage_dir)
+
+    def contains(self, key: str) -> bool:
+        with self.lock:
+            return key in self.entries
+
+    def acquire(self, key: str, cartridge_data: bytes = None, source_path: str = None, materialize = None) -> str:
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    entry.refs += 1
+                    return entry.path
+                staged_event = self.staging.get(key)
+                if staged_event is None:
+                    staged_event = threading.Event()
+                    self.staging[key] = staged_event
+                    break
+            # staged by another thread (or failed there and staged again here)
+            staged_event.wait()
+
+        try:
+            entry = self._stage(key, cartridge_data, source_path, materialize)
+        except BaseException:
+            with self.lock:
+                del self.staging[key]
+            staged_event.set()
+            raise
+
+        with self.lock:
+            del self.staging[key]
+            self.entries[key] = entry
+            self.total_bytes += entry.size
+            entry.refs += 1
+            self._evict()
+        staged_event.set()
+        return entry.path
+
+    def release(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None: return
+            entry.refs -= 1
+            self._evict()
+
+    @contextmanager
+    def staged(self, key: str, cartridge_data: bytes = None, source_path: str = None, materialize = None):
+        path = self.acquire(key, cartridge_data, source_path, materialize)
+        try:
+            yield path
+        finally:
+            self.release(key)
+
+    def remove(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None: return
+            if entry.refs > 0:
+                raise Exception(f"Staged cartridge {key} still in use")
+            self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if self.entries[key].refs == 0: self._remove(key)
+
+    def _stage(self, key: str, cartridge_data: bytes, source_path: str, materialize = None) -> StagedCartridge:
+        path = f"{self.stage_dir}/{key}"
+        if cartridge_data is not None:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path,'wb') as cartridge_file:
+                cartridge_file.write(cartridge_data)
+            os.replace(tmp_path, path)
+        elif source_path is not None:
+            if not os.path.isfile(source_path):
+                raise Exception(f"Cartridge file {source_path} not found")
+            if os.path.exists(path): os.remove(path)
+            try:
+                os.link(source_path, path)
+            except OSError:
+                shutil.copyfile(source_path, path)
+        elif materialize is not None:
+            tmp_path = f"{path}.tmp"
+            materialize(tmp_path)
+            os.replace(tmp_path, path)
+        else:
+            raise Exception(f"Cartridge {key} not staged and no data provided")
+        LOGGER.debug(f"Staged cartridge {key}")
+        return StagedCartridge(path, os.path.getsize(path))
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry.size
+        if os.path.exists(entry.path): os.remove(entry.path)
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes: return
+        for key in list(self.entries.keys()):
+            if self.total_bytes <= self.max_bytes: break
+            if self.entries[key].refs == 0:
+                LOGGER.debug(f"Evicting staged cartridge {key}")
+                self._remove(key)
+
+
+###
+# Default stage
+
+_default_stage = None
+_default_stage_lock = threading.Lock()
+
+def get_stage_dir() -> str:
+    if is_inside_cm():
+        # inside the rivos tree so riv-chroot sees the same path
+        return f"/{CoreSettings().cartridges_path}"
+    base_dir = CoreSettings().cartridge_stage_path
+    if base_dir is None:
+        base_dir = "/dev/shm" if os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+    _remove_stale_stage_dirs(base_dir)
+    return f"{base_dir}/{STAGE_DIR_PREFIX}{os.getpid()}"
+
+def _remove_stale_stage_dirs(base_dir: str):
+    # stage dirs are per process, clean the ones left by processes that are gone
+    if not os.path.isdir(base_dir): return
+    for d in os.listdir(base_dir):
+        if not d.startswith(STAGE_DIR_PREFIX): continue
+        try:
+            pid = int(d[len(STAGE_DIR_PREFIX):])
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            shutil.rmtree(f"{base_dir}/{d}", ignore_errors=True)
+        except (ValueError, PermissionError):
+            pass
+
+def get_cartridge_stage() -> CartridgeStage:
+    global _default_stage
+    with _default_stage_lock:
+        # forked processes get their own stage
+        if _default_stage is None or (not is_inside_cm() and not _default_stage.stage_dir.endswith(f"-{os.getpid()}")):
+            _default_stage = CartridgeStage(get_stage_dir(), CoreSettings().cartridge_stage_max_bytes)
+            if not is_inside_cm():
+                atexit.register(shutil.rmtree, _default_stage.stage_dir, True)
+        return _default_stage
@@ -34,6 +34,14 @@ class CoreSettings:
             cls.internal_verify_lock = True
             cls.cartridge_moderation_lock = True
             cls.max_locked_cartridges = os.getenv('MAX_LOCKED_CARTRIDGES') or 100
+            cls.cartridge_stage_path = os.getenv('CARTRIDGE_STAGE_PATH')
+            # inside the cartesi machine staged cartridges take the machine's own memory
+            cls.cartridge_stage_max_bytes = int(os.getenv('CARTRIDGE_STAGE_MAX_BYTES') or \
+                (16*1024*1024 if is_inside_cm() else 256*1024*1024))
+            cls.rivemu_io_mode = os.getenv('RIVEMU_IO_MODE') or 'memfd' # memfd or files
+            cls.replay_cache_path = os.getenv('REPLAY_CACHE_PATH')
+            cls.replay_cache_max_bytes = int(os.getenv('REPLAY_CACHE_MAX_BYTES') or 256*1024*1024)
+            cls.replay_cache_memory_bytes = int(os.getenv('REPLAY_CACHE_MEMORY_BYTES') or 16*1024*1024)
             cls.initialized = True
         return cls
     def store_config():
@@ -0,0 +1,133 @@
+import zlib
+import struct
+import base64
+import logging
+from hashlib import sha256
+
+LOGGER = logging.getLogger(__name__)
+
+COVER_THUMBNAIL_MAX_SIZE = 128
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# chunks copied to the thumbnail as they are
+PNG_KEPT_CHUNKS = (b'PLTE', b'tRNS', b'gAMA', b'sRGB')
+
+
+###
+# Cover variants
+
+def generate_cover_id(cover: bytes) -> str:
+    return sha256(cover).hexdigest()
+
+def encode_cover(cover: bytes) -> str:
+    return base64.b64encode(cover).decode('ascii')
+
+def make_cover_thumbnail(cover: bytes, max_size: int = COVER_THUMBNAIL_MAX_SIZE) -> bytes | None:
+    # nearest neighbor downscale (covers are mostly pixel art), None when the cover
+    # is already small or isn't a png this can decode
+    try:
+        thumbnail = downscale_png(cover, max_size)
+    except Exception as e:
+        LOGGER.warning(f"Couldn't make cover thumbnail: {e}")
+        return None
+    if thumbnail is None or len(thumbnail) >= len(cover): return None
+    return thumbnail
+
+
+###
+# Png
+
+def read_png_chunks(data: bytes) -> list[tuple[bytes,bytes]]:
+    if data[:8] != PNG_SIGNATURE:
+        raise Exception(f"Not a png image")
+    chunks = []
+    pos = 8
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+        chunks.append((chunk_type, data[pos + 8:pos + 8 + length]))
+        pos += 12 + length
+        if chunk_type == b'IEND': break
+    return chunks
+
+def write_png_chunk(chunk_type: bytes, chunk_data: bytes) -> bytes:
+    return struct.pack('>I', len(chunk_data)) + chunk_type + chunk_data + \
+        struct.pack('>I', zlib.crc32(chunk_type + chunk_data) & 0xffffffff)
+
+def unfilter_png_rows(raw: bytes, height: int, stride: int, bpp: int) -> list[bytearray]:
+    rows = []
+    prev = bytearray(stride)
+    pos = 0
+    for _ in range(height):
+        filter_type = raw[pos]
+        row = bytearray(raw[pos + 1:pos + 1 + stride])
+        pos += 1 + stride
+        if filter_type == 1:
+            for i in range(bpp, stride):
+                row[i] = (row[i] + row[i - bpp]) & 0xff
+        elif filter_type == 2:
+            row = bytearray((a + b) & 0xff for a, b in zip(row, prev))
+        elif filter_type == 3:
+            for i in range(stride):
+                left = row[i - bpp] if i >= bpp else 0
+                row[i] = (row[i] + ((left + prev[i]) >> 1)) & 0xff
+        elif filter_type == 4:
+            for i in range(stride):
+                a = row[i - bpp] if i >= bpp else 0
+                b = prev[i]
+                c = prev[i - bpp] if i >= bpp else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                row[i] = (row[i] + (a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 0xff
+        elif filter_type != 0:
+            raise Exception(f"Invalid png filter {filter_type}")
+        rows.append(row)
+        prev = row
+    return rows
+
+def downscale_png(data: bytes, max_size: int) -> bytes | None:
+    chunks = read_png_chunks(data)
+    if len(chunks) == 0 or chunks[0][0] != b'IHDR':
+        raise Exception(f"Missing png header")
+    width, height, depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', chunks[0][1])
+    if max(width, height) <= max_size: return None
+    if interlace != 0 or color_type not in PNG_CHANNELS or depth not in (1, 2, 4, 8, 16):
+        raise Exception(f"Unsupported png format")
+
+    bits_per_pixel = PNG_CHANNELS[color_type] * depth
+    stride = (width * bits_per_pixel + 7) // 8
+    raw = zlib.decompress(b''.join(chunk_data for chunk_type, chunk_data in chunks if chunk_type == b'IDAT'))
+    rows = unfilter_png_rows(raw, height, stride, max(1, bits_per_pixel // 8))
+
+    scale = max(width, height) / max_size
+    new_width = max(1, round(width / scale))
+    new_height = max(1, round(height / scale))
+    xs = [min(width - 1, int(x * scale)) for x in range(new_width)]
+
+    # sub byte pixels are unpacked to 8 bits, the other formats are copied pixel by pixel
+    new_depth = max(depth, 8)
+    pixel_size = max(1, bits_per_pixel // 8)
+    raw_rows = []
+    for y in range(new_height):
+        row = rows[min(height - 1, int(y * scale))]
+        new_row = bytearray(b'\x00')
+        if depth < 8:
+            mask = (1 << depth) - 1
+            for x in xs:
+                shift = 8 - depth - (x * depth) % 8
+                value = (row[x * depth // 8] >> shift) & mask
+                # grayscale is rescaled to the full 8 bit range, palette indexes are kept
+                new_row.append(value if color_type == 3 else value * 255 // mask)
+        else:
+            for x in xs:
+                new_row += row[x * pixel_size:(x + 1) * pixel_size]
+        raw_rows.append(bytes(new_row))
+
+    header = struct.pack('>IIBBBBB', new_width, new_height, new_depth, color_type, 0, 0, 0)
+    out = [PNG_SIGNATURE, write_png_chunk(b'IHDR', header)]
+    for chunk_type, chunk_data in chunks:
+        if chunk_type in PNG_KEPT_CHUNKS and not (chunk_type == b'tRNS' and depth < 8 and color_type == 0):
+            out.append(write_png_chunk(chunk_type, chunk_data))
+    out.append(write_png_chunk(b'IDAT', zlib.compress(b''.join(raw_rows), 9)))
+    out.append(write_png_chunk(b'IEND', b''))
+    return b''.join(out)
@@ -0,0 +1,393 @@
+import threading
+import logging
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import List
+
+from cartesapp.storage import helpers
+
+from .model import Tape, SessionMarks, has_uncommitted_changes
+
+LOGGER = logging.getLogger(__name__)
+
+LEADERBOARD_CACHE_SIZE = 64
+LEADERBOARD_WINDOW_SIZE = 1024
+SORTED_KEYS_BUCKET_SIZE = 512
+
+
+###
+# Sorted keys
+
+class SortedKeys:
+    """
+    Sorted list split in buckets of at most twice the bucket size, so adding and
+    removing a key only shifts one bucket. The max key of each bucket is kept to
+    find the bucket by bisection
+    """
+    def __init__(self, keys: List[tuple] | None = None, bucket_size: int = SORTED_KEYS_BUCKET_SIZE):
+        self.bucket_size = bucket_size
+        self.buckets = []
+        self.maxes = []
+        self.size = 0
+        if keys is not None: self.load(keys)
+
+    def load(self, keys: List[tuple]):
+        keys = sorted(keys)
+        self.buckets = [keys[i:i + self.bucket_size] for i in range(0, len(keys), self.bucket_size)]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self.size = len(keys)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __contains__(self, key: tuple) -> bool:
+        i = bisect_left(self.maxes, key)
+        if i == len(self.maxes): return False
+        bucket = self.buckets[i]
+        j = bisect_left(bucket, key)
+        return j < len(bucket) and bucket[j] == key
+
+    def __iter__(self):
+        for bucket in self.buckets:
+            yield from bucket
+
+    def add(self, key: tuple):
+        if len(self.buckets) == 0:
+            self.buckets.append([key])
+            self.maxes.append(key)
+            self.size = 1
+            return
+        i = min(bisect_left(self.maxes, key), len(self.maxes) - 1)
+        bucket = self.buckets[i]
+        insort(bucket, key)
+        self.maxes[i] = bucket[-1]
+        self.size += 1
+        if len(bucket) > 2 * self.bucket_size:
+            self.buckets[i:i + 1] = [bucket[:self.bucket_size], bucket[self.bucket_size:]]
+            self.maxes[i:i + 1] = [bucket[self.bucket_size - 1], bucket[-1]]
+
+    def remove(self, key: tuple):
+        i = bisect_left(self.maxes, key)
+        if i < len(self.maxes):
+            bucket = self.buckets[i]
+            j = bisect_left(bucket, key)
+            if j < len(bucket) and bucket[j] == key:
+                del bucket[j]
+                self.size -= 1
+                if len(bucket) == 0:
+                    del self.buckets[i]
+                    del self.maxes[i]
+                else:
+                    self.maxes[i] = bucket[-1]
+                return
+        raise KeyError(key)
+
+    def index(self, key: tuple) -> int:
+        # number of keys lower than key
+        i = bisect_left(self.maxes, key)
+        if i == len(self.maxes): return self.size
+        return sum(len(bucket) for bucket in self.buckets[:i]) + bisect_left(self.buckets[i], key)
+
+    def slice(self, start: int, stop: int) -> List[tuple]:
+        keys = []
+        for bucket in self.buckets:
+            if stop <= 0: break
+            if start < len(bucket):
+                keys.extend(bucket[max(start, 0):stop])
+            start -= len(bucket)
+            stop -= len(bucket)
+        return keys
+
+
+###
+# Leaderboard
+
+class Leaderboard:
+    """
+    Scored tapes of a rule sorted by score desc, then by the earliest input and
+    tape id. Top k, rank of tape and rank of user (by the user's best tape) are
+    bisections over the sorted keys.
+    A board with a max size only holds the top of the rule: the tapes it doesn't
+    hold all sort after its bound, and it is trimmed back to the max size when it
+    grows to twice that
+    """
+    rule_id = None
+
+    def __init__(self, rule_id: str, max_size: int | None = None):
+        self.rule_id = rule_id
+        self.max_size = max_size
+        self.bound = None
+        self.keys = SortedKeys()
+        self.tape_keys = {}
+        self.tape_users = {}
+        self.user_tapes = {}
+        self.user_keys = SortedKeys()
+        self.user_best = {}
+
+    @staticmethod
+    def make_key(tape_id: str, score: int, input_index: int) -> tuple:
+        return (-score, input_index, tape_id)
+
+    def load(self, entries: List[tuple], bound: tuple | None = None):
+        # entries of (tape_id, user_address, score, input_index), bound when they are the top of a larger set
+        self.bound = bound
+        for tape_id, user_address, score, input_index in entries:
+            key = self.make_key(tape_id, score, input_index)
+            self.tape_keys[tape_id] = key
+            self.tape_users[tape_id] = user_address
+            self.user_tapes.setdefault(user_address, set()).add(key)
+            if self.user_best.get(user_address) is None or key < self.user_best[user_address]:
+                self.user_best[user_address] = key
+        self.keys.load(self.tape_keys.values())
+        self.user_keys.load(self.user_best.values())
+
+    def update(self, tape_id: str, user_address: str, score: int, input_index: int):
+        if tape_id in self.tape_keys: self.remove(tape_id)
+        key = self.make_key(tape_id, score, input_index)
+        if self.bound is not None and key > self.bound: return
+        self.keys.add(key)
+        self.tape_keys[tape_id] = key
+        self.tape_users[tape_id] = user_address
+        self.user_tapes.setdefault(user_address, set()).add(key)
+        best = self.user_best.get(user_address)
+        if best is None or key < best:
+            if best is not None: self.user_keys.remove(best)
+            self.user_keys.add(key)
+            self.user_best[user_address] = key
+        if self.max_size is not None and len(self.keys) > 2 * self.max_size:
+            self.trim(self.max_size)
+
+    def remove(self, tape_id: str):
+        key = self.tape_keys.pop(tape_id, None)
+        if key is None: return
+        user_address = self.tape_users.pop(tape_id)
+        self.keys.remove(key)
+        user_tapes = self.user_tapes[user_address]
+        user_tapes.discard(key)
+        if len(user_tapes) == 0: del self.user_tapes[user_address]
+        if self.user_best.get(user_address) == key:
+            self.user_keys.remove(key)
+            del self.user_best[user_address]
+            # next best tape of the user, if any
+            if len(user_tapes) > 0:
+                self.user_best[user_address] = min(user_tapes)
+                self.user_keys.add(self.user_best[user_address])
+
+    def held(self) -> int:
+        return len(self.keys)
+
+    def trim(self, n: int):
+        for key in self.keys.slice(n, self.held()):
+            self.remove(key[2])
+        self.bound = self.keys.slice(n - 1, n)[0]
+
+    def truncated(self) -> bool:
+        return self.bound is not None
+
+    def size(self) -> int:
+        return self.held()
+
+    def n_users(self) -> int:
+        return len(self.user_keys)
+
+    def top(self, k: int, offset: int = 0) -> List[dict]:
+        return [self._entry(key, offset + i + 1) for i, key in enumerate(self.keys.slice(offset, offset + k))]
+
+    def tape_rank(self, tape_id: str) -> int | None:
+        key = self.tape_keys.get(tape_id)
+        if key is None: return None
+        return self.keys.index(key) + 1
+
+    def user_rank(self, user_address: str) -> int | None:
+        # rank among users, each user counted by their best tape
+        key = self.user_best.get(user_address)
+        if key is None: return None
+        return self.user_keys.index(key) + 1
+
+    def tape_entry(self, tape_id: str) -> dict | None:
+        rank = self.tape_rank(tape_id)
+        if rank is None: return None
+        return self._entry(self.tape_keys[tape_id], rank)
+
+    def user_entry(self, user_address: str) -> dict | None:
+        rank = self.user_rank(user_address)
+        if rank is None: return None
+        return self._entry(self.user_best[user_address], rank)
+
+    def _entry(self, key: tuple, rank: int) -> dict:
+        return {
+            "rank": rank,
+            "tape_id": key[2],
+            "user_address": self.tape_users[key[2]],
+            "score": -key[0],
+            "input_index": key[1],
+        }
+
+
+class RuleLeaderboard(Leaderboard):
+    """
+    Leaderboard of a rule backed by the scored tapes. Entries past the top a
+    truncated board holds are read from the tapes index, ranks counting the
+    tapes (or users) sorting before them
+    """
+    def scored_tapes(self):
+        return helpers.select(t for t in Tape if t.rule_id == self.rule_id and t.verified == True and t.score is not None)
+
+    def size(self) -> int:
+        if not self.truncated(): return super().size()
+        return self.scored_tapes().count()
+
+    def n_users(self) -> int:
+        if not self.truncated(): return super().n_users()
+        return helpers.count(t.user_address for t in self.scored_tapes())
+
+    def top(self, k: int, offset: int = 0) -> List[dict]:
+        if not self.truncated() or offset + k <= self.held(): return super().top(k, offset)
+        entries = helpers.select((t.id, t.user_address, t.score, t.input_index) for t in self.scored_tapes()) \
+            .order_by(-3, 4, 1)[offset:offset + k]
+        return [self._stored_entry(entry, offset + i + 1) for i, entry in enumerate(entries)]
+
+    def tape_rank(self, tape_id: str) -> int | None:
+        if tape_id in self.tape_keys or not self.truncated(): return super().tape_rank(tape_id)
+        entry = self.tape_entry(tape_id)
+        return entry['rank'] if entry is not None else None
+
+    def user_rank(self, user_address: str) -> int | None:
+        if user_address in self.user_best or not self.truncated(): return super().user_rank(user_address)
+        entry = self.user_entry(user_address)
+        return entry['rank'] if entry is not None else None
+
+    def tape_entry(self, tape_id: str) -> dict | None:
+        if tape_id in self.tape_keys or not self.truncated(): return super().tape_entry(tape_id)
+        entries = helpers.select((t.id, t.user_address, t.score, t.input_index) for t in self.scored_tapes()
+            if t.id == tape_id)[:1]
+        if len(entries) == 0: return None
+        return self._stored_entry(entries[0], self._tapes_before(entries[0]).count() + 1)
+
+    def user_entry(self, user_address: str) -> dict | None:
+        if user_address in self.user_best or not self.truncated(): return super().user_entry(user_address)
+        entries = helpers.select((t.id, t.user_address, t.score, t.input_index) for t in self.scored_tapes()
+            if t.user_address == user_address).order_by(-3, 4, 1)[:1]
+        if len(entries) == 0: return None
+        return self._stored_entry(entries[0], helpers.count(t.user_address for t in self._tapes_before(entries[0])) + 1)
+
+    def _tapes_before(self, entry: tuple):
+        tape_id, _, score, input_index = entry
+        return helpers.select(t for t in self.scored_tapes() if t.score > score or t.score == score and
+            (t.input_index < input_index or t.input_index == input_index and t.id < tape_id))
+
+    def _stored_entry(self, entry: tuple, rank: int) -> dict:
+        tape_id, user_address, score, input_index = entry
+        return {
+            "rank": rank,
+            "tape_id": tape_id,
+            "user_address": user_address,
+            "score": score,
+            "input_index": input_index,
+        }
+
+
+###
+# Leaderboards
+
+class Leaderboards:
+    """
+    Leaderboards of the most recently used rules, built on first use from the top
+    scored tapes of the rule (at most the window size, read in order from the
+    rule score index). Scored tapes are only marked, their entries are read back
+    from the database once the session that scored them is over, so a rolled back
+    input never reaches a board. Sessions with uncommitted changes get a board
+    built from the database that isn't cached
+    """
+    def __init__(self, max_rules: int = LEADERBOARD_CACHE_SIZE, window_size: int = LEADERBOARD_WINDOW_SIZE):
+        self.max_rules = max_rules
+        self.window_size = window_size
+        self.boards = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get(self, rule_id: str) -> Leaderboard:
+        if has_uncommitted_changes():
+            return self._load(rule_id)
+
+        with self.lock:
+            board = self.boards.get(rule_id)
+            if board is not None:
+                self.boards.move_to_end(rule_id)
+                tape_ids = self._settled_tapes(rule_id)
+        if board is not None:
+            if len(tape_ids) > 0: self._refresh(board, tape_ids)
+            # a truncated board that lost most of its top is read again
+            if not board.truncated() or board.held() >= self.window_size // 2:
+                return board
+
+        board = self._load(rule_id)
+        with self.lock:
+            if rule_id not in self.boards: self.pending.pop(rule_id, None)
+            self.boards[rule_id] = board
+            self.boards.move_to_end(rule_id)
+            while len(self.boards) > self.max_rules:
+                evicted_rule_id, _ = self.boards.popitem(last=False)
+                self.pending.pop(evicted_rule_id, None)
+        return board
+
+    def update_tape(self, rule_id: str, tape_id: str):
+        # boards not in memory are rebuilt from the tapes when needed
+        with self.lock:
+            if rule_id not in self.boards: return
+            self.pending.setdefault(rule_id, SessionMarks()).mark(tape_id)
+
+    def clear(self, rule_id: str | None = None):
+        with self.lock:
+            if rule_id is None:
+                self.boards.clear()
+                self.pending.clear()
+            else:
+                self.boards.pop(rule_id, None)
+                self.pending.pop(rule_id, None)
+
+    def _load(self, rule_id: str) -> Leaderboard:
+        board = RuleLeaderboard(rule_id, self.window_size)
+        entries = helpers.select((t.id, t.user_address, t.score, t.input_index) for t in Tape
+            if t.rule_id == rule_id and t.verified == True and t.score is not None).order_by(-3, 4, 1)[:self.window_size + 1]
+        bound = None
+        if len(entries) > self.window_size:
+            entries = entries[:self.window_size]
+            bound = board.make_key(entries[-1][0], entries[-1][2], entries[-1][3])
+        board.load(entries, bound)
+        LOGGER.debug(f"Loaded leaderboard of rule {rule_id} with {board.held()} tapes")
+        return board
+
+    def _settled_tapes(self, rule_id: str) -> List[str]:
+        # called with the lock held
+        marks = self.pending.get(rule_id)
+        if marks is None: return []
+        tape_ids = marks.pop_settled()
+        if len(marks) == 0: del self.pending[rule_id]
+        return tape_ids
+
+    def _refresh(self, board: Leaderboard, tape_ids: List[str]):
+        # committed state of the marked tapes, rolled back ones drop out or keep their old entry
+        entries = dict((e[0], e) for e in helpers.select(
+            (t.id, t.user_address, t.score, t.input_index) for t in Tape
+                if t.id in tape_ids and t.rule_id == board.rule_id and t.verified == True and t.score is not None).fetch())
+        with self.lock:
+            for tape_id in tape_ids:
+                entry = entries.get(tape_id)
+                if entry is None:
+                    board.remove(tape_id)
+                else:
+                    board.update(*entry)
+
+_default_leaderboards = None
+_default_leaderboards_lock = threading.Lock()
+
+def get_leaderboards() -> Leaderboards:
+    global _default_leaderboards
+    with _default_leaderboards_lock:
+        if _default_leaderboards is None:
+            _default_leaderboards = Leaderboards()
+        return _default_leaderboards
+
+def get_leaderboard(rule_id: str) -> Leaderboard:
+    return get_leaderboards().get(rule_id)
@@ -0,0 +1,92 @@
+from typing import List, Iterator
+
+###
+# MICS incard container
+#
+# Multiple incards are packed in a container of 4-byte big endian words
+# [MICS, n_incards, offset_1, length_1, offset_2, length_2, ..., bytes_1, bytes_2, ...]
+# Offsets are from the start of the container and each incard is padded with
+# spaces to the word size. A single incard is passed as is, with no container
+
+MICS_MAGIC = b'MICS'
+WORD_SIZE = 8
+HALF_WORD_SIZE = WORD_SIZE // 2
+PADDING = b' '
+
+class MicsError(Exception):
+    pass
+
+def padded_size(length: int) -> int:
+    return length + (-length) % WORD_SIZE
+
+def header_size(n_entries: int) -> int:
+    return (1 + n_entries) * WORD_SIZE
+
+def encoded_size(lengths: List[int], container: bool = False) -> int:
+    if not container:
+        if len(lengths) == 0: return 0
+        if len(lengths) == 1: return lengths[0]
+    return header_size(len(lengths)) + sum(padded_size(l) for l in lengths)
+
+def encode(data_list: List[bytes], container: bool = False) -> bytes:
+    # data_list items can be any bytes-like object (e.g. memoryview slices of another container)
+    if not container:
+        if len(data_list) == 0: return b''
+        if len(data_list) == 1: return bytes(data_list[0])
+    lengths = [len(data) for data in data_list]
+    buf = bytearray(PADDING) * encoded_size(lengths, True)
+    buf[0:HALF_WORD_SIZE] = MICS_MAGIC
+    buf[HALF_WORD_SIZE:WORD_SIZE] = len(data_list).to_bytes(HALF_WORD_SIZE,'big')
+    pos = header_size(len(data_list))
+    for i, (data, length) in enumerate(zip(data_list, lengths)):
+        entry = WORD_SIZE * (i + 1)
+        buf[entry:entry + HALF_WORD_SIZE] = pos.to_bytes(HALF_WORD_SIZE,'big')
+        buf[entry + HALF_WORD_SIZE:entry + WORD_SIZE] = length.to_bytes(HALF_WORD_SIZE,'big')
+        buf[pos:pos + length] = data
+        pos += padded_size(length)
+    return bytes(buf)
+
+def is_container(buf: bytes) -> bool:
+    return len(buf) >= WORD_SIZE and bytes(buf[:HALF_WORD_SIZE]) == MICS_MAGIC
+
+def read_entries(buf: bytes) -> List[tuple[int,int]]:
+    # (offset, length) of each incard in the container
+    view = memoryview(buf)
+    n_entries = int.from_bytes(view[HALF_WORD_SIZE:WORD_SIZE],'big')
+    entries = []
+    for i in range(n_entries):
+        entry = WORD_SIZE * (i + 1)
+        entries.append((int.from_bytes(view[entry:entry + HALF_WORD_SIZE],'big'),
+                        int.from_bytes(view[entry + HALF_WORD_SIZE:entry + WORD_SIZE],'big')))
+    return entries
+
+def iter_entries(buf: bytes) -> Iterator[memoryview]:
+    # memoryview slices over the incards in the container, nothing is copied
+    view = memoryview(buf)
+    for offset, length in read_entries(buf):
+        yield view[offset:offset + length]
+
+def validate(buf: bytes):
+    if len(buf) < WORD_SIZE:
+        raise MicsError(f"Incard container is too short")
+    if not is_container(buf):
+        raise MicsError(f"Invalid incard container magic")
+    n_entries = int.from_bytes(bytes(buf[HALF_WORD_SIZE:WORD_SIZE]),'big')
+    if header_size(n_entries) > len(buf):
+        raise MicsError(f"Incard container header is truncated")
+    next_pos = header_size(n_entries)
+    for i, (offset, length) in enumerate(read_entries(buf)):
+        if offset % WORD_SIZE != 0:
+            raise MicsError(f"Incard {i} is not aligned")
+        if offset < next_pos:
+            raise MicsError(f"Incard {i} overlaps the previous data")
+        if offset + length > len(buf):
+            raise MicsError(f"Incard {i} is out of bounds")
+        next_pos = offset + padded_size(length)
+
+def decode(buf: bytes) -> List[memoryview]:
+    # incards of a validated container, or the buffer itself when it isn't one
+    if len(buf) == 0: return []
+    if not is_container(buf): return [memoryview(buf)]
+    validate(buf)
+    return list(iter_entries(buf))
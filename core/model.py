@@ -3,17 +3,29 @@ from pydantic import BaseModel
 import logging
 from typing import Optional, List, Annotated
 import json
-from py_expression_eval import Parser
 import pickle
 import traceback
+import threading
+from hashlib import sha256
+from collections import OrderedDict
 
 from cartesi.abi import String, Bytes, Bytes32, UInt, Bool, ABIType
 
 from cartesapp.storage import Entity, helpers, Storage, seed
+from cartesapp.setup import post_setup
 from cartesapp.utils import hex2bytes, str2bytes, bytes2str
 
-from .riv import riv_get_cartridge_info, riv_get_cover, verify_log
-from .core_settings import CoreSettings, generate_cartridge_id, get_cartridges_path, is_inside_cm, \
+from .riv import riv_get_cartridge_info, riv_get_cover, riv_get_cartridge_metadata, verify_log, riv_mount_session, \
+    staged_cartridge
+from .blob_store import get_cartridge_blob_store
+from .cartridge_stage import get_cartridge_stage
+from . import mics
+from .replay_cache import cached_verify_many
+from .score import evaluate_score
+from .cover import generate_cover_id, encode_cover, make_cover_thumbnail
+from .tag_index import TagIndex
+from .name_index import NameIndex
+from .core_settings import CoreSettings, generate_cartridge_id, is_inside_cm, \
     get_cartridge_tapes_filename, generate_rule_id, generate_rule_parameters_tag, \
     format_cartridge_id_from_bytes, format_tape_id_from_bytes
 
@@ -42,7 +54,7 @@ class Cartridge(Entity):
     created_at      = helpers.Required(int, unsigned=True)
     updated_at      = helpers.Required(int, unsigned=True)
     input_index     = helpers.Required(int, lazy=True) # -1 means not created by an input (created in genesis)
-    cover           = helpers.Optional(bytes, lazy=True)
+    cover_id        = helpers.Optional(str, 64)
     active          = helpers.Optional(bool, lazy=True, index=True)
     unlocked        = helpers.Optional(bool, lazy=True, index=True)
     primary         = helpers.Optional(bool, index=True)
@@ -50,8 +62,15 @@ class Cartridge(Entity):
     versions        = helpers.Optional(helpers.StrArray, lazy=True)
     last_version    = helpers.Optional(str, 64)
     tapes           = helpers.Optional(helpers.StrArray, lazy=True)
+    base_incard     = helpers.Optional(bytes, lazy=True)
+    n_tapes         = helpers.Optional(int, unsigned=True, default=0)
+    n_verified      = helpers.Optional(int, unsigned=True, default=0)
+    n_failed        = helpers.Optional(int, unsigned=True, default=0)
+    n_players       = helpers.Optional(int, unsigned=True, default=0)
+    best_score      = helpers.Optional(int)
     tags            = helpers.Set("CartridgeTag")
     authors         = helpers.Set("CartridgeAuthor")
+    incard_tapes    = helpers.Set("IncardTape")
 
 class CartridgeTag(Entity):
     cartridges      = helpers.Set(Cartridge)
@@ -61,6 +80,12 @@ class CartridgeAuthor(Entity):
     cartridges      = helpers.Set(Cartridge)
     name            = helpers.PrimaryKey(str)
 
+class CartridgeCover(Entity):
+    id              = helpers.PrimaryKey(str, 64) # sha256 of the image
+    size            = helpers.Required(int, unsigned=True)
+    encoded         = helpers.Required(str, lazy=True) # base64
+    thumbnail       = helpers.Optional(str, lazy=True) # base64, empty when the image is already small
+
 class Rule(Entity):
     id              = helpers.PrimaryKey(str, 64)
     name            = helpers.Required(str, index=True)
@@ -79,8 +104,19 @@ class Rule(Entity):
     allow_in_card   = helpers.Optional(bool, lazy=True)
     save_tapes      = helpers.Optional(bool, lazy=True)
     save_out_cards  = helpers.Optional(bool, lazy=True)
+    max_frames      = helpers.Optional(int, unsigned=True, lazy=True)
+    max_time        = helpers.Optional(int, unsigned=True, lazy=True) # seconds, only enforced outside the cartesi machine
+    base_incard     = helpers.Optional(bytes, lazy=True)
     deactivated     = helpers.Optional(bool)
+    n_tapes         = helpers.Optional(int, unsigned=True, default=0)
+    n_verified      = helpers.Optional(int, unsigned=True, default=0)
+    n_failed        = helpers.Optional(int, unsigned=True, default=0)
+    n_players       = helpers.Optional(int, unsigned=True, default=0)
+    best_score      = helpers.Optional(int)
     tags            = helpers.Set("RuleTag")
+    tag_names       = helpers.Optional(helpers.StrArray) # names of tags, kept in sync with RuleTag
+    incard_tapes    = helpers.Set("IncardTape")
+    helpers.composite_index(cartridge_id, name)
 
 class RuleTag(Entity):
     rules           = helpers.Set(Rule)
@@ -97,11 +133,21 @@ class Tape(Entity):
     input_index     = helpers.Required(int, lazy=True)
     score           = helpers.Optional(int, lazy=True)
     verified        = helpers.Optional(bool, lazy=True)
+    error_code      = helpers.Optional(int, lazy=True)
     rank            = helpers.Optional(int, lazy=True)
     out_card        = helpers.Optional(bytes, lazy=True)
     in_card         = helpers.Optional(bytes, lazy=True)
     tapes           = helpers.Optional(helpers.StrArray, lazy=True)
     data            = helpers.Optional(bytes, lazy=True)
+    helpers.composite_index(rule_id, verified, score)
+    helpers.composite_index(rule_id, user_address)
+    helpers.composite_index(cartridge_id, user_address)
+    helpers.composite_index(cartridge_id, timestamp)
+
+class IncardTape(Entity): # tapes in the base incards, so they can be cleared when the out card changes
+    id              = helpers.PrimaryKey(str)
+    cartridges      = helpers.Set(Cartridge)
+    rules           = helpers.Set(Rule)
 
 class RuleData(BaseModel):
     cartridge_id:       Bytes32
@@ -188,26 +234,132 @@ class InfoCartridge(BaseModel):
 #         cartridge_tapes = cls.get_cartridge_tapes()
 #         return cartridge_tapes.get(tape_hash)
     
+###
+# Migrations
+
+# columns added to the tables of existing databases, they must exist before pony checks the tables
+ADDED_COLUMNS = {
+    "Cartridge": {
+        "cover_id": "VARCHAR(64) NOT NULL DEFAULT ''",
+        "base_incard": "BLOB",
+        "n_tapes": "INTEGER UNSIGNED",
+        "n_verified": "INTEGER UNSIGNED",
+        "n_failed": "INTEGER UNSIGNED",
+        "n_players": "INTEGER UNSIGNED",
+        "best_score": "INTEGER",
+    },
+    "Rule": {
+        "max_frames": "INTEGER UNSIGNED",
+        "max_time": "INTEGER UNSIGNED",
+        "base_incard": "BLOB",
+        "n_tapes": "INTEGER UNSIGNED",
+        "n_verified": "INTEGER UNSIGNED",
+        "n_failed": "INTEGER UNSIGNED",
+        "n_players": "INTEGER UNSIGNED",
+        "best_score": "INTEGER",
+        "tag_names": "TEXT[] NOT NULL DEFAULT '[]'",
+    },
+    "Tape": {
+        "error_code": "INTEGER",
+    },
+}
+
+# (table, column) added by this process, their rows are backfilled after setup
+added_columns = set()
+
+def add_missing_columns(database, connection):
+    cursor = connection.cursor()
+    for table, columns in ADDED_COLUMNS.items():
+        existing = [row[1] for row in cursor.execute(f'PRAGMA table_info("{table}")').fetchall()]
+        if len(existing) == 0: continue # new tables are created with all columns
+        for column, definition in columns.items():
+            if column in existing: continue
+            LOGGER.info(f"Adding column {column} to {table}")
+            cursor.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition}')
+            added_columns.add((table, column))
+
+Entity._database_.on_connect(provider='sqlite')(add_missing_columns)
+if Entity._database_.provider is not None:
+    # database bound before this module was loaded
+    _connection, _ = Entity._database_.provider.connect()
+    add_missing_columns(Entity._database_, _connection)
+    _connection.commit()
+    Entity._database_.provider.release(_connection)
+
+@post_setup()
+def backfill_added_columns():
+    # rows of existing databases get the values the columns would have if they always existed
+    with helpers.db_session:
+        if ("Tape", "error_code") in added_columns:
+            # verified tapes passed before error codes were stored
+            for tape in Tape.select(lambda t: t.verified and t.error_code is None):
+                tape.error_code = 0 # ErrorCode.NONE
+
+        if ("Cartridge", "n_tapes") in added_columns or ("Rule", "n_tapes") in added_columns:
+            LOGGER.info(f"Rebuilding activity counters")
+            rebuild_activity_counters()
+
+        if ("Rule", "tag_names") in added_columns:
+            rule_tags = {}
+            for rule_id, name in _load_rule_tags(None):
+                rule_tags.setdefault(rule_id, []).append(name)
+            for rule_id, names in rule_tags.items():
+                Rule[rule_id].tag_names = names
+
+        n_covers = migrate_legacy_covers()
+        if n_covers > 0: LOGGER.info(f"Moved {n_covers} cartridge covers to the cover store")
+
+        if not IncardTape.select().exists():
+            for cartridge in Cartridge.select():
+                if cartridge.tapes: reference_incard_tapes(cartridge, cartridge.tapes)
+            for rule in Rule.select():
+                if rule.tapes: reference_incard_tapes(rule, rule.tapes)
+
+@post_setup()
+def create_missing_indexes():
+    # tables of existing databases are kept as they are, so indexes added later are created here
+    with helpers.db_session:
+        connection = Tape._database_.get_connection()
+        for table in Tape._database_.schema.tables.values():
+            for index in table.indexes.values():
+                if index.is_pk: continue
+                connection.execute(index.get_create_command().replace(" INDEX ", " INDEX IF NOT EXISTS ", 1))
+
 ###
 # Seeds
 
 @seed()
 def initialize_data():
+    # keep riv os mounted across the genesis cartridges
+    with riv_mount_session():
+        initialize_genesis_data()
+
+def initialize_genesis_data():
     cartridge_ids = {}
-    cartridge_data = {}
+    created_ids = []
     for cartridge in CoreSettings().genesis_cartridges:
         try:
             cartridge_path = f"misc/{cartridge}.sqfs"
             with open(cartridge_path,'rb') as cartridge_example_file:
                 cartridge_example_data = cartridge_example_file.read()
                 cartridge_ids[cartridge] = generate_cartridge_id(cartridge_example_data)
-                cartridge_data[cartridge] = cartridge_example_data
-                create_and_unlock_cartridge(cartridge_example_data,msg_sender=CoreSettings().operator_address)
+                create_cartridge(cartridge_example_data,msg_sender=CoreSettings().operator_address)
+                created_ids.append(cartridge_ids[cartridge])
                 if is_inside_cm(): os.remove(cartridge_path)
         except Exception as e:
             LOGGER.warning(e)
             traceback.print_exc()
 
+    # test tapes of the new cartridges run in one batch
+    test_results = verify_cartridge_test_tapes(created_ids)
+    for cartridge_id in created_ids:
+        try:
+            unlock_and_test_cartridge(cartridge_id,test_results.get(cartridge_id),msg_sender=CoreSettings().operator_address)
+        except Exception as e:
+            LOGGER.warning(e)
+            traceback.print_exc()
+
+    rule_confs = []
     for genesis_rule_cartridge in CoreSettings().genesis_rules:
         if cartridge_ids.get(genesis_rule_cartridge) is not None:
             try:
@@ -239,16 +391,29 @@ def initialize_data():
                     str2bytes(rule_conf.name))
                 if helpers.count(r for r in Rule if r.id == rule_id) > 0:
                     raise Exception(f"Rule already exists")
-                test_replay_file = open(CoreSettings().test_tape_path,'rb')
-                test_replay = test_replay_file.read()
-                test_replay_file.close()
-
-                verification_output = verify_log(cartridge_data[genesis_rule_cartridge],test_replay,rule_conf_dict["args"],rule_conf_dict["in_card"])
-                insert_rule(rule_id, rule_conf, verification_output.get("outcard"), msg_sender=CoreSettings().operator_address)
+                rule_confs.append((genesis_rule_cartridge,cartridge.id,rule_id,rule_conf))
             except Exception as e:
                 LOGGER.warning(e)
                 traceback.print_exc()
 
+    # test tapes of all the rules run in one batch
+    test_replay_file = open(CoreSettings().test_tape_path,'rb')
+    test_replay = test_replay_file.read()
+    test_replay_file.close()
+    results = cached_verify_many([{"cartridge": cartridge_id, "cartridge_id": cartridge_id, "log": test_replay,
+        "riv_args": rule_conf.args, "in_card": rule_conf.in_card} for _, cartridge_id, _, rule_conf in rule_confs])
+    for (genesis_rule_cartridge, _, rule_id, rule_conf), result in zip(rule_confs,results):
+        try:
+            if result['error'] is not None:
+                raise Exception(result['error'])
+            rule = insert_rule(rule_id, rule_conf, result['outputs'].get("outcard"), msg_sender=CoreSettings().operator_address)
+            apply_rule_budget(rule,
+                int(CoreSettings().genesis_rules[genesis_rule_cartridge].get("max_frames") or 0),
+                int(CoreSettings().genesis_rules[genesis_rule_cartridge].get("max_time") or 0))
+        except Exception as e:
+            LOGGER.warning(e)
+            traceback.print_exc()
+
 ###
 # Helpers
 
@@ -307,8 +472,7 @@ def insert_rule(rule_id:str, rule_conf: RuleData,outcard_raw: bytes,**metadata):
             raise Exception(f"Couldn't parse json outcard: {e}")
 
         try:
-            parser = Parser()
-            score = parser.parse(rule_conf.score_function).evaluate(outcard_json)
+            score = evaluate_score(rule_conf.score_function,outcard_json)
         except Exception as e:
             raise Exception(f"Couldn't parse score: {e}")
         # function_log = f"function {rule_conf.score_function}"
@@ -350,19 +514,34 @@ def insert_rule_db(rule_id:str, rule_conf: RuleData,**metadata):
         save_tapes = rule_conf.save_tapes,
         save_out_cards = rule_conf.save_out_cards,
     )
+    reference_incard_tapes(new_rule, rule_conf.tapes)
 
-    tags = list(rule_conf.tags)
-    tags.append(generate_rule_parameters_tag(rule_conf.args,rule_conf.in_card,rule_conf.score_function))
+    cartridge = Cartridge.get(lambda c: c.id == payload_cartridge)
+    if cartridge is not None:
+        new_rule.base_incard = build_rule_base_incard(new_rule, cartridge)
+
+    tags = list(dict.fromkeys(rule_conf.tags))
+    parameters_tag = generate_rule_parameters_tag(rule_conf.args,rule_conf.in_card,rule_conf.score_function)
+    if parameters_tag not in tags: tags.append(parameters_tag)
     for tag in tags:
         rule_tag = RuleTag.get(lambda r: r.name == tag and r.cartridge_id == payload_cartridge)
         if rule_tag is None:
             rule_tag = RuleTag(name = tag, cartridge_id = payload_cartridge)
+            get_name_index('rule_tag').update(tag)
         rule_tag.rules.add(new_rule)
+    new_rule.tag_names = tags
+    get_rule_tag_index().update(new_rule.id)
+    get_name_index('rule').update(new_rule.id)
 
     # LOGGER.info(f"{new_rule=}")
 
     return new_rule
 
+def apply_rule_budget(rule: Rule, max_frames: int, max_time: int):
+    # 0 means no limit
+    rule.max_frames = max_frames if max_frames > 0 else None
+    rule.max_time = max_time if max_time > 0 else None
+
 def create_and_unlock_cartridge(cartridge_data, **metadata):
     cartridge = create_cartridge(cartridge_data, **metadata)
     return unlock_and_test_cartridge(cartridge.id, **metadata)
@@ -381,13 +560,10 @@ def create_cartridge(cartridge_data, **metadata):
     if helpers.count(c for c in Cartridge if c.id == cartridge_id) > 0:
         raise Exception(f"Cartridge hash already exists")
 
-    cartridges_path = get_cartridges_path()
-    if not os.path.exists(cartridges_path):
-        os.makedirs(cartridges_path)
-    cartridge_filepath = f"{cartridges_path}/{cartridge_id}"
+    # reject invalid images before storing (metadata is memoized for the unlock)
+    riv_get_cartridge_metadata(cartridge_data,cartridge_id)
 
-    with open(cartridge_filepath,'wb') as cartridge_file:
-        cartridge_file.write(cartridge_data)
+    get_cartridge_blob_store().put(cartridge_id, cartridge_data)
 
     LOGGER.info(f"Storing cartridge (id={cartridge_id})")
 
@@ -400,10 +576,44 @@ def create_cartridge(cartridge_data, **metadata):
         updated_at = metadata.get('timestamp') or 0,
         active = True
     )
+    get_name_index('cartridge').update(cartridge.id)
     
     return cartridge
 
-def unlock_and_test_cartridge(cartridge_id,**metadata):
+def cartridge_test_job(cartridge: Cartridge, test_replay: bytes) -> dict:
+    # verify_many job running the test tape on a locked cartridge
+    incard = b""
+    if cartridge.info.get("tapes") is not None:
+        incard = format_incard(map(lambda x: format_tape_id_from_bytes(hex2bytes(x)), cartridge.info["tapes"]),[b''])
+
+    # only take the screenshot when the cartridge has no cover
+    with staged_cartridge(cartridge.id) as cartridge_filepath:
+        cartridge_cover = riv_get_cover(cartridge_filepath,cartridge.id)
+    has_cover = cartridge_cover is not None and len(cartridge_cover) > 0
+    return {"cartridge": cartridge.id, "cartridge_id": cartridge.id, "log": test_replay, "in_card": incard,
+            "get_screenshot": not has_cover}
+
+def verify_cartridge_test_tapes(cartridge_ids: List[str]) -> dict[str,dict]:
+    # verify_many results of the test tape on the locked cartridges, run in a single batch
+    cartridges = [c for c in Cartridge.select(lambda c: c.id in cartridge_ids) if not c.unlocked]
+    if len(cartridges) == 0: return {}
+    test_replay_file = open(CoreSettings().test_tape_path,'rb')
+    test_replay = test_replay_file.read()
+    test_replay_file.close()
+
+    results = {}
+    jobs = []
+    for cartridge in cartridges:
+        try:
+            jobs.append(cartridge_test_job(cartridge,test_replay))
+        except Exception as e:
+            results[cartridge.id] = {"outputs": None, "error": str(e), "budget_exceeded": False}
+    for job, result in zip(jobs,cached_verify_many(jobs)):
+        results[job['cartridge_id']] = result
+    return results
+
+def unlock_and_test_cartridge(cartridge_id, test_result: dict | None = None, **metadata):
+    # test_result is the cartridge result of verify_cartridge_test_tapes, when tested in a batch
     cartridge = Cartridge.get(lambda c: c.id == cartridge_id)
     if cartridge is None:
         raise Exception(f"Cartridge doesn't exist")
@@ -415,10 +625,9 @@ def unlock_and_test_cartridge(cartridge_id,**metadata):
     if metadata['msg_sender'].lower() != CoreSettings().operator_address:
         raise Exception(f"Sender not allowed")
     
-    cartridges_path = get_cartridges_path()
-    cartridge_filepath = f"{cartridges_path}/{cartridge_id}"
-
-    cartridge_info = riv_get_cartridge_info(cartridge_filepath)
+    with staged_cartridge(cartridge_id) as cartridge_filepath:
+        cartridge_info = riv_get_cartridge_info(cartridge_filepath,cartridge_id)
+        cartridge_cover = riv_get_cover(cartridge_filepath,cartridge_id)
     
     # validate info
     cartridge_info_json = json.loads(cartridge_info)
@@ -433,23 +642,15 @@ def unlock_and_test_cartridge(cartridge_id,**metadata):
         if cartridge.user_address != primary_cartridge.user_address:
             raise Exception(f"Primary cartridge and new version with different users")
 
-    with open(cartridge_filepath,'rb') as cartridge_file:
-        cartridge_data = cartridge_file.read()
-
     # check if cartridge runs
-    test_replay_file = open(CoreSettings().test_tape_path,'rb')
-    test_replay = test_replay_file.read()
-    test_replay_file.close()
-
-    # parse tapes to incard
-    incard = b""
-    if cartridge.info.get("tapes") is not None:
-        incard = format_incard(map(lambda x: format_tape_id_from_bytes(hex2bytes(x)), cartridge.info["tapes"]),[b''])
-
-    verification_output = verify_log(cartridge_data,test_replay,'',incard,get_screenshot=True)
-
-    cartridge_cover = riv_get_cover(cartridge_filepath)
-    if cartridge_cover is None or len(cartridge_cover) == 0:
+    if test_result is None:
+        test_result = verify_cartridge_test_tapes([cartridge_id])[cartridge_id]
+    if test_result['error'] is not None:
+        raise Exception(test_result['error'])
+    verification_output = test_result['outputs']
+
+    has_cover = cartridge_cover is not None and len(cartridge_cover) > 0
+    if not has_cover:
         cartridge_cover = verification_output.get("screenshot")
 
     LOGGER.info(f"Creating cartridge {cartridge_info_json['name']} (id={cartridge_id})")
@@ -462,7 +663,9 @@ def unlock_and_test_cartridge(cartridge_id,**metadata):
         for author_json in cartridge_info_json['authors']:
             if author_json.get('name') is not None:
                 author = CartridgeAuthor.get(lambda r: r.name == author_json['name'])
-                if author is None: author = CartridgeAuthor(name=author_json['name'])
+                if author is None:
+                    author = CartridgeAuthor(name=author_json['name'])
+                    get_name_index('cartridge_author').update(author.name)
                 authors.append(author)
 
     cartridge_tags = []
@@ -472,36 +675,46 @@ def unlock_and_test_cartridge(cartridge_id,**metadata):
             cartridge_tag = CartridgeTag.get(lambda r: r.name == tag)
             if cartridge_tag is None:
                 cartridge_tag = CartridgeTag(name = tag)
+                get_name_index('cartridge_tag').update(tag)
             cartridge_tags.append(cartridge_tag)
 
     cartridge.name = cartridge_info_json['name']
+    get_name_index('cartridge').update(cartridge.id)
     cartridge.authors = authors
     cartridge.info = cartridge_info_json
     cartridge.unlocked = True
 
     if primary_cartridge is None:
         cartridge.original_info = cartridge_info_json
-        cartridge.cover = cartridge_cover
+        cartridge.cover_id = store_cartridge_cover(cartridge_cover)
         cartridge.primary = True
         cartridge.tapes = tapes
+        reference_incard_tapes(cartridge, tapes)
         cartridge.versions = [cartridge_id]
         cartridge.last_version = cartridge_id
         cartridge.tags = cartridge_tags
+        get_cartridge_tag_index().update(cartridge.id)
 
     else:
         if cartridge_info_json.get('authors') is not None:
             primary_cartridge.authors = authors
         primary_cartridge.updated_at = cartridge.updated_at
         primary_cartridge.info = cartridge_info_json
-        primary_cartridge.cover = cartridge_cover
+        previous_cover_id = primary_cartridge.cover_id
+        primary_cartridge.cover_id = store_cartridge_cover(cartridge_cover)
+        release_cartridge_cover(previous_cover_id)
         primary_cartridge.active = True
         primary_cartridge.versions.append(cartridge_id)
         primary_cartridge.last_version = cartridge_id
         primary_cartridge.tags = cartridge_tags
+        get_cartridge_tag_index().update(primary_cartridge.id)
 
         cartridge.primary = False
         cartridge.primary_id = primary_cartridge.id
         cartridge.tapes = tapes
+        reference_incard_tapes(cartridge, tapes)
+
+    cartridge.base_incard = build_cartridge_base_incard(cartridge)
 
     rule_metadata = {
         'input_index': -1,# not created by an input
@@ -667,14 +880,17 @@ def delete_cartridge(cartridge_id,**metadata):
                 primary_cartridge.last_version = ''
                 primary_cartridge.active = False
 
-    with open(f"{get_cartridges_path()}/{cartridge_id}",'rb')as cartridge_file:
-        cartridge_data = cartridge_file.read()
-    cur_cartridge = (cartridge,cartridge_data)
+    # the reader stays readable after the cartridge files are removed
+    cartridge_reader = get_cartridge_blob_store().read(cartridge_id)
+    cur_cartridge = (cartridge,cartridge_reader)
     cartridges_deleted.append(cur_cartridge)
 
     cartridge.active = False
-    cartridge.cover = None
-    os.remove(f"{get_cartridges_path()}/{cartridge_id}")
+    cover_id = cartridge.cover_id
+    cartridge.cover_id = None
+    release_cartridge_cover(cover_id)
+    get_cartridge_blob_store().remove(cartridge_id)
+    get_cartridge_stage().remove(cartridge_id)
 
     return cartridges_deleted
 
@@ -697,55 +913,431 @@ def change_cartridge_user_address(cartridge_id,new_user_address, internal_call=F
     cartridge.user_address = new_user_address
     return cartridge
 
+def get_session_cache():
+    # pony's cache of the current db session, None outside of one
+    return helpers.core.local.db2cache.get(Entity._database_)
+
+def has_uncommitted_changes(cache = None) -> bool:
+    # the session wrote to the database and may still roll back
+    if cache is None: cache = get_session_cache()
+    return cache is not None and cache.is_alive and (cache.modified or cache.in_transaction)
+
+class SessionMarks:
+    """
+    Keys changed by db sessions, e.g. to refresh an in memory index from the
+    database. A key settles once the session that marked it is over (committed or
+    rolled back), or is the current one with nothing left to commit
+    """
+    def __init__(self):
+        self.marks = {}
+        self.lock = threading.Lock()
+
+    def mark(self, key):
+        with self.lock:
+            self.marks[key] = get_session_cache()
+
+    def pop_settled(self) -> list:
+        current = get_session_cache()
+        with self.lock:
+            keys = [key for key, cache in self.marks.items()
+                if cache is None or not cache.is_alive or (cache is current and not has_uncommitted_changes(cache))]
+            for key in keys: del self.marks[key]
+        return keys
+
+    def __len__(self) -> int:
+        return len(self.marks)
+
+    def clear(self):
+        with self.lock:
+            self.marks.clear()
+
+class IncardCache:
+    """
+    Assembled incards keyed by the ordered tape ids and the incard hashes. Entries
+    are dropped when the out card of any referenced tape changes. Only incards of
+    committed out cards should be stored, so a rolled back input leaves no entries
+    behind
+    """
+    max_entries = None
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.tape_keys = {}
+
+    @staticmethod
+    def make_key(tape_ids: List[str], incards: List[bytes]) -> tuple:
+        return (tuple(format_tape_ids(tape_ids)), tuple(sha256(incard).digest() for incard in incards))
+
+    def get(self, key: tuple) -> bytes | None:
+        with self.lock:
+            incard = self.entries.get(key)
+            if incard is not None: self.entries.move_to_end(key)
+            return incard
+
+    def put(self, key: tuple, incard: bytes):
+        with self.lock:
+            self.entries[key] = incard
+            self.entries.move_to_end(key)
+            for tape_id in key[0]:
+                self.tape_keys.setdefault(tape_id,set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, tape_ids: List[str]):
+        with self.lock:
+            for tape_id in format_tape_ids(tape_ids):
+                for key in list(self.tape_keys.get(tape_id) or []):
+                    self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tape_keys.clear()
+
+    def _remove(self, key: tuple):
+        self.entries.pop(key, None)
+        for tape_id in key[0]:
+            keys = self.tape_keys.get(tape_id)
+            if keys is None: continue
+            keys.discard(key)
+            if len(keys) == 0: del self.tape_keys[tape_id]
+
+incard_cache = IncardCache()
+
+def format_tape_ids(tape_ids: List[str]) -> List[str]:
+    return [t[2:] if t.startswith('0x') else t for t in tape_ids]
+
 def format_incard(tape_ids: List[str],incards: List[bytes]) -> bytes:
+    tape_ids = list(tape_ids)
+    # inside an input with pending writes the out cards may still be rolled back
+    use_cache = not has_uncommitted_changes()
+    key = IncardCache.make_key(tape_ids,incards)
+    incard = incard_cache.get(key) if use_cache else None
+    if incard is not None: return incard
+
     incard_data_list = []
     for incard in incards:
         if len(incard) > 0: incard_data_list.append(incard)
     incard_data_list.extend(format_tapes_to_byte_list(tape_ids))
-    return format_bytes_list_to_incard(incard_data_list)
-    
+    incard = format_bytes_list_to_incard(incard_data_list)
+    if use_cache: incard_cache.put(key,incard)
+    return incard
+
 def format_tapes_to_byte_list(tape_ids: List[str]) -> List[bytes]:
+    ids = format_tape_ids(tape_ids)
+    if len(ids) == 0: return []
+    # out card is lazy, so select it explicitly to load all tapes in one query
+    outcards = dict(helpers.select((r.id, r.out_card) for r in Tape if r.id in ids))
     tapes_data_list = []
-    for t in tape_ids:
-        tape_id = t[2:] if t.startswith('0x') else t
-        tape = Tape.get(lambda r: r.id == tape_id)
-        if tape is None or tape.out_card is None or len(tape.out_card) == 0: continue
-        tapes_data_list.append(tape.out_card)
-        # outcard = TapeHash.get_outcard(tape_id)
-        # if outcard is None or len(outcard) == 0: continue
-        # tapes_data_list.append(outcard)
+    for tape_id in ids:
+        outcard = outcards.get(tape_id)
+        if outcard is None or len(outcard) == 0: continue
+        tapes_data_list.append(outcard)
     return tapes_data_list
 
 
-word_size = 8
-to_bytes_half = lambda x: x.to_bytes(word_size//2,'big')
-to_bytes = lambda x: x.to_bytes(word_size,'big')
-
 def format_bytes_list_to_incard(incard_data_list: List[bytes]):
-    if len(incard_data_list) == 0: return b''
-    if len(incard_data_list) == 1: return incard_data_list[0]
-    next_pos = (1 + len(incard_data_list)) * 8
-    final_incard = b'MICS' + to_bytes_half(len(incard_data_list))
-    incard_data = b''
-    for outcard in incard_data_list:
-        l = len(outcard)
-        final_incard += to_bytes_half(next_pos) + to_bytes_half(l)
-        r = l % word_size
-        if r > 0: l += word_size - r
-        incard_data += outcard.ljust(l)
-        next_pos += l
-    final_incard += incard_data
-    return final_incard
-
-
-# Tipo (4-byte words)
-# [MICD, n_incards, offset_1, length_1, offset_2, length_2, ..., bytes_1, bytes_2, ...]
-# ￼
-# 0 - MICD - header
-# 4 - 0x0000002 - incard count
-# 8 - 0x000001c - incard 1 offset (in the 2MB data)
-# 12 - 0x0000010 - incard 1 size (0x10 bytes)
-# 16 - 0x0000080 - incard 2 offset
-# 24 - 0x0000010 - incard 2 size (0x10 bytes)
-# 28 - incard 1 start
-# ...
+    return mics.encode(incard_data_list)
+
+
+###
+# Base incards
+
+# The incard parts that don't depend on the tape (rule incard, cartridge and rule tape
+# out cards) are kept as a MICS container, so a verification only appends its own parts.
+# Containers are stored in base_incard and cleared when a referenced tape changes
+
+def extend_base_incard(base: bytes, n_head: int, incards: List[bytes], outcards: List[bytes], container: bool = False) -> bytes:
+    # final order is the first n_head base parts, incards, remaining base parts, outcards
+    base_parts = list(mics.iter_entries(base)) if len(base) > 0 else []
+    new_parts = lambda data_list: [d for d in data_list if len(d) > 0]
+    return mics.encode(base_parts[:n_head] + new_parts(incards) + base_parts[n_head:] + new_parts(outcards), container)
+
+def build_cartridge_base_incard(cartridge: Cartridge) -> bytes:
+    return extend_base_incard(b'', 0, [], format_tapes_to_byte_list(cartridge.tapes or []), container=True)
+
+def get_cartridge_base_incard(cartridge: Cartridge, store: bool = True) -> bytes:
+    base = cartridge.base_incard
+    if base is None:
+        base = build_cartridge_base_incard(cartridge)
+        if store: cartridge.base_incard = base
+    return base
+
+def build_rule_base_incard(rule: Rule, cartridge: Cartridge, store: bool = True) -> bytes:
+    return extend_base_incard(get_cartridge_base_incard(cartridge, store), 0, [rule.in_card or b''],
+                              format_tapes_to_byte_list(rule.tapes or []), container=True)
+
+def get_rule_base_incard(rule: Rule, cartridge: Cartridge, store: bool = True) -> bytes:
+    base = rule.base_incard
+    if base is None:
+        base = build_rule_base_incard(rule, cartridge, store)
+        if store: rule.base_incard = base
+    return base
+
+def format_cartridge_incard(cartridge: Cartridge, incards: List[bytes], tape_ids: List[str], store: bool = True) -> bytes:
+    # same as format_incard(cartridge.tapes + tape_ids, incards)
+    return extend_base_incard(get_cartridge_base_incard(cartridge, store), 0, incards, format_tapes_to_byte_list(tape_ids))
+
+def format_rule_incard(rule: Rule, cartridge: Cartridge, incards: List[bytes], tape_ids: List[str], store: bool = True) -> bytes:
+    # same as format_incard(cartridge.tapes + rule.tapes + tape_ids, [rule.in_card] + incards)
+    n_head = 1 if rule.in_card is not None and len(rule.in_card) > 0 else 0
+    return extend_base_incard(get_rule_base_incard(rule, cartridge, store), n_head, incards, format_tapes_to_byte_list(tape_ids))
+
+def reference_incard_tapes(entity: Cartridge | Rule, tape_ids: List[str]):
+    # keeps the tapes of the base incard of a cartridge or rule
+    for tape_id in set(format_tape_ids(tape_ids)):
+        incard_tape = IncardTape.get(id=tape_id)
+        if incard_tape is None: incard_tape = IncardTape(id=tape_id)
+        entity.incard_tapes.add(incard_tape)
+
+def invalidate_incards(tape_ids: List[str]):
+    # called when the out card of the tapes changed
+    incard_cache.invalidate(tape_ids)
+    ids = format_tape_ids(tape_ids)
+    cartridge_ids = []
+    for cartridge in helpers.select(c for t in IncardTape if t.id in ids for c in t.cartridges):
+        cartridge.base_incard = None
+        cartridge_ids.append(cartridge.id)
+    # rule base incards extend the cartridge one
+    for rule in Rule.select(lambda r: r.cartridge_id in cartridge_ids):
+        rule.base_incard = None
+    for rule in helpers.select(r for t in IncardTape if t.id in ids for r in t.rules):
+        rule.base_incard = None
+
+
+
+###
+# Activity counters
+
+def count_tape_submission(rule: Rule, cartridge: Cartridge | None, user_address: str):
+    # called before the tape is inserted, so a player is new when they have no tapes yet
+    if not helpers.exists(t for t in Tape if t.rule_id == rule.id and t.user_address == user_address):
+        rule.n_players += 1
+    rule.n_tapes += 1
+    if cartridge is not None:
+        if not helpers.exists(t for t in Tape if t.cartridge_id == cartridge.id and t.user_address == user_address):
+            cartridge.n_players += 1
+        cartridge.n_tapes += 1
+
+def count_tape_verification(rule: Rule, cartridge: Cartridge | None, score: int, error_code: int):
+    for entity in (rule, cartridge):
+        if entity is None: continue
+        if error_code == 0:
+            entity.n_verified += 1
+            if entity.best_score is None or score > entity.best_score: entity.best_score = score
+        else:
+            entity.n_failed += 1
+
+def rebuild_activity_counters(cartridge_ids: List[str] | None = None) -> int:
+    # recomputes the counters from the tapes, of all rules and cartridges or only of the cartridges given
+    rules_query = Rule.select()
+    cartridges_query = Cartridge.select()
+    tapes_query = Tape.select()
+    if cartridge_ids is not None:
+        rules_query = rules_query.filter(lambda r: r.cartridge_id in cartridge_ids)
+        cartridges_query = cartridges_query.filter(lambda c: c.id in cartridge_ids)
+        tapes_query = tapes_query.filter(lambda t: t.cartridge_id in cartridge_ids)
+
+    counters = {}
+    players = {}
+    n_tapes = 0
+    for _, rule_id, cartridge_id, user_address, verified, score, error_code in helpers.select(
+            (t.id, t.rule_id, t.cartridge_id, t.user_address, t.verified, t.score, t.error_code) for t in tapes_query).fetch():
+        n_tapes += 1
+        for key in (('rule', rule_id), ('cartridge', cartridge_id)):
+            entry = counters.setdefault(key, {"n_tapes": 0, "n_verified": 0, "n_failed": 0, "best_score": None})
+            players.setdefault(key, set()).add(user_address)
+            entry["n_tapes"] += 1
+            if not verified: continue
+            if not error_code:
+                entry["n_verified"] += 1
+                if score is not None and (entry["best_score"] is None or score > entry["best_score"]):
+                    entry["best_score"] = score
+            else:
+                entry["n_failed"] += 1
+
+    for kind, query in (('rule', rules_query), ('cartridge', cartridges_query)):
+        for entity in query:
+            entry = counters.get((kind, entity.id), {"n_tapes": 0, "n_verified": 0, "n_failed": 0, "best_score": None})
+            entity.n_tapes = entry["n_tapes"]
+            entity.n_verified = entry["n_verified"]
+            entity.n_failed = entry["n_failed"]
+            entity.best_score = entry["best_score"]
+            entity.n_players = len(players.get((kind, entity.id), ()))
+    return n_tapes
+
+###
+# Covers
+
+def store_cartridge_cover(cover: bytes) -> str | None:
+    # covers are stored once per image with the base64 forms the queries return
+    if cover is None or len(cover) == 0: return None
+    cover_id = generate_cover_id(cover)
+    if not CartridgeCover.exists(id=cover_id):
+        thumbnail = make_cover_thumbnail(cover)
+        CartridgeCover(
+            id = cover_id,
+            size = len(cover),
+            encoded = encode_cover(cover),
+            thumbnail = encode_cover(thumbnail) if thumbnail is not None else ''
+        )
+    return cover_id
+
+def migrate_legacy_covers() -> int:
+    # covers stored in the cartridge rows before the cover store are moved to it
+    connection = Cartridge._database_.get_connection()
+    if "cover" not in [row[1] for row in connection.execute('PRAGMA table_info("Cartridge")')]: return 0
+    ids = [row[0] for row in connection.execute('SELECT "id" FROM "Cartridge" WHERE "cover" IS NOT NULL')]
+    for cartridge_id in ids:
+        cover = connection.execute('SELECT "cover" FROM "Cartridge" WHERE "id" = ?', (cartridge_id,)).fetchone()[0]
+        cartridge = Cartridge[cartridge_id]
+        if not cartridge.cover_id: cartridge.cover_id = store_cartridge_cover(bytes(cover))
+    # written in the same transaction before the old covers are dropped
+    helpers.flush()
+    connection.execute('UPDATE "Cartridge" SET "cover" = NULL WHERE "cover" IS NOT NULL')
+    return len(ids)
+
+def release_cartridge_cover(cover_id: str | None):
+    if cover_id is None or len(cover_id) == 0: return
+    if helpers.count(c for c in Cartridge if c.cover_id == cover_id) > 0: return
+    cover = CartridgeCover.get(id=cover_id)
+    if cover is not None: cover.delete()
+
+def get_encoded_covers(cover_ids: List[str], thumbnail: bool = False) -> dict[str,str]:
+    # base64 covers by id, thumbnails fall back to the full image when there is none
+    ids = list(set(cover_id for cover_id in cover_ids if cover_id))
+    if len(ids) == 0: return {}
+    covers = {}
+    if thumbnail:
+        covers = dict(helpers.select((c.id, c.thumbnail) for c in CartridgeCover if c.id in ids and c.thumbnail != '').fetch())
+    missing = [cover_id for cover_id in ids if cover_id not in covers]
+    if len(missing) > 0:
+        covers.update(helpers.select((c.id, c.encoded) for c in CartridgeCover if c.id in missing).fetch())
+    return covers
+
+###
+# Tag indexes
+
+# larger matches are filtered joining the tag tables instead of with an id list
+TAG_FILTER_MAX_IDS = 500
+
+def _load_cartridge_tags(cartridge_ids: List[str] | None) -> List[tuple[str,str]]:
+    if cartridge_ids is None:
+        return helpers.select((c.id, t.name) for t in CartridgeTag for c in t.cartridges).fetch()
+    return helpers.select((c.id, t.name) for t in CartridgeTag for c in t.cartridges if c.id in cartridge_ids).fetch()
+
+def _load_rule_tags(rule_ids: List[str] | None) -> List[tuple[str,str]]:
+    if rule_ids is None:
+        return helpers.select((r.id, t.name) for t in RuleTag for r in t.rules).fetch()
+    return helpers.select((r.id, t.name) for t in RuleTag for r in t.rules if r.id in rule_ids).fetch()
+
+_cartridge_tag_index = None
+_rule_tag_index = None
+_tag_index_lock = threading.Lock()
+
+def get_cartridge_tag_index() -> TagIndex:
+    global _cartridge_tag_index
+    with _tag_index_lock:
+        if _cartridge_tag_index is None:
+            _cartridge_tag_index = TagIndex(_load_cartridge_tags, SessionMarks())
+        return _cartridge_tag_index
+
+def get_rule_tag_index() -> TagIndex:
+    global _rule_tag_index
+    with _tag_index_lock:
+        if _rule_tag_index is None:
+            _rule_tag_index = TagIndex(_load_rule_tags, SessionMarks())
+        return _rule_tag_index
+
+def _match_tags(tag_index: TagIndex, tags: List[str], match_any: bool) -> List[str] | None:
+    # the index doesn't see the session's uncommitted changes
+    if has_uncommitted_changes(): return None
+    return tag_index.match(tags, match_any=match_any, max_size=TAG_FILTER_MAX_IDS)
+
+def filter_cartridges_by_tags(query, tags: List[str], match_any: bool = False):
+    cartridge_ids = _match_tags(get_cartridge_tag_index(), tags, match_any)
+    if cartridge_ids is not None:
+        return query.filter(lambda c: c.id in cartridge_ids)
+    if match_any:
+        return query.filter(lambda c: helpers.exists(t for t in c.tags if t.name in tags))
+    for tag in set(tags):
+        query = query.filter(lambda c: helpers.exists(t for t in c.tags if t.name == tag))
+    return query
+
+def filter_rules_by_tags(query, tags: List[str], match_any: bool = False):
+    rule_ids = _match_tags(get_rule_tag_index(), tags, match_any)
+    if rule_ids is not None:
+        return query.filter(lambda r: r.id in rule_ids)
+    if match_any:
+        return query.filter(lambda r: helpers.exists(t for t in r.tags if t.name in tags))
+    for tag in set(tags):
+        query = query.filter(lambda r: helpers.exists(t for t in r.tags if t.name == tag))
+    return query
+
+def filter_tapes_by_tags(query, tags: List[str], match_any: bool = False):
+    # tapes have the tags of their rules
+    rule_ids = _match_tags(get_rule_tag_index(), tags, match_any)
+    if rule_ids is not None:
+        return query.filter(lambda x: x.rule_id in rule_ids)
+    if match_any:
+        return query.filter(lambda x: helpers.exists(t for t in RuleTag for r in t.rules if r.id == x.rule_id and t.name in tags))
+    for tag in set(tags):
+        query = query.filter(lambda x: helpers.exists(t for t in RuleTag for r in t.rules if r.id == x.rule_id and t.name == tag))
+    return query
+
+###
+# Name indexes
+
+def _load_cartridge_names(cartridge_ids: List[str] | None) -> List[tuple[str,str]]:
+    if cartridge_ids is None:
+        return helpers.select((c.id, c.name) for c in Cartridge).fetch()
+    return helpers.select((c.id, c.name) for c in Cartridge if c.id in cartridge_ids).fetch()
+
+def _load_rule_names(rule_ids: List[str] | None) -> List[tuple[str,str]]:
+    if rule_ids is None:
+        return helpers.select((r.id, r.name) for r in Rule).fetch()
+    return helpers.select((r.id, r.name) for r in Rule if r.id in rule_ids).fetch()
+
+def _load_cartridge_author_names(names: List[str] | None) -> List[tuple[str,str]]:
+    if names is None:
+        return [(name, name) for name in helpers.select(a.name for a in CartridgeAuthor).fetch()]
+    return [(name, name) for name in helpers.select(a.name for a in CartridgeAuthor if a.name in names).fetch()]
+
+def _load_cartridge_tag_names(names: List[str] | None) -> List[tuple[str,str]]:
+    if names is None:
+        return [(name, name) for name in helpers.select(t.name for t in CartridgeTag).fetch()]
+    return [(name, name) for name in helpers.select(t.name for t in CartridgeTag if t.name in names).fetch()]
+
+def _load_rule_tag_names(names: List[str] | None) -> List[tuple[str,str]]:
+    if names is None:
+        return [(name, name) for name in helpers.select(t.name for t in RuleTag).fetch()]
+    return [(name, name) for name in helpers.select(t.name for t in RuleTag if t.name in names).fetch()]
+
+# larger candidate sets are left to the like filter instead of an id list
+NAME_FILTER_MAX_IDS = 500
+
+# names are keyed by the entity id, authors and tags by the name itself
+NAME_INDEX_LOADERS = {
+    'cartridge': _load_cartridge_names,
+    'rule': _load_rule_names,
+    'cartridge_author': _load_cartridge_author_names,
+    'cartridge_tag': _load_cartridge_tag_names,
+    'rule_tag': _load_rule_tag_names,
+}
+
+_name_indexes = {}
+_name_index_lock = threading.Lock()
+
+def get_name_index(kind: str) -> NameIndex:
+    with _name_index_lock:
+        if _name_indexes.get(kind) is None:
+            _name_indexes[kind] = NameIndex(NAME_INDEX_LOADERS[kind], SessionMarks())
+        return _name_indexes[kind]
+
+def name_candidates(kind: str, substring: str) -> List[str] | None:
+    # keys to narrow a name like filter to, None to run it on its own
+    # the index doesn't see the session's uncommitted changes
+    if has_uncommitted_changes(): return None
+    return get_name_index(kind).candidates(substring, max_size=NAME_FILTER_MAX_IDS)
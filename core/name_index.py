@@ -0,0 +1,37 @@
+from typing import List, Callable
+
+from .tag_index import TagIndex
+
+NAME_INDEX_GRAM_SIZE = 3
+
+
+###
+# Trigrams
+
+def name_trigrams(name: str) -> set[str]:
+    # like queries are case insensitive, so are the trigrams. casefold maps each char
+    # on its own (lower doesn't, e.g. the final sigma), so a substring keeps its trigrams
+    name = name.casefold()
+    return set(name[i:i + NAME_INDEX_GRAM_SIZE] for i in range(len(name) - NAME_INDEX_GRAM_SIZE + 1))
+
+
+###
+# Name index
+
+class NameIndex(TagIndex):
+    """
+    Bitmaps of entity ordinals by the trigrams of their names. A substring is only
+    in the names having all of its trigrams, so the intersection narrows the
+    candidates the like match has to check
+    """
+    def __init__(self, load_fn: Callable[[List[str] | None], List[tuple[str,str]]], marks):
+        # load_fn returns the (key, name) pairs of the given keys, or of all of them
+        super().__init__(lambda keys: [(key, trigram) for key, name in load_fn(keys) for trigram in name_trigrams(name)], marks)
+
+    def candidates(self, substring: str, max_size: int | None = None) -> List[str] | None:
+        # keys of the names that may contain the substring (a superset, the like match
+        # still filters them), None when it is too short to narrow them or there are
+        # more than max_size
+        trigrams = name_trigrams(substring)
+        if len(trigrams) == 0: return None
+        return self.match(list(trigrams), max_size=max_size)
@@ -0,0 +1,88 @@
+import json
+import base64
+from typing import List
+
+from cartesapp.storage import helpers
+
+from .projection import select_columns, column_rows
+
+DEFAULT_PAGE_SIZE = 10
+
+
+###
+# Keyset pagination
+#
+# Pages are sought from the order by values of the last row of the previous
+# page plus its primary key, so deep pages cost the same as the first one.
+# Nulls sort first in ascending order and last in descending order (sqlite)
+
+def parse_order(entity, order_by: str | None, order_dir: str | None) -> List[tuple[str,bool]]:
+    # (attribute, descending) list ending with the primary key
+    order = []
+    order_dirs = order_dir.split(',') if order_dir is not None else []
+    for idx, name in enumerate(order_by.split(',') if order_by is not None else []):
+        if not name.isidentifier() or name not in entity._adict_ or entity._adict_[name].py_type not in (int, str, bool):
+            raise Exception(f"Invalid order by {name}")
+        direction = order_dirs[idx] if idx < len(order_dirs) else "asc"
+        if direction not in ("asc", "desc"):
+            raise Exception(f"Invalid order dir {direction}")
+        order.append((name, direction == "desc"))
+    pk_name = entity._pk_attrs_[0].name
+    if pk_name not in [name for name, _ in order]:
+        order.append((pk_name, False))
+    return order
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',',':')).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise Exception(f"Invalid cursor")
+
+def _after_expression(name: str, descending: bool, value_name: str, value) -> str:
+    if value is None:
+        return "False" if descending else f"x.{name} is not None"
+    if descending:
+        return f"(x.{name} < {value_name} or x.{name} is None)"
+    return f"x.{name} > {value_name}"
+
+def _equal_expression(name: str, value_name: str, value) -> str:
+    return f"x.{name} is None" if value is None else f"x.{name} == {value_name}"
+
+def seek(query, order: List[tuple[str,bool]], values: list):
+    # rows strictly after values in the order
+    if len(values) != len(order):
+        raise Exception(f"Cursor doesn't match the order")
+    params = dict((f"v{i}", value) for i, value in enumerate(values))
+    terms = []
+    for i, (name, descending) in enumerate(order):
+        term = [_equal_expression(order[j][0], f"v{j}", values[j]) for j in range(i)]
+        term.append(_after_expression(name, descending, f"v{i}", values[i]))
+        terms.append(f"({' and '.join(term)})")
+    return query.filter(f"lambda x: {' or '.join(terms)}", {}, params)
+
+def keyset_page(query, entity, order: List[tuple[str,bool]], cursor: str | None, page_size: int | None,
+                columns: List[str] | None = None) -> tuple[list,str | None]:
+    # rows of the page and the cursor of the next one (None on the last page). An empty cursor is the first page.
+    # With columns the rows are dicts of those columns (and the order ones) instead of entities
+    page_size = page_size if page_size is not None else DEFAULT_PAGE_SIZE
+    if cursor:
+        query = seek(query, order, decode_cursor(cursor))
+    query = query.order_by(*[helpers.desc(getattr(entity, name)) if descending else getattr(entity, name)
+                             for name, descending in order])
+    if columns is not None:
+        columns = columns + [name for name, _ in order if name not in columns]
+        query = select_columns(query, columns)
+    rows = list(query.limit(page_size + 1))
+    if columns is not None:
+        rows = column_rows(rows, columns)
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        if columns is not None:
+            next_cursor = encode_cursor([rows[-1][name] for name, _ in order])
+        else:
+            next_cursor = encode_cursor([getattr(rows[-1], name) for name, _ in order])
+    return rows, next_cursor
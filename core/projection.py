@@ -0,0 +1,43 @@
+from typing import List
+
+from cartesapp.storage import helpers
+
+
+###
+# Field projection
+#
+# List queries can ask for a subset of the columns. The page is selected as a
+# tuple of the requested columns only (plus the ones the extra fields derive
+# from), so the other columns are neither read nor loaded into entities
+
+def parse_fields(entity, fields: List[str], extra_fields: List[str] = ()) -> List[str]:
+    # requested columns (or extra fields the query computes), always starting with the primary key
+    pk_name = entity._pk_attrs_[0].name
+    parsed = [pk_name]
+    for name in fields:
+        if name in parsed: continue
+        if name not in extra_fields:
+            attr = entity._adict_.get(name) if name.isidentifier() else None
+            if attr is None or attr.is_collection:
+                raise Exception(f"Invalid field {name}")
+        parsed.append(name)
+    return parsed
+
+def field_columns(entity, fields: List[str], extra_columns: List[str] = ()) -> List[str]:
+    # columns to select for the fields, then the columns the extra fields are computed from
+    columns = [name for name in fields if name in entity._adict_ and not entity._adict_[name].is_collection]
+    return columns + [name for name in extra_columns if name not in columns]
+
+def select_columns(query, columns: List[str]):
+    # the rows of an entity query (filters and order kept) as tuples of the columns
+    attrs = ''.join(f"x.{name}, " for name in columns)
+    return helpers.select(f"({attrs}) for x in query", {}, {'query': query}).distinct()
+
+def column_rows(rows: list, columns: List[str]) -> List[dict]:
+    # a single column is selected as plain values
+    if len(columns) == 1: return [{columns[0]: row} for row in rows]
+    return [dict(zip(columns, row)) for row in rows]
+
+def project(rows: List[dict], fields: List[str]) -> List[dict]:
+    # dicts with the column fields of the rows, in the same order
+    return [dict((name, row[name]) for name in fields if name in row) for row in rows]
@@ -0,0 +1,331 @@
+import os
+import stat
+import struct
+import threading
+import logging
+from hashlib import sha256
+from collections import OrderedDict
+
+from cartesapp.utils import str2bytes
+
+from .core_settings import CoreSettings, generate_cartridge_id
+from .riv import verify_log, verify_many, cartridge_emulator_key
+
+LOGGER = logging.getLogger(__name__)
+
+CACHED_OUTPUTS = ["outcard","outhash","outhist"]
+# entries on disk are the cached outputs in order, each prefixed by its length
+ENTRY_MAGIC = b'RIVREPLAY1'
+ENTRY_LENGTH_FORMAT = '>Q'
+ENTRY_LENGTH_SIZE = struct.calcsize(ENTRY_LENGTH_FORMAT)
+
+
+###
+# Cache
+
+class InFlightReplay:
+    event = None
+    result = None
+    error = None
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class ReplayCache:
+    """
+    Replay outputs keyed by the full verification input (cartridge id, riv
+    version and emulator binary, log, args, incard, entropy, stop frame).
+    Replays are deterministic so entries never go stale, they are only evicted
+    in lru order to respect the size limits. An in-memory lru sits in front of
+    the optional disk store, kept in a private directory of this user, and
+    concurrent identical replays run the emulator only once
+    """
+    cache_dir = None
+    max_bytes = None
+    memory_max_bytes = None
+
+    def __init__(self, cache_dir: str | None, max_bytes: int, memory_max_bytes: int, emulator_key_function=None):
+        self.cache_dir = cache_dir
+        self.emulator_key_function = emulator_key_function or cartridge_emulator_key
+        self.max_bytes = max_bytes
+        self.memory_max_bytes = memory_max_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        if self.cache_dir is not None and not self._check_cache_dir():
+            self.cache_dir = None
+        if self.cache_dir is not None:
+            self._load_disk_index()
+
+    def _check_cache_dir(self) -> bool:
+        # cached entries are trusted outputs, so only a directory private to this user is used
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            st = os.lstat(self.cache_dir)
+            if not stat.S_ISDIR(st.st_mode):
+                raise Exception(f"not a directory")
+            if st.st_uid != os.getuid():
+                raise Exception(f"owned by uid {st.st_uid}")
+            if stat.S_IMODE(st.st_mode) & 0o077 != 0:
+                os.chmod(self.cache_dir, 0o700)
+        except Exception as e:
+            LOGGER.error(f"Not using replay cache dir {self.cache_dir}: {e}")
+            return False
+        return True
+
+    @staticmethod
+    def make_key(cartridge_id: str, emulator: str, log: bytes, riv_args: str, in_card: bytes, entropy: str = None,
+                 frame: int = None, get_outhist=False) -> str:
+        key_data = b'\0'.join([
+            str2bytes(cartridge_id),
+            str2bytes(emulator),
+            sha256(log).digest(),
+            str2bytes(riv_args or ''),
+            sha256(in_card or b'').digest(),
+            str2bytes(entropy or ''),
+            str2bytes(f"{frame}"),
+            str2bytes(f"{get_outhist}"),
+        ])
+        return sha256(key_data).hexdigest()
+
+    def get(self, key: str) -> dict[str,bytes] | None:
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                return dict(entry)
+        # the disk store may be shared with other processes
+        if self.cache_dir is None or not os.path.exists(self._disk_path(key)): return None
+        entry = self._read_disk(key)
+        if entry is None: return None
+        with self.lock:
+            if key in self.disk:
+                self.disk.move_to_end(key)
+            else:
+                self.disk[key] = os.path.getsize(self._disk_path(key))
+                self.disk_bytes += self.disk[key]
+            self._put_memory(key, entry)
+        return dict(entry)
+
+    def put(self, key: str, outputs: dict[str,bytes]):
+        entry = dict((k,outputs.get(k) or b'') for k in CACHED_OUTPUTS)
+        with self.lock:
+            self._put_memory(key, entry)
+        if self.cache_dir is not None:
+            self._write_disk(key, entry)
+
+    def verify_log(self, cartridge: bytes | str, log: bytes,riv_args: str,in_card: bytes, entropy: str = None,
+                   frame: int =None,get_outhist=False,get_screenshot=False,verify_function=None) -> dict[str,bytes]:
+        if verify_function is None: verify_function = verify_log
+        if get_screenshot:
+            # screenshots are not cached
+            return verify_function(cartridge,log,riv_args,in_card,entropy,frame,get_outhist,get_screenshot)
+
+        key = self.make_key(get_replay_cartridge_id(cartridge),self.emulator_key_function(cartridge),
+                            log,riv_args,in_card,entropy,frame,get_outhist)
+        outputs = self.get(key)
+        if outputs is not None:
+            with self.lock: self.hits += 1
+            return outputs | {"screenshot": b''}
+
+        with self.lock:
+            in_flight = self.in_flight.get(key)
+            leader = in_flight is None
+            if leader:
+                in_flight = InFlightReplay()
+                self.in_flight[key] = in_flight
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            in_flight.event.wait()
+            if in_flight.error is not None: raise in_flight.error
+            return dict(in_flight.result)
+
+        try:
+            in_flight.result = verify_function(cartridge,log,riv_args,in_card,entropy,frame,get_outhist,get_screenshot)
+            self.put(key, in_flight.result)
+            return in_flight.result
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            in_flight.event.set()
+
+    def verify_many(self, jobs: list[dict], max_workers: int = 1) -> list[dict]:
+        # verify_many with the cached outputs of the jobs found, the others run in a single batch.
+        # Jobs with a screenshot or a time or frame budget always run
+        results = [None] * len(jobs)
+        keys = {}
+        for i, job in enumerate(jobs):
+            if job.get('get_screenshot') or job.get('max_frames') is not None or job.get('timeout') is not None:
+                continue
+            keys[i] = self.make_key(job.get('cartridge_id') or get_replay_cartridge_id(job['cartridge']),
+                                    self.emulator_key_function(job['cartridge']),job['log'],job.get('riv_args'),
+                                    job.get('in_card'),job.get('entropy'),job.get('frame'),job.get('get_outhist') or False)
+            outputs = self.get(keys[i])
+            if outputs is not None:
+                with self.lock: self.hits += 1
+                results[i] = {"outputs": outputs | {"screenshot": b''}, "error": None, "budget_exceeded": False}
+
+        pending = [i for i, result in enumerate(results) if result is None]
+        with self.lock: self.misses += len([i for i in pending if i in keys])
+        for i, result in zip(pending, verify_many([jobs[i] for i in pending], max_workers)):
+            if result['error'] is None and keys.get(i) is not None:
+                self.put(keys[i], result['outputs'])
+            results[i] = result
+        return results
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.memory_bytes = 0
+            for key in list(self.disk.keys()):
+                self._remove_disk(key)
+
+    def stats(self) -> dict[str,int]:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+                "disk_entries": len(self.disk),
+                "disk_bytes": self.disk_bytes,
+            }
+
+    def _put_memory(self, key: str, entry: dict[str,bytes]):
+        size = sum(len(v) for v in entry.values())
+        if size > self.memory_max_bytes: return
+        if key in self.memory:
+            self.memory_bytes -= sum(len(v) for v in self.memory.pop(key).values())
+        self.memory[key] = entry
+        self.memory_bytes += size
+        while self.memory_bytes > self.memory_max_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= sum(len(v) for v in evicted.values())
+
+    def _disk_path(self, key: str) -> str:
+        return f"{self.cache_dir}/{key}"
+
+    def _load_disk_index(self):
+        entries = []
+        for f in os.scandir(self.cache_dir):
+            if not f.is_file() or f.name.endswith('.tmp'): continue
+            st = f.stat()
+            entries.append((st.st_mtime_ns, f.name, st.st_size))
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_bytes += size
+        with self.lock:
+            self._evict_disk()
+
+    def _read_disk(self, key: str) -> dict[str,bytes] | None:
+        try:
+            with open(self._disk_path(key),'rb') as f:
+                entry = decode_entry(f.read())
+            os.utime(self._disk_path(key))
+            return entry
+        except Exception as e:
+            LOGGER.warning(f"Couldn't read cached replay {key}: {e}")
+            with self.lock:
+                if key in self.disk: self._remove_disk(key)
+            return None
+
+    def _write_disk(self, key: str, entry: dict[str,bytes]):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600),'wb') as f:
+                f.write(encode_entry(entry))
+            os.replace(tmp_path, path)
+        except Exception as e:
+            LOGGER.warning(f"Couldn't store cached replay {key}: {e}")
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            return
+        with self.lock:
+            if key in self.disk: self.disk_bytes -= self.disk.pop(key)
+            self.disk[key] = os.path.getsize(path)
+            self.disk_bytes += self.disk[key]
+            self._evict_disk()
+
+    def _remove_disk(self, key: str):
+        self.disk_bytes -= self.disk.pop(key)
+        if os.path.exists(self._disk_path(key)): os.remove(self._disk_path(key))
+
+    def _evict_disk(self):
+        while self.disk_bytes > self.max_bytes and len(self.disk) > 0:
+            self._remove_disk(next(iter(self.disk)))
+
+
+###
+# Entry format
+
+def encode_entry(entry: dict[str,bytes]) -> bytes:
+    data = [ENTRY_MAGIC]
+    for k in CACHED_OUTPUTS:
+        data.append(struct.pack(ENTRY_LENGTH_FORMAT, len(entry[k])))
+        data.append(entry[k])
+    return b''.join(data)
+
+def decode_entry(data: bytes) -> dict[str,bytes]:
+    if not data.startswith(ENTRY_MAGIC):
+        raise Exception(f"invalid entry header")
+    entry = {}
+    offset = len(ENTRY_MAGIC)
+    for k in CACHED_OUTPUTS:
+        if offset + ENTRY_LENGTH_SIZE > len(data):
+            raise Exception(f"truncated entry")
+        size, = struct.unpack_from(ENTRY_LENGTH_FORMAT, data, offset)
+        offset += ENTRY_LENGTH_SIZE
+        if offset + size > len(data):
+            raise Exception(f"truncated entry")
+        entry[k] = data[offset:offset + size]
+        offset += size
+    if offset != len(data):
+        raise Exception(f"invalid entry size")
+    return entry
+
+
+###
+# Default cache
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_replay_cartridge_id(cartridge: bytes | str) -> str:
+    # cartridge can be raw bytes, a cartridge id or a path to a cartridge file
+    if isinstance(cartridge, (bytes, bytearray, memoryview)):
+        return generate_cartridge_id(cartridge)
+    if os.path.sep in cartridge or os.path.isfile(cartridge):
+        with open(cartridge,'rb') as f:
+            return generate_cartridge_id(f.read())
+    return cartridge
+
+def get_replay_cache() -> ReplayCache:
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            # without a configured path the cache is only kept in memory
+            _default_cache = ReplayCache(CoreSettings().replay_cache_path, CoreSettings().replay_cache_max_bytes,
+                                         CoreSettings().replay_cache_memory_bytes)
+        return _default_cache
+
+def cached_verify_log(cartridge: bytes | str, log: bytes,riv_args: str,in_card: bytes, entropy: str = None,
+                      frame: int =None,get_outhist=False,get_screenshot=False,verify_function=None) -> dict[str,bytes]:
+    return get_replay_cache().verify_log(cartridge,log,riv_args,in_card,entropy,frame,get_outhist,get_screenshot,verify_function)
+
+def cached_verify_many(jobs: list[dict], max_workers: int = 1) -> list[dict]:
+    return get_replay_cache().verify_many(jobs,max_workers)
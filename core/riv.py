@@ -1,168 +1,533 @@
 import subprocess
 import os
+import re
+import time
+import signal
 from pathlib import Path
 import tempfile
 import shutil
-
-from .core_settings import CoreSettings, get_cartridges_path, is_inside_cm
-
-def riv_get_cartridge_info(cartridge_filepath):
-    args = ["sqfscat","-st"]
-    args.append(cartridge_filepath)
-    args.append("/info.json")
-        
-    result = subprocess.run(args, capture_output=True, text=True)
-    if result.returncode > 0:
-        raise Exception(f"Error getting info: {str(result.stderr)}")
-
-    return result.stdout
-
-def riv_get_cover(cartridge_filepath):
-    args = ["sqfscat","-no-exit"]
-    args.append(cartridge_filepath)
-    args.append("/cover.png")
-        
-    result = subprocess.run(args, capture_output=True)
-    if result.returncode > 0:
-        raise Exception(f"Error getting cover: {str(result.stderr)}")
-
-    return result.stdout
-
-def riv_get_cartridge_riv_version(cartridge_filepath):
-    args = ["sqfscat","-st"]
-    args.append(cartridge_filepath)
-    args.append("/.riv")
-        
-    result = subprocess.run(args, capture_output=True, text=True)
-    if result.returncode > 0:
-        raise Exception(f"Error getting info: {str(result.stderr)}")
-
-    return result.stdout.strip()
-
-
-def verify_log(cartridge_data: bytes, log: bytes,riv_args: str,in_card: bytes, entropy: str = None,
-               frame: int =None,get_outhist=False,get_screenshot=False) -> dict[str,bytes]:
-    if is_inside_cm(): # use riv os
-        log_path = "/run/replaylog"
-        outcard_path = "/run/outcard"
-        incard_path = "/run/incard"
-        outhash_path = "/run/outhash"
-        screenshot_path = "/run/screenshot"
-        outhist_path = "/run/outhist"
-        rivos_cartridges_path = f"/{CoreSettings().cartridges_path}" # absolute cartridges path on rivos
-        # data_cartridge_path = f"{get_cartridges_path()}/{cartridge_id}" # absolute data full cartridge path
-        cartridge_path = f"/{CoreSettings().cartridges_path}/run_cartridge" #{cartridge_id}" # relative to rivos full cartridge path
-        rivos_cartridge_path = f"{rivos_cartridges_path}/run_cartridge" #{cartridge_id}" # absolute full cartridge path on rivos
-        
-        if not os.path.exists(rivos_cartridges_path):
-            os.makedirs(rivos_cartridges_path)
-
-        # shutil.copy2(data_cartridge_path, rivos_cartridge_path)
-
-        with open(rivos_cartridge_path,'wb') as cartridge_file:
-            cartridge_file.write(cartridge_data)
-
-        with open(log_path,'wb') as log_file:
-            log_file.write(log)
-
-        if os.path.exists(outcard_path): os.remove(outcard_path)
-        if os.path.exists(outhist_path): os.remove(outhist_path)
-        if os.path.exists(outhash_path): os.remove(outhash_path)
-        if os.path.exists(screenshot_path): os.remove(screenshot_path)
-
-        if in_card is not None and len(in_card) > 0:
-            incard_file = open(incard_path,'wb')
-            incard_file.write(in_card)
-            incard_file.close()
-
-        version = riv_get_cartridge_riv_version(rivos_cartridge_path)
-        result = subprocess.run(["sh","/usr/sbin/riv-mount",version])
-        if result.returncode != 0:
-            raise Exception(f"Error reading version: {str(result.stderr)}")
-
-        run_args = []
-        run_args.append("/rivos/usr/sbin/riv-chroot")
-        run_args.append("/rivos")
-        run_args.extend(["--setenv", "RIV_CARTRIDGE", cartridge_path])
-        run_args.extend(["--setenv", "RIV_REPLAYLOG", log_path])
-        run_args.extend(["--setenv", "RIV_OUTCARD", outcard_path])
-        if get_outhist:
-            run_args.extend(["--setenv", "RIV_OUTHIST", outhist_path])
-        run_args.extend(["--setenv", "RIV_OUTHASH", outhash_path])
-        if get_screenshot:
-            run_args.extend(["--setenv", "RIV_SAVE_SCREENSHOT", screenshot_path])
+from hashlib import sha256
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from cartesapp.utils import str2bytes, bytes2str
+
+from .core_settings import CoreSettings, is_inside_cm, generate_cartridge_id
+from .cartridge_stage import get_cartridge_stage
+from .blob_store import get_cartridge_blob_store
+from .sqfs import read_squashfs_files
+from .riv_stats import make_run_stats, get_emulator_stats
+
+LOGGER = logging.getLogger(__name__)
+
+CARTRIDGE_METADATA_FILES = {"info": "/info.json", "cover": "/cover.png", "riv_version": "/.riv"}
+CARTRIDGE_METADATA_CACHE_SIZE = 64
+
+_cartridge_metadata_cache = OrderedDict()
+_cartridge_metadata_lock = threading.Lock()
+
+def riv_get_cartridge_metadata(cartridge: bytes | str, cartridge_id: str | None = None) -> dict[str,bytes | None]:
+    # cartridge can be raw bytes or a path to a cartridge file, all metadata is read in a single pass
+    if cartridge_id is not None:
+        key = cartridge_id
+    elif isinstance(cartridge, (bytes, bytearray, memoryview)):
+        key = generate_cartridge_id(cartridge)
+    else:
+        st = os.stat(cartridge)
+        key = (os.path.abspath(cartridge), st.st_mtime_ns, st.st_size)
+
+    with _cartridge_metadata_lock:
+        metadata = _cartridge_metadata_cache.get(key)
+        if metadata is not None:
+            _cartridge_metadata_cache.move_to_end(key)
+            return metadata
+
+    try:
+        files = read_squashfs_files(cartridge, list(CARTRIDGE_METADATA_FILES.values()))
+    except Exception as e:
+        raise Exception(f"Error getting info: {e}")
+    metadata = dict((k,files[f]) for k,f in CARTRIDGE_METADATA_FILES.items())
+
+    with _cartridge_metadata_lock:
+        _cartridge_metadata_cache[key] = metadata
+        while len(_cartridge_metadata_cache) > CARTRIDGE_METADATA_CACHE_SIZE:
+            _cartridge_metadata_cache.popitem(last=False)
+    return metadata
+
+def riv_get_cartridge_info(cartridge: bytes | str, cartridge_id: str | None = None) -> str:
+    info = riv_get_cartridge_metadata(cartridge, cartridge_id)['info']
+    if info is None:
+        raise Exception(f"Error getting info: /info.json not found in cartridge")
+    return bytes2str(info)
+
+def riv_get_cover(cartridge: bytes | str, cartridge_id: str | None = None) -> bytes:
+    return riv_get_cartridge_metadata(cartridge, cartridge_id)['cover'] or b''
+
+def riv_get_cartridge_riv_version(cartridge: bytes | str, cartridge_id: str | None = None) -> str:
+    riv_version = riv_get_cartridge_metadata(cartridge, cartridge_id)['riv_version']
+    if riv_version is None:
+        raise Exception(f"Error getting info: /.riv not found in cartridge")
+    return bytes2str(riv_version).strip()
+
+
+def acquire_cartridge(cartridge: bytes | str) -> tuple[str | None, str]:
+    # cartridge can be raw bytes, a cartridge id or a path to a cartridge file
+    stage = get_cartridge_stage()
+    if isinstance(cartridge, (bytes, bytearray, memoryview)):
+        stage_key = generate_cartridge_id(cartridge)
+        return stage_key, stage.acquire(stage_key, cartridge_data=cartridge)
+    if os.path.sep in cartridge or os.path.isfile(cartridge):
+        if not is_inside_cm():
+            return None, os.path.abspath(cartridge)
+        # rivos only sees the cartridges in its tree
+        stage_key = f"path-{sha256(str2bytes(os.path.abspath(cartridge))).hexdigest()[:16]}"
+        return stage_key, stage.acquire(stage_key, source_path=cartridge)
+    store = get_cartridge_blob_store()
+    if not store.exists(cartridge):
+        raise Exception(f"Cartridge {cartridge} not found")
+    return cartridge, stage.acquire(cartridge, materialize=lambda path: store.materialize(cartridge, path))
+
+def release_cartridge(stage_key: str | None):
+    if stage_key is not None:
+        get_cartridge_stage().release(stage_key)
+
+@contextmanager
+def staged_cartridge(cartridge: bytes | str):
+    stage_key, cartridge_path = acquire_cartridge(cartridge)
+    try:
+        yield cartridge_path
+    finally:
+        release_cartridge(stage_key)
+
+def verify_log(cartridge: bytes | str, log: bytes,riv_args: str,in_card: bytes, entropy: str = None,
+               frame: int =None,get_outhist=False,get_screenshot=False,timeout: float | None = None,
+               rule_id: str | None = None, max_frames: int | None = None) -> dict[str,bytes]:
+    # timeout is only enforced outside the cartesi machine, where wall clock doesn't affect the rollup state.
+    # Logs running past max_frames raise RivemuFrameBudgetError. The run stats are recorded for the cartridge
+    # and, when given, the rule
+    stage_key, cartridge_path = acquire_cartridge(cartridge)
+    try:
+        emulator = resolve_cartridge_emulator(stage_key or cartridge_path,cartridge_path)
+        stop_frame = budget_stop_frame(frame,max_frames)
+        if is_inside_cm(): # use riv os
+            outputs = verify_log_rivos(cartridge_path,emulator['version'],log,riv_args,in_card,entropy,stop_frame,
+                                       get_outhist,get_screenshot)
         else:
-            run_args.extend(["--setenv", "RIV_NO_YIELD", "y"])
-        if in_card is not None and len(in_card) > 0:
-            run_args.extend(["--setenv", "RIV_INCARD", incard_path])
-        if frame is not None:
-            run_args.extend(["--setenv", "RIV_STOP_FRAME", f"{frame}"])
-        if entropy is not None:
-            run_args.extend(["--setenv", "RIV_ENTROPY", f"{entropy}"])
-        run_args.append("riv-run")
-        if riv_args is not None and len(riv_args) > 0:
-            run_args.extend(riv_args.split())
-        result = subprocess.run(run_args)
-        if result.returncode != 0:
-            os.remove(log_path)
-            os.remove(rivos_cartridge_path)
-            raise Exception(f"Error processing log: {str(result.stderr)}")
-
-        with open(outcard_path,'rb') as f:
-            outcard_raw = f.read()
-        os.remove(outcard_path)
-
-        with open(outhash_path,'r') as f:
-            outhash = bytes.fromhex(f.read())
-        os.remove(outhash_path)
-
-        screenshot = b''
-        if os.path.exists(screenshot_path):
-            with open(screenshot_path,'rb') as f: screenshot = f.read()
-            os.remove(screenshot_path)
-
-        outhist_raw = b''
-        if os.path.exists(outhist_path):
-            with open(outhist_path,'rb') as f: outhist_raw = f.read()
-            os.remove(outhist_path)
-
-        os.remove(log_path)
-        os.remove(rivos_cartridge_path)
+            outputs = verify_log_rivemu(cartridge_path,emulator['rivemu_path'],log,riv_args,in_card,entropy,stop_frame,
+                                        get_outhist,get_screenshot,timeout=timeout)
+        record_run_stats(outputs, stage_key or os.path.basename(cartridge_path), rule_id)
+        check_frame_budget(outputs,max_frames,frame)
+        return outputs
+    finally:
+        release_cartridge(stage_key)
+
+###
+# Run accounting
+
+FRAMES_PATTERN = re.compile(r"frame[^0-9\n]*(\d+)", re.IGNORECASE)
+
+class RivemuBudgetError(Exception):
+    pass
+
+class RivemuTimeoutError(RivemuBudgetError):
+    pass
+
+class RivemuFrameBudgetError(RivemuBudgetError):
+    pass
+
+def emulator_frames(stderr: str) -> int | None:
+    # the last frame count the emulator printed, the stop frame is only an upper bound
+    matches = FRAMES_PATTERN.findall(stderr)
+    return int(matches[-1]) if len(matches) > 0 else None
+
+def budget_stop_frame(frame: int | None, max_frames: int | None) -> int | None:
+    # logs over the budget run one frame past it, so they can be told from logs ending right at it
+    if max_frames is None: return frame
+    return max_frames + 1 if frame is None else min(frame, max_frames + 1)
+
+def check_frame_budget(outputs: dict, max_frames: int | None, frame: int | None = None):
+    # without a frame count from the emulator a run that may have reached the stop frame past the budget
+    # is taken as over it
+    if max_frames is None: return
+    frames = (outputs.get('stats') or {}).get('frames')
+    if frames is None: frames = budget_stop_frame(frame,max_frames)
+    if frames > max_frames:
+        raise RivemuFrameBudgetError(f"Error processing log: exceeded frame budget of {max_frames} frames")
+
+def _kill_process_group(proc: subprocess.Popen, fired: threading.Event):
+    fired.set()
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def run_emulator_process(run_args: list[str], pass_fds: list[int] = (),
+                         timeout: float | None = None) -> tuple[int,str,dict]:
+    # like subprocess.run, but reaps the child with wait4 to get its resource usage. With a timeout
+    # a watchdog kills the emulator process group and RivemuTimeoutError is raised
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(run_args, stderr=subprocess.PIPE, pass_fds=pass_fds, start_new_session=timeout is not None)
+    watchdog = None
+    fired = threading.Event()
+    if timeout is not None:
+        watchdog = threading.Timer(timeout, _kill_process_group, (proc, fired))
+        watchdog.start()
+    try:
+        stderr = proc.stderr.read().decode('utf-8', errors='replace')
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        proc.stderr.close()
+        if watchdog is not None: watchdog.cancel()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall_time = time.perf_counter() - t0
+
+    if fired.is_set() and proc.returncode == -signal.SIGKILL:
+        raise RivemuTimeoutError(f"Error processing log: exceeded time budget of {timeout}s")
+
+    stats = make_run_stats(wall_time, rusage, emulator_frames(stderr))
+    LOGGER.debug(f"Emulator run stats: {stats}")
+    return proc.returncode, stderr.strip(), stats
+
+def record_run_stats(outputs: dict, cartridge_id: str | None, rule_id: str | None = None):
+    if outputs is None: return
+    get_emulator_stats().record(outputs.get('stats'), cartridge_id, rule_id)
+
+###
+# Batch verification
+
+VERIFICATION_JOB_DEFAULTS = {
+    "riv_args": "",
+    "in_card": b'',
+    "entropy": None,
+    "frame": None,
+    "get_outhist": False,
+    "get_screenshot": False,
+    "timeout": None,
+    "rule_id": None,
+    "max_frames": None,
+}
+
+def verify_many(jobs: list[dict], max_workers: int = 1, verify_function=None) -> list[dict]:
+    """
+    Verifies a list of jobs (dicts with the verify_log arguments, plus an optional
+    cartridge_id to avoid hashing cartridge bytes and rule_id for the run stats). Jobs are grouped by cartridge and
+    riv version so each cartridge is staged and each version mounted once. Returns,
+    in input order, {"outputs": ..., "error": None} or {"outputs": None, "error": msg},
+    with budget_exceeded set when the job exceeded its time or frame budget
+    """
+    results = [None] * len(jobs)
+
+    groups = {}
+    for i,job in enumerate(jobs):
+        cartridge = job['cartridge']
+        if job.get('cartridge_id') is not None:
+            group_key = job['cartridge_id']
+        elif isinstance(cartridge, (bytes, bytearray, memoryview)):
+            group_key = generate_cartridge_id(cartridge)
+        else:
+            group_key = cartridge
+        groups.setdefault(group_key,[]).append(i)
+
+    staged = []
+    runs = []
+    try:
+        for group_key, indexes in groups.items():
+            try:
+                stage_key, cartridge_path = acquire_cartridge(jobs[indexes[0]]['cartridge'])
+                staged.append(stage_key)
+                emulator = resolve_cartridge_emulator(stage_key or cartridge_path,cartridge_path)
+            except Exception as e:
+                for i in indexes: results[i] = {"outputs": None, "error": str(e), "budget_exceeded": False}
+                continue
+            for i in indexes:
+                runs.append((emulator['version'],i,cartridge_path,emulator,stage_key or os.path.basename(cartridge_path)))
+        # consecutive runs of the same version share the mount
+        runs.sort(key=lambda r: (r[0],r[1]))
+
+        def run_job(run) -> tuple[int,dict]:
+            _, i, cartridge_path, emulator, stats_key = run
+            job = VERIFICATION_JOB_DEFAULTS | dict((k,v) for k,v in jobs[i].items() if k not in ('cartridge','cartridge_id'))
+            try:
+                if verify_function is not None:
+                    args = (job['log'],job['riv_args'],job['in_card'],job['entropy'],job['frame'],job['get_outhist'],
+                            job['get_screenshot'])
+                    outputs = verify_function(cartridge_path,*args,timeout=job['timeout'],rule_id=job['rule_id'],
+                                              max_frames=job['max_frames'])
+                else:
+                    args = (job['log'],job['riv_args'],job['in_card'],job['entropy'],
+                            budget_stop_frame(job['frame'],job['max_frames']),job['get_outhist'],job['get_screenshot'])
+                    if is_inside_cm():
+                        outputs = verify_log_rivos(cartridge_path,emulator['version'],*args)
+                    else:
+                        outputs = verify_log_rivemu(cartridge_path,emulator['rivemu_path'],*args,timeout=job['timeout'])
+                    record_run_stats(outputs, stats_key, job['rule_id'])
+                    check_frame_budget(outputs,job['max_frames'],job['frame'])
+                return i, {"outputs": outputs, "error": None, "budget_exceeded": False}
+            except Exception as e:
+                return i, {"outputs": None, "error": str(e), "budget_exceeded": isinstance(e, RivemuBudgetError)}
+
+        if is_inside_cm() or max_workers <= 1:
+            with riv_mount_session():
+                for run in runs:
+                    i, result = run_job(run)
+                    results[i] = result
+        else:
+            with ThreadPoolExecutor(max_workers) as executor:
+                for i, result in executor.map(run_job, runs):
+                    results[i] = result
+    finally:
+        for stage_key in staged:
+            release_cartridge(stage_key)
+
+    return results
+
+
+###
+# Riv os mount session
+
+class RivMountSession:
+    """
+    Keeps the riv os version mounted across consecutive verifications inside
+    the cartesi machine, remounting only when the version changes. Without an
+    open session each verification unmounts right away
+    """
+    mounted_version = None
+    depth = 0
+    lock = threading.RLock()
+
+    def __new__(cls):
+        return cls
+
+    @classmethod
+    def active(cls) -> bool:
+        return cls.depth > 0
+
+    @classmethod
+    def mount(cls, version: str):
+        with cls.lock:
+            if cls.mounted_version == version: return
+            if cls.mounted_version is not None: cls.unmount()
+            result = subprocess.run(["sh","/usr/sbin/riv-mount",version])
+            if result.returncode != 0:
+                raise Exception(f"Error reading version: {str(result.stderr)}")
+            cls.mounted_version = version
+
+    @classmethod
+    def unmount(cls):
+        with cls.lock:
+            if cls.mounted_version is None: return
+            cls.mounted_version = None
+            result = subprocess.run(["sh","/usr/sbin/riv-umount"])
+            if result.returncode != 0:
+                raise Exception(f"Error reading version: {str(result.stderr)}")
+
+    @classmethod
+    @contextmanager
+    def session(cls):
+        with cls.lock:
+            cls.depth += 1
+        try:
+            yield cls
+        finally:
+            with cls.lock:
+                cls.depth -= 1
+                if cls.depth == 0: cls.unmount()
+
+def riv_mount_session():
+    return RivMountSession.session()
+
+RIVOS_RUN_PATHS = {
+    "log": "/run/replaylog",
+    "outcard": "/run/outcard",
+    "incard": "/run/incard",
+    "outhash": "/run/outhash",
+    "screenshot": "/run/screenshot",
+    "outhist": "/run/outhist",
+}
+
+def verify_log_rivos(cartridge_path: str, version: str, log: bytes,riv_args: str,in_card: bytes, entropy: str = None,
+                     frame: int =None,get_outhist=False,get_screenshot=False) -> dict[str,bytes]:
+    run_paths = RIVOS_RUN_PATHS | {"cartridge": cartridge_path}
+
+    with open(run_paths['log'],'wb') as log_file:
+        log_file.write(log)
+
+    if os.path.exists(run_paths['outcard']): os.remove(run_paths['outcard'])
+    if os.path.exists(run_paths['outhist']): os.remove(run_paths['outhist'])
+    if os.path.exists(run_paths['outhash']): os.remove(run_paths['outhash'])
+    if os.path.exists(run_paths['screenshot']): os.remove(run_paths['screenshot'])
 
-        result = subprocess.run(["sh","/usr/sbin/riv-umount"])
-        if result.returncode != 0:
-            raise Exception(f"Error reading version: {str(result.stderr)}")
-
-        return {"outhist":outhist_raw, "outhash":outhash,"screenshot":screenshot,"outcard":outcard_raw}
-
-    # use rivemu
-    cartridge_temp = tempfile.NamedTemporaryFile()
-    cartridge_file = cartridge_temp.file
-    log_temp = tempfile.NamedTemporaryFile()
-    log_file = log_temp.file
-    incard_temp = tempfile.NamedTemporaryFile()
-    incard_file = incard_temp.file
-    outcard_temp = tempfile.NamedTemporaryFile()
-    outhist_temp = tempfile.NamedTemporaryFile()
-    outhash_temp = tempfile.NamedTemporaryFile(mode='w+')
-    screenshot_temp = tempfile.NamedTemporaryFile()
-
-    cartridge_file.write(cartridge_data)
-    cartridge_file.flush()
-
-    log_file.write(log)
-    log_file.flush()
-    
     if in_card is not None and len(in_card) > 0:
+        incard_file = open(run_paths['incard'],'wb')
         incard_file.write(in_card)
-        incard_file.flush()
+        incard_file.close()
 
-    incard_path = len(in_card) > 0 and incard_temp.name or None
+    RivMountSession.mount(version)
+    try:
+        return run_rivos(run_paths,riv_args,in_card,entropy,frame,get_outhist,get_screenshot)
+    finally:
+        if not RivMountSession.active():
+            RivMountSession.unmount()
+
+def run_rivos(run_paths: dict[str,str], riv_args: str,in_card: bytes, entropy: str = None,
+              frame: int =None,get_outhist=False,get_screenshot=False) -> dict[str,bytes]:
+    run_args = []
+    run_args.append("/rivos/usr/sbin/riv-chroot")
+    run_args.append("/rivos")
+    run_args.extend(["--setenv", "RIV_CARTRIDGE", run_paths['cartridge']])
+    run_args.extend(["--setenv", "RIV_REPLAYLOG", run_paths['log']])
+    run_args.extend(["--setenv", "RIV_OUTCARD", run_paths['outcard']])
+    if get_outhist:
+        run_args.extend(["--setenv", "RIV_OUTHIST", run_paths['outhist']])
+    run_args.extend(["--setenv", "RIV_OUTHASH", run_paths['outhash']])
+    if get_screenshot:
+        run_args.extend(["--setenv", "RIV_SAVE_SCREENSHOT", run_paths['screenshot']])
+    else:
+        run_args.extend(["--setenv", "RIV_NO_YIELD", "y"])
+    if in_card is not None and len(in_card) > 0:
+        run_args.extend(["--setenv", "RIV_INCARD", run_paths['incard']])
+    if frame is not None:
+        run_args.extend(["--setenv", "RIV_STOP_FRAME", f"{frame}"])
+    if entropy is not None:
+        run_args.extend(["--setenv", "RIV_ENTROPY", f"{entropy}"])
+    run_args.append("riv-run")
+    if riv_args is not None and len(riv_args) > 0:
+        run_args.extend(riv_args.split())
+    returncode, stderr, stats = run_emulator_process(run_args)
+    if returncode != 0:
+        os.remove(run_paths['log'])
+        raise Exception(f"Error processing log: {stderr}")
+
+    outputs = rivemu_read_outputs(run_paths)
+    outputs['stats'] = stats
+
+    for f in ['outcard','outhash','screenshot','outhist','log']:
+        if os.path.exists(run_paths[f]): os.remove(run_paths[f])
+
+    return outputs
+
+###
+# Rivemu run files
+
+RIVEMU_RUN_FILES = ["log","incard","outcard","outhash","outhist","screenshot"]
+RIVEMU_OUTPUT_FILES = ["outcard","outhash","outhist","screenshot"]
+
+# None: not tried yet, True: emulator accepted fd paths, False: fall back to temp files
+_memfd_io_state = None
+
+class RivemuRunFiles:
+    """
+    Scratch files of a rivemu run. With memfd they live in anonymous memory and
+    are handed to the emulator as /dev/fd paths, otherwise in a temp dir
+    """
+    memfd = False
+    paths = None
+    fds = None
+    tmp_dir = None
+
+    def __init__(self, memfd: bool):
+        self.memfd = memfd
+        self.fds = {}
+        if memfd:
+            for f in RIVEMU_RUN_FILES:
+                self.fds[f] = os.memfd_create(f"rivemu-{f}")
+            self.paths = dict((f,f"/dev/fd/{fd}") for f,fd in self.fds.items())
+        else:
+            self.tmp_dir = tempfile.mkdtemp(prefix="rivemu-")
+            self.paths = dict((f,f"{self.tmp_dir}/{f}") for f in RIVEMU_RUN_FILES)
 
-    absolute_cartridge_path = cartridge_temp.name # os.path.abspath(f"{get_cartridges_path()}/{cartridge_id}")
+    def pass_fds(self) -> list[int]:
+        return list(self.fds.values())
 
-    version = riv_get_cartridge_riv_version(absolute_cartridge_path)
-    
+    def write(self, name: str, data: bytes):
+        if self.memfd:
+            os.ftruncate(self.fds[name], 0)
+            os.pwrite(self.fds[name], data, 0)
+        else:
+            with open(self.paths[name],'wb') as f: f.write(data)
+
+    def reset_outputs(self):
+        for f in RIVEMU_OUTPUT_FILES:
+            if self.memfd:
+                os.ftruncate(self.fds[f], 0)
+            elif os.path.exists(self.paths[f]):
+                os.remove(self.paths[f])
+
+    def close(self):
+        for fd in self.fds.values(): os.close(fd)
+        self.fds = {}
+        if self.tmp_dir is not None: shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+def use_memfd_io() -> bool:
+    return CoreSettings().rivemu_io_mode == 'memfd' and hasattr(os, 'memfd_create') and _memfd_io_state is not False
+
+def memfd_io_checked() -> bool:
+    return _memfd_io_state is not None
+
+def set_memfd_io_state(accepted: bool):
+    global _memfd_io_state
+    _memfd_io_state = accepted
+
+def get_run_files(run_files: dict[bool,RivemuRunFiles], memfd: bool) -> RivemuRunFiles:
+    if run_files.get(memfd) is None:
+        run_files[memfd] = RivemuRunFiles(memfd)
+    return run_files[memfd]
+
+def prepare_rivemu_run(rivemu_path: str, cartridge_path: str, run_files: RivemuRunFiles, log: bytes,riv_args: str,
+                       in_card: bytes, entropy: str = None, frame: int =None,get_outhist=False,
+                       get_screenshot=False) -> tuple[list[str],dict[str,str]]:
+    run_files.reset_outputs()
+    run_files.write('log', log)
+    run_paths = run_files.paths | {"cartridge": cartridge_path}
+    if in_card is not None and len(in_card) > 0:
+        run_files.write('incard', in_card)
+    else:
+        run_paths['incard'] = None
+
+    return rivemu_run_args(rivemu_path,run_paths,riv_args,entropy,frame,get_outhist,get_screenshot), run_paths
+
+def run_rivemu(rivemu_path: str, cartridge_path: str, run_files: RivemuRunFiles, log: bytes,riv_args: str,
+               in_card: bytes, entropy: str = None, frame: int =None,get_outhist=False,get_screenshot=False,
+               timeout: float | None = None) -> dict[str,bytes]:
+    run_args, run_paths = prepare_rivemu_run(rivemu_path,cartridge_path,run_files,log,riv_args,in_card,entropy,frame,
+                                             get_outhist,get_screenshot)
+    returncode, stderr, stats = run_emulator_process(run_args, run_files.pass_fds(), timeout)
+    if returncode != 0:
+        raise Exception(f"Error processing log: {stderr}")
+
+    return rivemu_read_outputs(run_paths) | {"stats": stats}
+
+def verify_log_rivemu(cartridge_path: str, rivemu_path: str, log: bytes,riv_args: str,in_card: bytes, entropy: str = None,
+                      frame: int =None,get_outhist=False,get_screenshot=False,timeout: float | None = None) -> dict[str,bytes]:
+    run_files = {}
+    try:
+        memfd = use_memfd_io()
+        try:
+            outputs = run_rivemu(rivemu_path,cartridge_path,get_run_files(run_files,memfd),log,riv_args,in_card,
+                                 entropy,frame,get_outhist,get_screenshot,timeout)
+        except RivemuTimeoutError:
+            raise
+        except Exception as e:
+            if not memfd or memfd_io_checked(): raise
+            # first memfd run failed, check if the emulator runs with temp files
+            outputs = run_rivemu(rivemu_path,cartridge_path,get_run_files(run_files,False),log,riv_args,in_card,
+                                 entropy,frame,get_outhist,get_screenshot,timeout)
+            LOGGER.warning(f"Emulator rejected fd paths ({e}), using temp files")
+            set_memfd_io_state(False)
+            return outputs
+        if memfd: set_memfd_io_state(True)
+        return outputs
+    finally:
+        for f in run_files.values(): f.close()
+
+def get_rivemu_path(version: str) -> str:
     rivemu_path = f"{CoreSettings().rivemu_path}-{version}"
     if not os.path.isabs(rivemu_path):
         rivemu_path = f"{os.getcwd()}/{rivemu_path}"
@@ -170,53 +535,118 @@ def verify_log(cartridge_data: bytes, log: bytes,riv_args: str,in_card: bytes, e
         rivemu_path = CoreSettings().rivemu_path
         if not os.path.isabs(rivemu_path):
             rivemu_path = f"{os.getcwd()}/{rivemu_path}"
+    return rivemu_path
+
+
+###
+# Emulator resolution
+
+_emulator_resolutions = {}
+_emulator_resolutions_lock = threading.Lock()
+
+def _file_signature(path: str) -> tuple | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def _file_hash(path: str) -> str | None:
+    h = sha256()
+    try:
+        with open(path,'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''): h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+def _emulator_signature(version: str, rivemu_path: str | None) -> tuple | None:
+    # a versioned binary showing up also changes the resolution of the fallback
+    if rivemu_path is None: return None
+    versioned_path = f"{CoreSettings().rivemu_path}-{version}"
+    if not os.path.isabs(versioned_path):
+        versioned_path = f"{os.getcwd()}/{versioned_path}"
+    if versioned_path == rivemu_path:
+        return (_file_signature(rivemu_path),)
+    return (_file_signature(rivemu_path), _file_signature(versioned_path))
+
+def resolve_cartridge_emulator(cartridge_key: str, cartridge_path: str) -> dict[str,str | None]:
+    # riv version and absolute emulator path (None inside the cartesi machine) of a cartridge
+    with _emulator_resolutions_lock:
+        resolution = _emulator_resolutions.get(cartridge_key)
+    if resolution is not None and \
+            _emulator_signature(resolution['version'],resolution['rivemu_path']) == resolution['signature']:
+        return resolution
+
+    version = riv_get_cartridge_riv_version(cartridge_path)
+    rivemu_path = None if is_inside_cm() else get_rivemu_path(version)
+    resolution = {
+        "version": version,
+        "rivemu_path": rivemu_path,
+        "rivemu_hash": _file_hash(rivemu_path) if rivemu_path is not None else None,
+        "signature": _emulator_signature(version,rivemu_path),
+    }
+    with _emulator_resolutions_lock:
+        _emulator_resolutions[cartridge_key] = resolution
+    return resolution
+
+def cartridge_emulator_key(cartridge: bytes | str) -> str:
+    # riv version and emulator binary of a cartridge, replays of the same inputs only match with both
+    stage_key, cartridge_path = acquire_cartridge(cartridge)
+    try:
+        emulator = resolve_cartridge_emulator(stage_key or cartridge_path,cartridge_path)
+    finally:
+        release_cartridge(stage_key)
+    return f"{emulator['version']}:{emulator['rivemu_hash'] or 'rivos'}"
+
+def invalidate_emulator_resolutions(cartridge_key: str | None = None):
+    with _emulator_resolutions_lock:
+        if cartridge_key is None:
+            _emulator_resolutions.clear()
+        else:
+            _emulator_resolutions.pop(cartridge_key, None)
 
+def rivemu_run_args(rivemu_path: str, run_paths: dict[str,str], riv_args: str, entropy: str = None,
+                    frame: int = None, get_outhist=False, get_screenshot=False) -> list[str]:
     run_args = []
     run_args.append(rivemu_path)
-    run_args.append(f"-cartridge={absolute_cartridge_path}")
-    run_args.append(f"-verify={log_temp.name}")
+    run_args.append(f"-cartridge={run_paths['cartridge']}")
+    run_args.append(f"-verify={run_paths['log']}")
     run_args.append(f"-quiet")
-    run_args.append(f"-save-outcard={outcard_temp.name}")
-    run_args.append(f"-save-outhash={outhash_temp.name}")
+    run_args.append(f"-save-outcard={run_paths['outcard']}")
+    run_args.append(f"-save-outhash={run_paths['outhash']}")
     if get_outhist:
-        run_args.append(f"-save-outhist={outhist_temp.name}")
+        run_args.append(f"-save-outhist={run_paths['outhist']}")
     run_args.append(f"-no-window")
     if get_screenshot:
-        run_args.append(f"-save-screenshot={screenshot_temp.name}")
+        run_args.append(f"-save-screenshot={run_paths['screenshot']}")
     else:
         run_args.append(f"-no-yield")
     run_args.append(f"-no-audio")
-    if in_card is not None and len(in_card):
-        run_args.append(f"-load-incard={incard_temp.name}")
+    if run_paths.get('incard') is not None:
+        run_args.append(f"-load-incard={run_paths['incard']}")
     if frame is not None:
         run_args.append(f"-stop-frame={frame}")
     if entropy is not None:
         run_args.append(f"-entropy={entropy}")
     if riv_args is not None and len(riv_args) > 0:
         run_args.append(f"-args={riv_args}")
+    return run_args
+
+def rivemu_read_outputs(run_paths: dict[str,str]) -> dict[str,bytes]:
+    with open(run_paths['outcard'],'rb') as f:
+        outcard_raw = f.read()
 
-    result = subprocess.run(run_args)
-    if result.returncode != 0:
-        log_temp.close()
-        outcard_temp.close()
-        incard_temp.close()
-        outhash_temp.close()
-        outhist_temp.close()
-        screenshot_temp.close()
-        raise Exception(f"Error processing log: {str(result.stderr)}")
-
-    outcard_raw = outcard_temp.file.read()
-    outhash = bytes.fromhex(outhash_temp.file.read())
-    screenshot = screenshot_temp.file.read()
-    outhist_raw = outhist_temp.file.read()
-
-    cartridge_temp.close()
-    log_temp.close()
-    outcard_temp.close()
-    incard_temp.close()
-    outhash_temp.close()
-    outhist_temp.close()
-    screenshot_temp.close()
+    with open(run_paths['outhash'],'r') as f:
+        outhash = bytes.fromhex(f.read())
+
+    screenshot = b''
+    if os.path.exists(run_paths['screenshot']):
+        with open(run_paths['screenshot'],'rb') as f: screenshot = f.read()
+
+    outhist_raw = b''
+    if os.path.exists(run_paths['outhist']):
+        with open(run_paths['outhist'],'rb') as f: outhist_raw = f.read()
 
     return {"outhist":outhist_raw, "outhash":outhash,"screenshot":screenshot,"outcard":outcard_raw}
 
@@ -244,3 +674,6 @@ def install_riv_version(rivos_data: bytes):
 
         rivos_sqfs_temp.close()
         shutil.rmtree(rivos_version_path)
+
+    # cartridges may now resolve to the new version
+    invalidate_emulator_resolutions()
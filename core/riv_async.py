@@ -0,0 +1,100 @@
+import os
+import time
+import asyncio
+import logging
+
+from .core_settings import is_inside_cm
+from .riv import verify_log, acquire_cartridge, release_cartridge, resolve_cartridge_emulator, use_memfd_io, \
+    memfd_io_checked, set_memfd_io_state, get_run_files, prepare_rivemu_run, rivemu_read_outputs, RivemuRunFiles, \
+    record_run_stats, emulator_frames, budget_stop_frame, check_frame_budget, RivemuTimeoutError
+from .riv_stats import make_run_stats
+
+LOGGER = logging.getLogger(__name__)
+
+###
+# Async verification
+
+async def _kill(proc: asyncio.subprocess.Process):
+    if proc.returncode is None:
+        proc.kill()
+        await proc.wait()
+
+async def run_rivemu_async(rivemu_path: str, cartridge_path: str, run_files: RivemuRunFiles, log: bytes,riv_args: str,
+                           in_card: bytes, entropy: str = None, frame: int =None,get_outhist=False,get_screenshot=False,
+                           timeout: float | None = None) -> dict[str,bytes]:
+    run_args, run_paths = prepare_rivemu_run(rivemu_path,cartridge_path,run_files,log,riv_args,in_card,entropy,frame,
+                                             get_outhist,get_screenshot)
+    t0 = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(*run_args, pass_fds=run_files.pass_fds(), stderr=asyncio.subprocess.PIPE)
+    try:
+        _, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        await _kill(proc)
+        raise RivemuTimeoutError(f"Error processing log: exceeded time budget of {timeout}s")
+    except asyncio.CancelledError:
+        await _kill(proc)
+        raise
+    stderr = stderr.decode('utf-8', errors='replace')
+    if proc.returncode != 0:
+        raise Exception(f"Error processing log: {stderr.strip()}")
+
+    # the event loop reaps the child, so only wall time and frames are available here
+    return rivemu_read_outputs(run_paths) | {"stats": make_run_stats(time.perf_counter() - t0, None, emulator_frames(stderr))}
+
+async def verify_log_async(cartridge: bytes | str, log: bytes,riv_args: str,in_card: bytes, entropy: str = None,
+                           frame: int =None,get_outhist=False,get_screenshot=False,
+                           timeout: float | None = None, rule_id: str | None = None,
+                           max_frames: int | None = None) -> dict[str,bytes]:
+    if is_inside_cm():
+        # rollup inputs are processed one at a time
+        return verify_log(cartridge,log,riv_args,in_card,entropy,frame,get_outhist,get_screenshot,rule_id=rule_id,
+                          max_frames=max_frames)
+
+    stage_key, cartridge_path = acquire_cartridge(cartridge)
+    run_files = {}
+    try:
+        emulator = resolve_cartridge_emulator(stage_key or cartridge_path,cartridge_path)
+        stop_frame = budget_stop_frame(frame,max_frames)
+        memfd = use_memfd_io()
+        try:
+            outputs = await run_rivemu_async(emulator['rivemu_path'],cartridge_path,get_run_files(run_files,memfd),log,
+                                             riv_args,in_card,entropy,stop_frame,get_outhist,get_screenshot,timeout)
+            if memfd: set_memfd_io_state(True)
+        except RivemuTimeoutError:
+            raise
+        except Exception as e:
+            if not memfd or memfd_io_checked(): raise
+            # first memfd run failed, check if the emulator runs with temp files
+            outputs = await run_rivemu_async(emulator['rivemu_path'],cartridge_path,get_run_files(run_files,False),log,
+                                             riv_args,in_card,entropy,stop_frame,get_outhist,get_screenshot,timeout)
+            LOGGER.warning(f"Emulator rejected fd paths ({e}), using temp files")
+            set_memfd_io_state(False)
+        record_run_stats(outputs, stage_key or os.path.basename(cartridge_path), rule_id)
+        check_frame_budget(outputs,max_frames,frame)
+        return outputs
+    finally:
+        for f in run_files.values(): f.close()
+        release_cartridge(stage_key)
+
+
+###
+# Executor
+
+class AsyncVerifier:
+    """Runs verify_log_async with at most max_concurrency emulators at a time"""
+    semaphore = None
+    timeout = None
+
+    def __init__(self, max_concurrency: int = 4, timeout: float | None = None):
+        if max_concurrency < 1:
+            raise Exception(f"Async verifier needs a concurrency of at least one")
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.timeout = timeout
+
+    async def verify_log(self, cartridge: bytes | str, log: bytes,riv_args: str,in_card: bytes, entropy: str = None,
+                         frame: int =None,get_outhist=False,get_screenshot=False,
+                         timeout: float | None = None, rule_id: str | None = None,
+                         max_frames: int | None = None) -> dict[str,bytes]:
+        async with self.semaphore:
+            return await verify_log_async(cartridge,log,riv_args,in_card,entropy,frame,get_outhist,get_screenshot,
+                                          timeout if timeout is not None else self.timeout,rule_id,max_frames)
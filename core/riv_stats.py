@@ -0,0 +1,82 @@
+import threading
+import logging
+from collections import OrderedDict, deque
+
+LOGGER = logging.getLogger(__name__)
+
+STATS_METRICS = ["wall_time","user_time","sys_time","max_rss_kb","frames"]
+STATS_PERCENTILES = [50,95,99]
+
+
+###
+# Run stats
+
+def make_run_stats(wall_time: float, rusage = None, frames: int | None = None) -> dict:
+    return {
+        "wall_time": wall_time,
+        "user_time": rusage.ru_utime if rusage is not None else None,
+        "sys_time": rusage.ru_stime if rusage is not None else None,
+        "max_rss_kb": rusage.ru_maxrss if rusage is not None else None,
+        "frames": frames,
+    }
+
+def percentile(sorted_values: list, p: int):
+    # nearest rank
+    if len(sorted_values) == 0: return None
+    rank = max(1, -(-p * len(sorted_values) // 100))
+    return sorted_values[rank - 1]
+
+
+###
+# Rolling store
+
+class EmulatorStats:
+    """Last window runs of each cartridge and rule, at most max_keys of each kept"""
+    window = None
+    max_keys = None
+
+    def __init__(self, window: int = 1000, max_keys: int = 1024):
+        self.window = window
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.runs = {"cartridge": OrderedDict(), "rule": OrderedDict()}
+
+    def record(self, stats: dict | None, cartridge_id: str | None = None, rule_id: str | None = None):
+        if stats is None: return
+        with self.lock:
+            for kind, key in (("cartridge",cartridge_id),("rule",rule_id)):
+                if key is None: continue
+                runs = self.runs[kind]
+                if key not in runs:
+                    runs[key] = deque(maxlen=self.window)
+                    while len(runs) > self.max_keys: runs.popitem(last=False)
+                runs.move_to_end(key)
+                runs[key].append(stats)
+
+    def percentiles(self, kind: str, key: str) -> dict | None:
+        with self.lock:
+            runs = list(self.runs[kind].get(key) or [])
+        if len(runs) == 0: return None
+        report = {"runs": len(runs)}
+        for metric in STATS_METRICS:
+            values = sorted(r[metric] for r in runs if r.get(metric) is not None)
+            if len(values) == 0: continue
+            report[metric] = dict((f"p{p}",percentile(values,p)) for p in STATS_PERCENTILES)
+        return report
+
+    def report(self, kind: str = "cartridge") -> dict[str,dict]:
+        with self.lock:
+            keys = list(self.runs[kind].keys())
+        return dict((key,self.percentiles(kind,key)) for key in keys)
+
+    def log_report(self, kind: str = "cartridge"):
+        for key, report in self.report(kind).items():
+            if report is None or report.get('wall_time') is None: continue
+            LOGGER.info(f"Emulator cost for {kind} {key} ({report['runs']} runs): wall time " +
+                        ", ".join(f"{p}={v:.3f}s" for p,v in report['wall_time'].items()))
+
+
+_default_stats = EmulatorStats()
+
+def get_emulator_stats() -> EmulatorStats:
+    return _default_stats
@@ -0,0 +1,176 @@
+import json
+import threading
+import logging
+from collections import OrderedDict
+from typing import List
+
+from py_expression_eval import Parser
+from py_expression_eval import TNUMBER, TOP1, TOP2, TVAR
+
+LOGGER = logging.getLogger(__name__)
+
+SCORE_FUNCTION_CACHE_SIZE = 256
+
+# largest magnitude kept exact by int64 columns and by floats holding integers
+MAX_EXACT_INT = 2**62
+MAX_EXACT_FLOAT_INT = 2**53
+
+
+###
+# Compiled score functions
+
+class ScoreFunction:
+    """Score expression parsed once, evaluated for a single outcard or a batch of outcards"""
+    text = None
+    expression = None
+    vectorizable = None
+    variables = None
+
+    def __init__(self, text: str):
+        self.text = text
+        self.expression = Parser().parse(text)
+        # arithmetic over variables and numbers can be evaluated on numeric columns
+        self.vectorizable = all(
+            t.type_ in (TNUMBER, TVAR) or
+            (t.type_ == TOP1 and t.index_ == '-') or
+            (t.type_ == TOP2 and t.index_ in ('+','-','*','/','%','^','**'))
+            for t in self.expression.tokens)
+        self.variables = sorted(set(t.index_ for t in self.expression.tokens if t.type_ == TVAR))
+        if len(self.variables) == 0: self.vectorizable = False
+
+    def evaluate(self, values: dict):
+        return self.expression.evaluate(values)
+
+    def evaluate_many(self, values_list: List[dict]) -> List:
+        # same results as evaluate on each item, None where it fails
+        scores = [None] * len(values_list)
+        pending = list(range(len(values_list)))
+        if self.vectorizable:
+            # rows are grouped by the types of their variables, ints and floats don't mix in python
+            groups = {}
+            for i, values in enumerate(values_list):
+                if not isinstance(values, dict): continue
+                kinds = tuple(type(values.get(name)) for name in self.variables)
+                if all(kind in (int, float) for kind in kinds):
+                    groups.setdefault(kinds,[]).append(i)
+            vectorized = set()
+            for group in groups.values():
+                if len(group) < 2: continue
+                try:
+                    group_scores = self._evaluate_columns([values_list[i] for i in group])
+                except ImportError:
+                    break
+                if group_scores is None: continue
+                for i, score in zip(group, group_scores): scores[i] = score
+                vectorized.update(group)
+            pending = [i for i in pending if i not in vectorized]
+        for i in pending:
+            try:
+                scores[i] = self.evaluate(values_list[i])
+            except Exception:
+                scores[i] = None
+        return scores
+
+    def _evaluate_columns(self, values_list: List[dict]) -> List | None:
+        # values have entries of the same numeric type for each variable. Returns None when the batch
+        # can't be evaluated exactly as the scalar evaluator would
+        import numpy as np
+
+        columns = {}
+        stack = []
+        for t in self.expression.tokens:
+            if t.type_ == TNUMBER:
+                if type(t.number_) not in (int, float): return None
+                stack.append(t.number_)
+            elif t.type_ == TVAR:
+                if t.index_ not in columns:
+                    column = [values[t.index_] for values in values_list]
+                    if all(type(v) is int for v in column):
+                        if max(abs(v) for v in column) >= MAX_EXACT_INT: return None
+                        columns[t.index_] = np.array(column, dtype=np.int64)
+                    else:
+                        columns[t.index_] = np.array(column, dtype=np.float64)
+                stack.append(columns[t.index_])
+            elif t.type_ == TOP1:
+                stack.append(-stack.pop())
+            else:
+                b = stack.pop()
+                a = stack.pop()
+                result = self._apply(np, t.index_, a, b)
+                if result is None: return None
+                stack.append(result)
+        if len(stack) != 1: return None
+
+        return stack[0].tolist()
+
+    @staticmethod
+    def _apply(np, op: str, a, b):
+        is_int = lambda x: np.issubdtype(x.dtype, np.integer) if isinstance(x, np.ndarray) else type(x) is int
+        values = lambda x: x if isinstance(x, np.ndarray) else np.array([x])
+        max_abs = lambda x: int(np.abs(values(x)).max()) if is_int(x) else float(np.abs(values(x)).max())
+        both_int = is_int(a) and is_int(b)
+
+        if op in ('/','%') and np.any(values(b) == 0):
+            return None # python raises ZeroDivisionError
+
+        if op in ('^','**'):
+            if both_int:
+                if np.any(values(b) < 0): return None
+                # exponents are small or the result doesn't fit
+                if max_abs(a) > 1 and (max_abs(b) > 64 or max_abs(a) ** max_abs(b) >= MAX_EXACT_INT): return None
+                result = np.power(a, b)
+            else:
+                return None # numpy float powers may differ from python in the last bit
+        elif both_int and op in ('+','-','*'):
+            bound = max_abs(a) * max_abs(b) if op == '*' else max_abs(a) + max_abs(b)
+            if bound >= MAX_EXACT_INT: return None
+            result = {'+': np.add, '-': np.subtract, '*': np.multiply}[op](a, b)
+        elif op == '/':
+            if both_int and max(max_abs(a), max_abs(b)) >= MAX_EXACT_FLOAT_INT:
+                return None # python divides big ints exactly
+            result = np.true_divide(np.asarray(a, dtype=np.float64), b)
+        elif op == '%':
+            result = np.remainder(a, b)
+        else:
+            if (is_int(a) and max_abs(a) >= MAX_EXACT_FLOAT_INT) or (is_int(b) and max_abs(b) >= MAX_EXACT_FLOAT_INT):
+                return None
+            result = {'+': np.add, '-': np.subtract, '*': np.multiply}[op](a, b)
+
+        if not is_int(result) and not np.all(np.isfinite(values(result))):
+            return None # python raises OverflowError
+        return result
+
+_score_function_cache = OrderedDict()
+_score_function_lock = threading.Lock()
+
+def get_score_function(text: str) -> ScoreFunction:
+    with _score_function_lock:
+        score_function = _score_function_cache.get(text)
+        if score_function is not None:
+            _score_function_cache.move_to_end(text)
+            return score_function
+
+    score_function = ScoreFunction(text)
+
+    with _score_function_lock:
+        _score_function_cache[text] = score_function
+        while len(_score_function_cache) > SCORE_FUNCTION_CACHE_SIZE:
+            _score_function_cache.popitem(last=False)
+    return score_function
+
+def evaluate_score(score_function: str, outcard_json: dict):
+    return get_score_function(score_function).evaluate(outcard_json)
+
+def evaluate_scores(score_function: str, outcards_json: List[dict]) -> List:
+    return get_score_function(score_function).evaluate_many(outcards_json)
+
+def decode_outcard_json(outcard_raw: bytes) -> dict | None:
+    if outcard_raw is None or outcard_raw[:4] != b"JSON": return None
+    try:
+        return json.loads(outcard_raw[4:])
+    except Exception:
+        return None
+
+def score_outcards(score_function: str, outcards_raw: List[bytes]) -> List:
+    # scores of stored outcards, None for outcards that aren't json or can't be scored
+    return evaluate_scores(score_function, [decode_outcard_json(outcard_raw) for outcard_raw in outcards_raw])
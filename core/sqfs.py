@@ -0,0 +1,207 @@
+import os
+import mmap
+import struct
+import zlib
+import lzma
+
+###
+# SquashFS 4.0 reader (read only, regular files and directories)
+
+SQUASHFS_MAGIC = 0x73717368
+SUPERBLOCK_FORMAT = '<IIIIIHHHHHHQQQQQQQQ'
+SUPERBLOCK_SIZE = struct.calcsize(SUPERBLOCK_FORMAT)
+METADATA_BLOCK_SIZE = 8192
+METADATA_UNCOMPRESSED = 0x8000
+DATA_UNCOMPRESSED = 1 << 24
+NO_FRAGMENT = 0xFFFFFFFF
+
+BASIC_DIRECTORY = 1
+BASIC_FILE = 2
+EXTENDED_DIRECTORY = 8
+EXTENDED_FILE = 9
+
+ZLIB_COMPRESSION = 1
+LZMA_COMPRESSION = 2
+LZO_COMPRESSION = 3
+XZ_COMPRESSION = 4
+LZ4_COMPRESSION = 5
+ZSTD_COMPRESSION = 6
+
+class SquashFsError(Exception):
+    pass
+
+def _lz4_decompress(data: bytes, size: int) -> bytes:
+    import lz4.block
+    return lz4.block.decompress(data, uncompressed_size=size)
+
+def _zstd_decompress(data: bytes, size: int) -> bytes:
+    import zstandard
+    return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+
+DECOMPRESSORS = {
+    ZLIB_COMPRESSION: lambda data, size: zlib.decompress(data),
+    LZMA_COMPRESSION: lambda data, size: lzma.decompress(data, format=lzma.FORMAT_ALONE),
+    XZ_COMPRESSION: lambda data, size: lzma.decompress(data, format=lzma.FORMAT_XZ),
+    LZ4_COMPRESSION: _lz4_decompress,
+    ZSTD_COMPRESSION: _zstd_decompress,
+}
+
+class SquashFsImage:
+    data = None
+    superblock = None
+    decompress = None
+
+    def __init__(self, data: bytes | mmap.mmap):
+        # mmap slices are copies, so no buffer is left exported when the map closes
+        self.data = data if isinstance(data, mmap.mmap) else memoryview(data)
+        self.superblock = self._read_superblock()
+        self.decompress = DECOMPRESSORS[self.superblock['compressor']]
+        self._metadata_cache = {}
+        self._fragment_table = None
+
+    def _read_superblock(self) -> dict:
+        if len(self.data) < SUPERBLOCK_SIZE:
+            raise SquashFsError(f"Can't find a valid SQUASHFS superblock")
+        fields = struct.unpack_from(SUPERBLOCK_FORMAT, self.data, 0)
+        sb = dict(zip(['magic','inode_count','mod_time','block_size','fragment_count','compressor','block_log',
+                       'flags','id_count','version_major','version_minor','root_inode','bytes_used','id_table_start',
+                       'xattr_id_table_start','inode_table_start','directory_table_start','fragment_table_start',
+                       'export_table_start'], fields))
+        if sb['magic'] != SQUASHFS_MAGIC:
+            raise SquashFsError(f"Can't find a valid SQUASHFS superblock")
+        if (sb['version_major'], sb['version_minor']) != (4, 0):
+            raise SquashFsError(f"Unsupported SQUASHFS version {sb['version_major']}.{sb['version_minor']}")
+        if sb['block_size'] != 1 << sb['block_log'] or sb['block_size'] < 4096 or sb['block_size'] > 1024*1024:
+            raise SquashFsError(f"Invalid SQUASHFS block size")
+        if sb['bytes_used'] > len(self.data):
+            raise SquashFsError(f"SQUASHFS image is truncated")
+        if not sb['inode_table_start'] < sb['directory_table_start'] <= sb['bytes_used']:
+            raise SquashFsError(f"Invalid SQUASHFS table offsets")
+        if sb['compressor'] not in DECOMPRESSORS:
+            raise SquashFsError(f"Unsupported SQUASHFS compressor {sb['compressor']}")
+        return sb
+
+    def _read_metadata_block(self, position: int) -> tuple[bytes, int]:
+        cached = self._metadata_cache.get(position)
+        if cached is not None: return cached
+        header, = struct.unpack_from('<H', self.data, position)
+        size = header & ~METADATA_UNCOMPRESSED
+        raw = self.data[position + 2:position + 2 + size]
+        block = bytes(raw) if header & METADATA_UNCOMPRESSED else self.decompress(bytes(raw), METADATA_BLOCK_SIZE)
+        cached = (block, position + 2 + size)
+        self._metadata_cache[position] = cached
+        return cached
+
+    def _read_metadata(self, table_start: int, block: int, offset: int, length: int) -> bytes:
+        position = table_start + block
+        out = bytearray()
+        while len(out) < length:
+            data, next_position = self._read_metadata_block(position)
+            out += data[offset:offset + length - len(out)]
+            offset = 0
+            position = next_position
+        return bytes(out)
+
+    def _read_inode(self, inode_ref: int) -> dict:
+        block, offset = inode_ref >> 16, inode_ref & 0xFFFF
+        start = self.superblock['inode_table_start']
+        inode_type, = struct.unpack('<H', self._read_metadata(start, block, offset, 2))
+        if inode_type == BASIC_DIRECTORY:
+            raw = self._read_metadata(start, block, offset, 32)
+            dir_block, _, file_size, dir_offset, _ = struct.unpack_from('<IIHHI', raw, 16)
+            return {'type': inode_type, 'dir_block': dir_block, 'dir_offset': dir_offset, 'file_size': file_size}
+        if inode_type == EXTENDED_DIRECTORY:
+            raw = self._read_metadata(start, block, offset, 40)
+            _, file_size, dir_block, _, _, dir_offset, _ = struct.unpack_from('<IIIIHHI', raw, 16)
+            return {'type': inode_type, 'dir_block': dir_block, 'dir_offset': dir_offset, 'file_size': file_size}
+        if inode_type == BASIC_FILE:
+            raw = self._read_metadata(start, block, offset, 32)
+            blocks_start, fragment, fragment_offset, file_size = struct.unpack_from('<IIII', raw, 16)
+            header_size = 32
+        elif inode_type == EXTENDED_FILE:
+            raw = self._read_metadata(start, block, offset, 56)
+            blocks_start, file_size, _, _, fragment, fragment_offset, _ = struct.unpack_from('<QQQIII', raw, 16)
+            header_size = 56
+        else:
+            return {'type': inode_type}
+        block_size = self.superblock['block_size']
+        n_blocks = file_size // block_size if fragment != NO_FRAGMENT else (file_size + block_size - 1) // block_size
+        raw = self._read_metadata(start, block, offset, header_size + 4 * n_blocks)
+        return {'type': inode_type, 'blocks_start': blocks_start, 'fragment': fragment,
+                'fragment_offset': fragment_offset, 'file_size': file_size,
+                'block_sizes': struct.unpack_from(f"<{n_blocks}I", raw, header_size)}
+
+    def _list_directory(self, inode: dict) -> dict[str,int]:
+        entries = {}
+        # listing size includes the implicit . and .. entries
+        listing_size = inode['file_size'] - 3
+        if listing_size <= 0: return entries
+        raw = self._read_metadata(self.superblock['directory_table_start'], inode['dir_block'], inode['dir_offset'], listing_size)
+        pos = 0
+        while pos + 12 <= len(raw):
+            count, inode_block, _ = struct.unpack_from('<IIi', raw, pos)
+            pos += 12
+            for _ in range(count + 1):
+                inode_offset, _, _, name_size = struct.unpack_from('<HhHH', raw, pos)
+                pos += 8
+                name = bytes(raw[pos:pos + name_size + 1]).decode('utf-8', errors='surrogateescape')
+                pos += name_size + 1
+                entries[name] = (inode_block << 16) | inode_offset
+        return entries
+
+    def _fragment(self, index: int) -> tuple[int,int]:
+        if self._fragment_table is None:
+            count = self.superblock['fragment_count']
+            n_blocks = (count * 16 + METADATA_BLOCK_SIZE - 1) // METADATA_BLOCK_SIZE
+            self._fragment_table = struct.unpack_from(f"<{n_blocks}Q", self.data, self.superblock['fragment_table_start'])
+        block_position = self._fragment_table[(index * 16) // METADATA_BLOCK_SIZE]
+        raw = self._read_metadata(block_position, 0, (index * 16) % METADATA_BLOCK_SIZE, 16)
+        start, size, _ = struct.unpack('<QII', raw)
+        return start, size
+
+    def _read_data_block(self, position: int, size_field: int, expected_size: int) -> bytes:
+        size = size_field & (DATA_UNCOMPRESSED - 1)
+        if size == 0: return bytes(expected_size) # sparse block
+        raw = bytes(self.data[position:position + size])
+        return raw if size_field & DATA_UNCOMPRESSED else self.decompress(raw, self.superblock['block_size'])
+
+    def _read_file_inode(self, inode: dict) -> bytes:
+        block_size = self.superblock['block_size']
+        out = bytearray()
+        position = inode['blocks_start']
+        for size_field in inode['block_sizes']:
+            out += self._read_data_block(position, size_field, block_size)
+            position += size_field & (DATA_UNCOMPRESSED - 1)
+        if inode['fragment'] != NO_FRAGMENT:
+            start, size_field = self._fragment(inode['fragment'])
+            fragment = self._read_data_block(start, size_field, block_size)
+            tail = inode['file_size'] - len(out)
+            out += fragment[inode['fragment_offset']:inode['fragment_offset'] + tail]
+        return bytes(out[:inode['file_size']])
+
+    def lookup(self, path: str) -> dict | None:
+        inode = self._read_inode(self.superblock['root_inode'])
+        for name in [p for p in path.split('/') if len(p) > 0]:
+            if inode['type'] not in (BASIC_DIRECTORY, EXTENDED_DIRECTORY): return None
+            inode_ref = self._list_directory(inode).get(name)
+            if inode_ref is None: return None
+            inode = self._read_inode(inode_ref)
+        return inode
+
+    def read_file(self, path: str) -> bytes | None:
+        inode = self.lookup(path)
+        if inode is None or inode['type'] not in (BASIC_FILE, EXTENDED_FILE): return None
+        return self._read_file_inode(inode)
+
+    def read_files(self, paths: list[str]) -> dict[str,bytes | None]:
+        return dict((path, self.read_file(path)) for path in paths)
+
+def read_squashfs_files(image: bytes | str, paths: list[str]) -> dict[str,bytes | None]:
+    # image can be raw bytes or a file path (mapped in memory)
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return SquashFsImage(image).read_files(paths)
+    with open(image, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise SquashFsError(f"Can't find a valid SQUASHFS superblock")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return SquashFsImage(mapped).read_files(paths)
@@ -0,0 +1,229 @@
+import threading
+import logging
+from array import array
+from bisect import bisect_left
+from typing import List, Callable, Iterable
+
+LOGGER = logging.getLogger(__name__)
+
+# containers with more values than this are kept as bit sets
+BITMAP_ARRAY_MAX_SIZE = 4096
+BITMAP_CONTAINER_BYTES = 1 << 13
+
+
+###
+# Bitmap
+
+def _array_to_bits(values: array) -> int:
+    bits = bytearray(BITMAP_CONTAINER_BYTES)
+    for value in values:
+        bits[value >> 3] |= 1 << (value & 7)
+    return int.from_bytes(bits, 'little')
+
+def _bits_to_array(bits: int) -> array:
+    values = array('H')
+    for idx, byte in enumerate(bits.to_bytes(BITMAP_CONTAINER_BYTES, 'little')):
+        if byte == 0: continue
+        for bit in range(8):
+            if byte >> bit & 1: values.append(idx << 3 | bit)
+    return values
+
+def _container_size(container: array | int) -> int:
+    return container.bit_count() if isinstance(container, int) else len(container)
+
+def _compact(container: array | int) -> array | int | None:
+    size = _container_size(container)
+    if size == 0: return None
+    if isinstance(container, int) and size <= BITMAP_ARRAY_MAX_SIZE: return _bits_to_array(container)
+    if not isinstance(container, int) and size > BITMAP_ARRAY_MAX_SIZE: return _array_to_bits(container)
+    return container
+
+def _and_containers(a: array | int, b: array | int) -> array | int | None:
+    if isinstance(a, int) and isinstance(b, int):
+        return _compact(a & b)
+    if isinstance(a, int): a, b = b, a
+    if isinstance(b, int):
+        return _compact(array('H', (value for value in a if b >> value & 1)))
+    if len(a) > len(b): a, b = b, a
+    b_values = set(b)
+    return _compact(array('H', (value for value in a if value in b_values)))
+
+def _or_containers(a: array | int, b: array | int) -> array | int | None:
+    if isinstance(a, int) or isinstance(b, int) or len(a) + len(b) > BITMAP_ARRAY_MAX_SIZE:
+        a_bits = a if isinstance(a, int) else _array_to_bits(a)
+        b_bits = b if isinstance(b, int) else _array_to_bits(b)
+        return _compact(a_bits | b_bits)
+    return array('H', sorted(set(a).union(b)))
+
+class Bitmap:
+    """
+    Compressed set of non negative ints (roaring style). Values are split by their
+    high 16 bits, each container holding the low bits as a sorted array while
+    sparse and as a 2^16 bit set (int) once dense
+    """
+    def __init__(self, values: Iterable[int] = ()):
+        self.containers = {}
+        for value in values: self.add(value)
+
+    def add(self, value: int):
+        high, low = value >> 16, value & 0xffff
+        container = self.containers.get(high)
+        if container is None:
+            self.containers[high] = array('H', [low])
+        elif isinstance(container, int):
+            self.containers[high] = container | (1 << low)
+        else:
+            idx = bisect_left(container, low)
+            if idx < len(container) and container[idx] == low: return
+            container.insert(idx, low)
+            if len(container) > BITMAP_ARRAY_MAX_SIZE:
+                self.containers[high] = _array_to_bits(container)
+
+    def discard(self, value: int):
+        high, low = value >> 16, value & 0xffff
+        container = self.containers.get(high)
+        if container is None: return
+        if isinstance(container, int):
+            container &= ~(1 << low)
+        else:
+            idx = bisect_left(container, low)
+            if idx == len(container) or container[idx] != low: return
+            del container[idx]
+        container = _compact(container)
+        if container is None:
+            del self.containers[high]
+        else:
+            self.containers[high] = container
+
+    def __contains__(self, value: int) -> bool:
+        container = self.containers.get(value >> 16)
+        if container is None: return False
+        low = value & 0xffff
+        if isinstance(container, int): return container >> low & 1 == 1
+        idx = bisect_left(container, low)
+        return idx < len(container) and container[idx] == low
+
+    def __len__(self) -> int:
+        return sum(_container_size(container) for container in self.containers.values())
+
+    def __iter__(self):
+        for high in sorted(self.containers):
+            container = self.containers[high]
+            if isinstance(container, int): container = _bits_to_array(container)
+            for low in container:
+                yield high << 16 | low
+
+    def __and__(self, other: 'Bitmap') -> 'Bitmap':
+        result = Bitmap()
+        for high in self.containers.keys() & other.containers.keys():
+            container = _and_containers(self.containers[high], other.containers[high])
+            if container is not None: result.containers[high] = container
+        return result
+
+    def __or__(self, other: 'Bitmap') -> 'Bitmap':
+        result = Bitmap()
+        for high in self.containers.keys() | other.containers.keys():
+            a, b = self.containers.get(high), other.containers.get(high)
+            if a is None or b is None:
+                container = a if b is None else b
+                result.containers[high] = container if isinstance(container, int) else array('H', container)
+            else:
+                result.containers[high] = _or_containers(a, b)
+        return result
+
+
+###
+# Tag index
+
+class TagIndex:
+    """
+    Bitmaps of entity ordinals by tag name. Ordinals are given in memory as the
+    entities are indexed, so the index is loaded from the tag tables on first use.
+    Changed entities are only marked, their tags are read back from the tables
+    once the session that changed them is over, so a rolled back change never
+    reaches the index
+    """
+    def __init__(self, load_fn: Callable[[List[str] | None], List[tuple[str,str]]], marks):
+        # load_fn returns the (entity_id, tag) pairs of the given entity ids, or of all of them
+        # marks keep the changed ids until they settle (see model.SessionMarks)
+        self.load_fn = load_fn
+        self.marks = marks
+        self.loaded = False
+        self.ids = []
+        self.ordinals = {}
+        self.bitmaps = {}
+        self.entity_tags = {}
+        self.lock = threading.Lock()
+
+    def _ordinal(self, entity_id: str) -> int:
+        ordinal = self.ordinals.get(entity_id)
+        if ordinal is None:
+            ordinal = len(self.ids)
+            self.ids.append(entity_id)
+            self.ordinals[entity_id] = ordinal
+        return ordinal
+
+    def _set_tags(self, entity_id: str, tags: List[str]):
+        ordinal = self._ordinal(entity_id)
+        tags = set(tags)
+        previous_tags = self.entity_tags.get(entity_id, set())
+        for tag in previous_tags - tags:
+            self.bitmaps[tag].discard(ordinal)
+            if len(self.bitmaps[tag].containers) == 0: del self.bitmaps[tag]
+        for tag in tags - previous_tags:
+            self.bitmaps.setdefault(tag, Bitmap()).add(ordinal)
+        self.entity_tags[entity_id] = tags
+
+    def _load(self):
+        if self.loaded: return
+        entity_tags = {}
+        for entity_id, tag in self.load_fn(None):
+            entity_tags.setdefault(entity_id, []).append(tag)
+        for entity_id, tags in entity_tags.items():
+            self._set_tags(entity_id, tags)
+        self.loaded = True
+        LOGGER.debug(f"Loaded tag index with {len(self.bitmaps)} tags of {len(self.ids)} entities")
+
+    def _refresh(self):
+        # tags of the settled entities as committed, removed entities end up without tags
+        entity_ids = self.marks.pop_settled()
+        if len(entity_ids) == 0: return
+        entity_tags = dict((entity_id, []) for entity_id in entity_ids)
+        for entity_id, tag in self.load_fn(entity_ids):
+            entity_tags[entity_id].append(tag)
+        for entity_id, tags in entity_tags.items():
+            self._set_tags(entity_id, tags)
+
+    def update(self, entity_id: str):
+        # indexes not loaded yet will read the tags from the tables when needed
+        with self.lock:
+            if not self.loaded: return
+            self.marks.mark(entity_id)
+
+    def match(self, tags: List[str], match_any: bool = False, max_size: int | None = None) -> List[str] | None:
+        # ids of the entities with all of the tags (or any of them), None when there are more than max_size
+        with self.lock:
+            self._load()
+            self._refresh()
+            bitmaps = [self.bitmaps.get(tag, Bitmap()) for tag in set(tags)]
+            if len(bitmaps) == 0: return []
+            if match_any:
+                result = bitmaps[0]
+                for bitmap in bitmaps[1:]: result = result | bitmap
+            else:
+                bitmaps.sort(key=len)
+                result = bitmaps[0]
+                for bitmap in bitmaps[1:]:
+                    if len(result.containers) == 0: break
+                    result = result & bitmap
+            if max_size is not None and len(result) > max_size: return None
+            return [self.ids[ordinal] for ordinal in result]
+
+    def clear(self):
+        with self.lock:
+            self.loaded = False
+            self.ids = []
+            self.ordinals = {}
+            self.bitmaps = {}
+            self.entity_tags = {}
+            self.marks.clear()
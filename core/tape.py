@@ -2,7 +2,6 @@ from pydantic import BaseModel
 import logging
 from typing import Optional, List
 import json
-from py_expression_eval import Parser
 from enum import Enum
 
 from cartesi.abi import String, Bytes, Bytes32, Int, UInt, Address
@@ -13,10 +12,17 @@ from cartesapp.input import mutation, query
 from cartesapp.output import output, add_output, event, emit_event, index_input
 from cartesapp.utils import hex2bytes, bytes2str, str2bytes
 
-from .model import insert_rule, Rule, RuleTag, RuleData, Cartridge, Tape, \
-    AddressList, Bytes32List, UInt256List, Int256List, BytesList, Bytes32ListList, format_incard
+from .model import insert_rule, apply_rule_budget, Rule, RuleTag, RuleData, Cartridge, Tape, \
+    AddressList, Bytes32List, UInt256List, Int256List, BytesList, Bytes32ListList, format_incard, \
+    format_rule_incard, format_cartridge_incard, invalidate_incards, count_tape_submission, count_tape_verification, \
+    filter_rules_by_tags, filter_tapes_by_tags, name_candidates
 
 from .riv import verify_log
+from .replay_cache import cached_verify_log
+from .score import evaluate_score
+from .leaderboard import get_leaderboards, get_leaderboard
+from .pagination import parse_order, keyset_page
+from .projection import parse_fields, field_columns, select_columns, column_rows, project
 from .core_settings import CoreSettings, generate_tape_id, generate_rule_id, get_version, generate_entropy, get_cartridges_path, \
     format_cartridge_id_from_bytes, format_rule_id_from_bytes, format_tape_id_from_bytes
 
@@ -31,6 +37,7 @@ class ErrorCode(Enum):
     OUTHASH_MATCH_ERROR = 2
     SCORE_MATCH_ERROR = 3
     SCORE_ERROR = 4
+    BUDGET_EXCEEDED = 5
 
 # Inputs
 
@@ -39,6 +46,11 @@ RulePayload = RuleData
 class DeactivateRulePayload(BaseModel):
     rule_id:        Bytes32
 
+class SetRuleBudgetPayload(BaseModel):
+    rule_id:        Bytes32
+    max_frames:     UInt # 0 means no limit
+    max_time:       UInt # seconds, 0 means no limit
+
 class VerifyPayload(BaseModel):
     # cartridge_id:   Bytes32
     rule_id:        Bytes32
@@ -61,6 +73,9 @@ class GetRulesPayload(BaseModel):
     page_size:      Optional[int]
     order_by:       Optional[str]
     order_dir:      Optional[str]
+    cursor:         Optional[str] # keyset pagination instead of page, empty for the first page
+    with_total:     Optional[bool]
+    fields:         Optional[List[str]] # only these fields, in a *FieldsOutput
     tags:           Optional[List[str]]
     tags_or:        Optional[bool]
     full:           Optional[bool]
@@ -78,6 +93,9 @@ class GetTapesPayload(BaseModel):
     page_size:      Optional[int]
     order_by:       Optional[str]
     order_dir:      Optional[str]
+    cursor:         Optional[str] # keyset pagination instead of page, empty for the first page
+    with_total:     Optional[bool]
+    fields:         Optional[List[str]] # only these fields, in a *FieldsOutput
     tags:           Optional[List[str]]
     tags_or:        Optional[bool]
     full:           Optional[bool]
@@ -113,10 +131,20 @@ class GetTapesPayload(BaseModel):
     page_size:      Optional[int]
     order_by:       Optional[str]
     order_dir:      Optional[str]
+    cursor:         Optional[str] # keyset pagination instead of page, empty for the first page
+    with_total:     Optional[bool]
+    fields:         Optional[List[str]] # only these fields, in a *FieldsOutput
     tags:           Optional[List[str]]
     tags_or:        Optional[bool]
     full:           Optional[bool]
 
+class GetLeaderboardPayload(BaseModel):
+    rule_id:        str
+    tape_id:        Optional[str]
+    user_address:   Optional[str]
+    page:           Optional[int]
+    page_size:      Optional[int]
+
 class FormatInCardPayload(BaseModel):
     rule_id:        Optional[str]
     cartridge_id:   Optional[str]
@@ -175,8 +203,11 @@ class RuleInfo(BaseModel):
     args: str
     in_card: bytes
     score_function: str
-    # n_tapes: int
-    # n_verified: int
+    n_tapes: Optional[int]
+    n_verified: Optional[int]
+    n_failed: Optional[int]
+    n_players: Optional[int]
+    best_score: Optional[int]
     start: Optional[int]
     end: Optional[int]
     tags: List[str]
@@ -185,14 +216,24 @@ class RuleInfo(BaseModel):
     allow_in_card: Optional[bool]
     save_tapes: Optional[bool]
     save_out_cards: Optional[bool]
+    max_frames: Optional[int]
+    max_time: Optional[int]
     tapes: Optional[List[str]]
     deactivated: Optional[bool]
     
 @output()
 class RulesOutput(BaseModel):
     data:   List[RuleInfo]
-    total:  int
+    total:  Optional[int]
+    page:   int
+    next_cursor: Optional[str]
+
+@output()
+class RuleFieldsOutput(BaseModel):
+    data:   List[dict]
+    total:  Optional[int]
     page:   int
+    next_cursor: Optional[str]
 
 @output()
 class RuleTagsOutput(BaseModel):
@@ -206,6 +247,7 @@ class TapeInfo(BaseModel):
     timestamp: int
     input_index: Optional[int]
     score: Optional[int]
+    error_code: Optional[int]
     rank: Optional[int]
     verified: Optional[bool]
     in_card: Optional[bytes]
@@ -216,7 +258,29 @@ class TapeInfo(BaseModel):
 @output()
 class TapesOutput(BaseModel):
     data:   List[TapeInfo]
+    total:  Optional[int]
+    page:   int
+    next_cursor: Optional[str]
+
+@output()
+class TapeFieldsOutput(BaseModel):
+    data:   List[dict]
+    total:  Optional[int]
+    page:   int
+    next_cursor: Optional[str]
+
+class LeaderboardEntry(BaseModel):
+    rank: int
+    tape_id: str
+    user_address: str
+    score: int
+    input_index: int
+
+@output()
+class LeaderboardOutput(BaseModel):
+    data:   List[LeaderboardEntry]
     total:  int
+    users:  int
     page:   int
 
 
@@ -250,16 +314,9 @@ def create_rule(payload: RulePayload) -> bool:
         test_replay = test_replay_file.read()
         test_replay_file.close()
 
-        with open(f"{get_cartridges_path()}/{payload_cartridge}",'rb') as cartridge_file:
-            cartridge_data = cartridge_file.read()
-
-        all_tapes = []
-        if cartridge.tapes is not None and len(cartridge.tapes) > 0:
-            all_tapes.extend(cartridge.tapes)
-        all_tapes.extend(map(lambda x: format_tape_id_from_bytes(x), payload.tapes))
-        incard = format_incard(all_tapes, [payload.in_card])
+        incard = format_cartridge_incard(cartridge, [payload.in_card], map(lambda x: format_tape_id_from_bytes(x), payload.tapes))
 
-        verification_output = verify_log(cartridge_data,test_replay,payload.args,incard)
+        verification_output = cached_verify_log(payload_cartridge,test_replay,payload.args,incard)
 
         rule_id = generate_rule_id(
             hex2bytes(cartridge.primary_id or cartridge.id),
@@ -321,6 +378,32 @@ def deactivate_rule(payload: DeactivateRulePayload) -> bool:
 
     return True
 
+@mutation(proxy=CoreSettings().proxy_address)
+def set_rule_budget(payload: SetRuleBudgetPayload) -> bool:
+    metadata = get_metadata()
+
+    payload_rule = format_rule_id_from_bytes(payload.rule_id)
+
+    # get Rule
+    rule = Rule.get(lambda r: r.id == payload_rule)
+    if rule is None:
+        msg = f"rule {payload_rule} doesn't exist"
+        LOGGER.error(msg)
+        add_output(msg)
+        return False
+
+    if rule.created_by != metadata['msg_sender'].lower() and \
+            metadata['msg_sender'].lower() != CoreSettings().operator_address.lower():
+        msg = f"Sender not allowed"
+        LOGGER.error(msg)
+        add_output(msg)
+        return False
+
+    # tapes already submitted keep the result of the previous budget
+    apply_rule_budget(rule, payload.max_frames, payload.max_time)
+
+    return True
+
 @mutation(proxy=CoreSettings().proxy_address)
 def verify(payload: VerifyPayload) -> bool:
     metadata = get_metadata()
@@ -402,24 +485,17 @@ def verify(payload: VerifyPayload) -> bool:
     try:
         entropy = generate_entropy(metadata.msg_sender, rule.id)
 
-        with open(f"{get_cartridges_path()}/{rule.cartridge_id}",'rb') as cartridge_file:
-            cartridge_data = cartridge_file.read()
-
-        all_tapes = []
-        if cartridge.tapes is not None and len(cartridge.tapes) > 0:
-            all_tapes.extend(cartridge.tapes)
-        all_tapes.extend(rule.tapes)
+        payload_tapes = []
         if rule.allow_tapes and len(payload.tapes) > 0:
-            all_tapes.extend(map(lambda x: format_tape_id_from_bytes(x), payload.tapes))
+            payload_tapes.extend(map(lambda x: format_tape_id_from_bytes(x), payload.tapes))
 
-        all_incards = []
-        if rule.in_card is not None and len(rule.in_card) > 0:
-            all_incards.append(rule.in_card)
+        payload_incards = []
         if rule.allow_in_card and len(payload.in_card) > 0:
-           all_incards.append(payload.in_card)
-        incard = format_incard(all_tapes, all_incards)
+           payload_incards.append(payload.in_card)
+        incard = format_rule_incard(rule, cartridge, payload_incards, payload_tapes)
 
-        verification_output = verify_log(cartridge_data,payload.tape,rule.args,incard,entropy=entropy)
+        verification_output = verify_log(rule.cartridge_id,payload.tape,rule.args,incard,entropy=entropy,
+                                         max_frames=rule.max_frames or None,timeout=rule.max_time or None,rule_id=rule.id)
         outcard_raw = verification_output.get('outcard')
         outhash = verification_output.get('outhash')
         # screenshot = verification_output.get('screenshot')
@@ -457,8 +533,7 @@ def verify(payload: VerifyPayload) -> bool:
     if rule.score_function is not None and len(rule.score_function) > 0 and outcard_format == b"JSON":
         try:
             outcard_json = json.loads(outcard_print)
-            parser = Parser()
-            score = parser.parse(rule.score_function).evaluate(outcard_json)
+            score = evaluate_score(rule.score_function,outcard_json)
         except Exception as e:
             msg = f"Couldn't load/parse score from json: {e}"
             LOGGER.error(msg)
@@ -508,7 +583,7 @@ def verify(payload: VerifyPayload) -> bool:
         tapes=all_tapes
     )
     common_tags = [rule.cartridge_id,payload_rule,tape_id]
-    common_tags.extend(list(rule.tags.name.distinct().keys()))
+    common_tags.extend(list(rule.tag_names))
     index_tags = ["tape"]
     index_tags.extend(common_tags)
     index_input(tags=index_tags,value=metadata.timestamp)
@@ -519,6 +594,9 @@ def verify(payload: VerifyPayload) -> bool:
 
     # outcard_to_save = outcard_raw if rule.save_out_cards else True
 
+    count_tape_submission(rule,cartridge,metadata.msg_sender)
+    count_tape_verification(rule,cartridge,score,ErrorCode.NONE.value)
+
     t = Tape(
         id = tape_id,
         cartridge_id = cartridge.id,
@@ -528,6 +606,7 @@ def verify(payload: VerifyPayload) -> bool:
         input_index = metadata.input_index,
         verified = True,
         score = score,
+        error_code = ErrorCode.NONE.value,
     )
     if rule.allow_tapes and len(payload.tapes) > 0:
         t.tapes = [t.hex() for t in payload.tapes]
@@ -535,9 +614,11 @@ def verify(payload: VerifyPayload) -> bool:
         t.in_card = payload.in_card
     if rule.save_out_cards:
         t.out_card = outcard_raw
+        invalidate_incards([tape_id])
     if rule.save_tapes:
         t.data = payload.tape
     # TapeHash.set_verified(tape_id,outcard_to_save)
+    get_leaderboards().update_tape(rule.id,tape_id)
 
     return True
 
@@ -611,10 +692,12 @@ def register_external_verification(payload: VerifyPayload) -> bool:
 
     LOGGER.info(f"Received new tape {tape_id} in input {metadata.input_index}")
     tags = ["tape",rule.cartridge_id,payload_rule,tape_id]
-    tags.extend(list(rule.tags.name.distinct().keys()))
+    tags.extend(list(rule.tag_names))
     index_input(tags=tags,value=metadata.timestamp)
     # TapeHash.add(tape_id)#(rule.cartridge_id,rule.id,tape_id)
 
+    count_tape_submission(rule,cartridge,metadata.msg_sender)
+
     t = Tape(
         id = tape_id,
         cartridge_id = cartridge.id,
@@ -730,7 +813,7 @@ def external_verification(payload: ExternalVerificationPayload) -> bool:
         LOGGER.info(f"Sending tape verification output")
 
         tags = ['score',cartridge.id,rule.id,tape.id]
-        tags.extend(list(rule.tags.name.distinct().keys()))
+        tags.extend(list(rule.tag_names))
         emit_event(out_ev,tags=tags,value=payload.scores[ind])
 
         # tape_to_save = payload.outcards[ind] if rule.save_tapes else True
@@ -739,8 +822,12 @@ def external_verification(payload: ExternalVerificationPayload) -> bool:
         
         tape.verified = True
         tape.score = payload.scores[ind]
+        tape.error_code = payload.error_codes[ind]
+        count_tape_verification(rule,cartridge,payload.scores[ind],payload.error_codes[ind])
         if rule.save_out_cards and payload.error_codes[ind] == ErrorCode.NONE.value:
             tape.out_card = payload.outcards[ind]
+            invalidate_incards([tape.id])
+        get_leaderboards().update_tape(rule.id,tape.id)
 
     return True
 
@@ -797,17 +884,14 @@ def award_winners(payload: AwardWinnerTapesPayload) -> bool:
         add_output(msg)
         return False
     
-    total_tapes = Tape.select(lambda r: r.rule_id == rule.id).count()
-    tapes_verified_query = Tape.select(lambda r: r.rule_id == rule.id and 
-                                       r.verified and r.score is not None)
-    total_verified = tapes_verified_query.count()
-
-    if total_verified < total_tapes:
+    if helpers.exists(r for r in Tape if r.rule_id == rule.id and (not r.verified or r.score is None)):
         msg = f"not all tapes verified"
         LOGGER.error(msg)
         add_output(msg)
         return False
-    
+
+    tapes_verified_query = Tape.select(lambda r: r.rule_id == rule.id and 
+                                       r.verified and r.score is not None)
     tapes_to_award = tapes_verified_query.order_by(helpers.desc(Tape.score)).page(1,payload.tapes_to_award)
 
     rank = 1
@@ -864,6 +948,7 @@ def clean_tapes(payload: CleanTapesPayload) -> bool:
                 tags=['outcard',rule.cartridge_id,rule.id,tape.id]
             )
             tape.out_card = None
+            invalidate_incards([tape.id])
         if tape.data and len(tape.data) > 0:
             tape.data = None
         if tape.in_card and len(tape.in_card) > 0:
@@ -886,6 +971,9 @@ def rules(payload: GetRulesPayload) -> bool:
     if payload.cartridge_id is not None:
         rules_query = rules_query.filter(lambda r: r.cartridge_id == payload.cartridge_id)
     if payload.name is not None:
+        candidate_ids = name_candidates('rule', payload.name)
+        if candidate_ids is not None:
+            rules_query = rules_query.filter(lambda r: r.id in candidate_ids)
         rules_query = rules_query.filter(lambda r: payload.name in r.name)
     if payload.active_ts is not None:
         rules_query = rules_query.filter(lambda r: r.start is not None and r.end is not None and payload.active_ts >= r.start and payload.active_ts <= r.end)
@@ -896,54 +984,82 @@ def rules(payload: GetRulesPayload) -> bool:
     if payload.created_by is not None:
         rules_query = rules_query.filter(lambda r: payload.created_by.lower() == r.created_by)
     if payload.tags is not None and len(payload.tags) > 0:
-        if payload.tags_or is not None and payload.tags_or:
-            tags_fn = lambda t: t.name in payload.tags
-        else:
-            tags_fn = lambda t: t.name in payload.tags and helpers.count(t) == len(payload.tags)
-        rules_query = helpers.distinct(
-            r for r in rules_query for t in RuleTag if r in t.rules and tags_fn(t)
-        )
-    else:
-        rules_query = helpers.distinct(
-            o for o in rules_query
-        )
+        rules_query = filter_rules_by_tags(rules_query, payload.tags, match_any=payload.tags_or is not None and payload.tags_or)
+    rules_query = helpers.distinct(
+        o for o in rules_query
+    )
 
-    total = rules_query.count()
+    total = rules_query.count() if payload.with_total is None or payload.with_total else None
 
-    if payload.order_by is not None:
-        order_dict = {"asc":lambda d: d,"desc":helpers.desc}
-        order_dir_list = []
-        order_by_list = payload.order_by.split(',')
-        if payload.order_dir is not None:
-            order_dir_list = payload.order_dir.split(',')
-        for idx,ord in enumerate(order_by_list):
-            if idx < len(order_dir_list): dir_order = order_dict[order_dir_list[idx]]
-            else: dir_order = order_dict["asc"]
-            rules_query = rules_query.order_by(dir_order(getattr(Rule,ord)))
+    columns = None
+    if payload.fields is not None:
+        try:
+            fields = parse_fields(Rule,payload.fields,['tags'])
+        except Exception as e:
+            msg = f"Couldn't get rules fields: {e}"
+            LOGGER.error(msg)
+            add_output(msg)
+            return False
+        columns = field_columns(Rule,fields,['tag_names'] if 'tags' in fields else [])
 
     page = 1
-    if payload.page is not None:
-        page = payload.page
-        if payload.page_size is not None:
-            rules = rules_query.page(payload.page,payload.page_size)
-        else:
-            rules = rules_query.page(payload.page)
+    next_cursor = None
+    if payload.cursor is not None:
+        # keyset pagination, an empty cursor is the first page
+        try:
+            order = parse_order(Rule,payload.order_by,payload.order_dir)
+            rules, next_cursor = keyset_page(rules_query,Rule,order,payload.cursor,payload.page_size,columns)
+        except Exception as e:
+            msg = f"Couldn't get rules page: {e}"
+            LOGGER.error(msg)
+            add_output(msg)
+            return False
     else:
-        rules = rules_query
+        if payload.order_by is not None:
+            order_dict = {"asc":lambda d: d,"desc":helpers.desc}
+            order_dir_list = []
+            order_by_list = payload.order_by.split(',')
+            if payload.order_dir is not None:
+                order_dir_list = payload.order_dir.split(',')
+            for idx,ord in enumerate(order_by_list):
+                if idx < len(order_dir_list): dir_order = order_dict[order_dir_list[idx]]
+                else: dir_order = order_dict["asc"]
+                rules_query = rules_query.order_by(dir_order(getattr(Rule,ord)))
+        if columns is not None:
+            rules_query = select_columns(rules_query,columns)
+
+        if payload.page is not None:
+            page = payload.page
+            if payload.page_size is not None:
+                rules = rules_query.page(payload.page,payload.page_size)
+            else:
+                rules = rules_query.page(payload.page)
+        else:
+            rules = rules_query
+        if columns is not None:
+            rules = column_rows(list(rules),columns)
     
+    if payload.fields is not None:
+        if 'tags' in fields:
+            for r in rules: r["tags"] = list(r["tag_names"])
+        dict_list_result = project(rules,fields)
+
+        LOGGER.info(f"Returning {len(dict_list_result)} of {total} rules")
+
+        out = RuleFieldsOutput.parse_obj({'data':dict_list_result,'total':total,'page':page,'next_cursor':next_cursor})
+        add_output(out)
+        return True
+
     full = payload.full is not None and payload.full
     dict_list_result = []
     for r in rules:
         dict_rule = r.to_dict(with_lazy=full)
-        # summary = TapeHash.get_rule_tapes_summary(r.id)
-        # dict_rule["n_tapes"] = summary["all"]
-        # dict_rule["n_verified"] = summary["verified"]
-        dict_rule["tags"] = list(r.tags.name.distinct().keys())
+        dict_rule["tags"] = list(r.tag_names)
         dict_list_result.append(dict_rule)
 
     LOGGER.info(f"Returning {len(dict_list_result)} of {total} rules")
     
-    out = RulesOutput.parse_obj({'data':dict_list_result,'total':total,'page':page})
+    out = RulesOutput.parse_obj({'data':dict_list_result,'total':total,'page':page,'next_cursor':next_cursor})
     
     add_output(out)
 
@@ -955,6 +1071,9 @@ def rule_tags(payload: GetRuleTagsPayload) -> bool:
     if payload.cartridge_id is not None:
         tags_query = tags_query.filter(lambda r: r.cartridge_id == payload.cartridge_id)
     if payload.name is not None:
+        candidate_names = name_candidates('rule_tag', payload.name)
+        if candidate_names is not None:
+            tags_query = tags_query.filter(lambda r: r.name in candidate_names)
         tags_query = tags_query.filter(lambda r: payload.name in r.name)
 
     tag_names = helpers.select(r.name for r in tags_query).fetch()
@@ -965,6 +1084,8 @@ def rule_tags(payload: GetRuleTagsPayload) -> bool:
 
 @query()
 def tapes(payload: GetTapesPayload) -> bool:
+    if _leaderboard_tapes_page(payload): return True
+
     tapes_query = Tape.select()
     
     if payload.id is not None:
@@ -987,41 +1108,70 @@ def tapes(payload: GetTapesPayload) -> bool:
         tapes_query = tapes_query.filter(lambda r: payload.user_address.lower() == r.user_address)
 
     if payload.tags is not None and len(payload.tags) > 0:
-        if payload.tags_or is not None and payload.tags_or:
-            tags_fn = lambda t: t.name in payload.tags
-        else:
-            tags_fn = lambda t: t.name in payload.tags and helpers.count(t) == len(payload.tags)
-        tapes_query = helpers.distinct(
-            i for i in tapes_query for r in Rule for t in RuleTag if i.rule_id == r.id and r in t.rules and tags_fn(t)
-        )
-    else:
-        tapes_query = helpers.distinct(
-            o for o in tapes_query
-        )
+        tapes_query = filter_tapes_by_tags(tapes_query, payload.tags, match_any=payload.tags_or is not None and payload.tags_or)
+    tapes_query = helpers.distinct(
+        o for o in tapes_query
+    )
 
-    total = tapes_query.count()
+    total = tapes_query.count() if payload.with_total is None or payload.with_total else None
 
-    if payload.order_by is not None:
-        order_dict = {"asc":lambda d: d,"desc":helpers.desc}
-        order_dir_list = []
-        order_by_list = payload.order_by.split(',')
-        if payload.order_dir is not None:
-            order_dir_list = payload.order_dir.split(',')
-        for idx,ord in enumerate(order_by_list):
-            if idx < len(order_dir_list): dir_order = order_dict[order_dir_list[idx]]
-            else: dir_order = order_dict["asc"]
-            tapes_query = tapes_query.order_by(dir_order(getattr(Tape,ord)))
+    columns = None
+    if payload.fields is not None:
+        try:
+            fields = parse_fields(Tape,payload.fields)
+        except Exception as e:
+            msg = f"Couldn't get tapes fields: {e}"
+            LOGGER.error(msg)
+            add_output(msg)
+            return False
+        columns = field_columns(Tape,fields)
 
     page = 1
-    if payload.page is not None:
-        page = payload.page
-        if payload.page_size is not None:
-            tapes = tapes_query.page(payload.page,payload.page_size)
-        else:
-            tapes = tapes_query.page(payload.page)
+    next_cursor = None
+    if payload.cursor is not None:
+        # keyset pagination, an empty cursor is the first page
+        try:
+            order = parse_order(Tape,payload.order_by,payload.order_dir)
+            tapes, next_cursor = keyset_page(tapes_query,Tape,order,payload.cursor,payload.page_size,columns)
+        except Exception as e:
+            msg = f"Couldn't get tapes page: {e}"
+            LOGGER.error(msg)
+            add_output(msg)
+            return False
     else:
-        tapes = tapes_query
+        if payload.order_by is not None:
+            order_dict = {"asc":lambda d: d,"desc":helpers.desc}
+            order_dir_list = []
+            order_by_list = payload.order_by.split(',')
+            if payload.order_dir is not None:
+                order_dir_list = payload.order_dir.split(',')
+            for idx,ord in enumerate(order_by_list):
+                if idx < len(order_dir_list): dir_order = order_dict[order_dir_list[idx]]
+                else: dir_order = order_dict["asc"]
+                tapes_query = tapes_query.order_by(dir_order(getattr(Tape,ord)))
+        if columns is not None:
+            tapes_query = select_columns(tapes_query,columns)
+
+        if payload.page is not None:
+            page = payload.page
+            if payload.page_size is not None:
+                tapes = tapes_query.page(payload.page,payload.page_size)
+            else:
+                tapes = tapes_query.page(payload.page)
+        else:
+            tapes = tapes_query
+        if columns is not None:
+            tapes = column_rows(list(tapes),columns)
     
+    if payload.fields is not None:
+        dict_list_result = project(tapes,fields)
+
+        LOGGER.info(f"Returning {len(dict_list_result)} of {total} tapes")
+
+        out = TapeFieldsOutput.parse_obj({'data':dict_list_result,'total':total,'page':page,'next_cursor':next_cursor})
+        add_output(out)
+        return True
+
     full = payload.full is not None and payload.full
     dict_list_result = []
     for r in tapes:
@@ -1030,13 +1180,68 @@ def tapes(payload: GetTapesPayload) -> bool:
 
     LOGGER.info(f"Returning {len(dict_list_result)} of {total} tapes")
     
-    out = TapesOutput.parse_obj({'data':dict_list_result,'total':total,'page':page})
+    out = TapesOutput.parse_obj({'data':dict_list_result,'total':total,'page':page,'next_cursor':next_cursor})
     
     add_output(out)
 
     return True
 
 
+def _leaderboard_tapes_page(payload: GetTapesPayload) -> bool:
+    # a page of a rule's tapes by score desc is read from the leaderboard (unscored tapes sort last)
+    other_filters = [payload.id, payload.ids, payload.cartridge_id, payload.user_address, payload.rank_lte,
+        payload.rank_gte, payload.timestamp_lte, payload.timestamp_gte, payload.tags]
+    if payload.rule_id is None or payload.order_by != 'score' or payload.order_dir != 'desc' or \
+            payload.page is None or payload.page_size is None or payload.cursor is not None or payload.fields is not None or \
+            any(f is not None for f in other_filters):
+        return False
+
+    board = get_leaderboard(payload.rule_id)
+    offset = (payload.page - 1) * payload.page_size
+    if offset + payload.page_size > board.held(): return False
+
+    tape_ids = [e['tape_id'] for e in board.top(payload.page_size, offset)]
+    tapes_by_id = dict((t.id, t) for t in Tape.select(lambda r: r.id in tape_ids))
+    total = None
+    if payload.with_total is None or payload.with_total:
+        total = Tape.select(lambda r: r.rule_id == payload.rule_id).count()
+
+    full = payload.full is not None and payload.full
+    dict_list_result = [tapes_by_id[tape_id].to_dict(with_lazy=full) for tape_id in tape_ids]
+
+    LOGGER.info(f"Returning {len(dict_list_result)} of {total} tapes")
+
+    out = TapesOutput.parse_obj({'data':dict_list_result,'total':total,'page':payload.page})
+
+    add_output(out)
+
+    return True
+
+@query()
+def leaderboard(payload: GetLeaderboardPayload) -> bool:
+    board = get_leaderboard(payload.rule_id)
+
+    page = 1
+    if payload.tape_id is not None or payload.user_address is not None:
+        entries = []
+        if payload.tape_id is not None:
+            entries.append(board.tape_entry(payload.tape_id))
+        if payload.user_address is not None:
+            entries.append(board.user_entry(payload.user_address.lower()))
+        entries = [e for e in entries if e is not None]
+    else:
+        page_size = payload.page_size if payload.page_size is not None else 10
+        if payload.page is not None: page = payload.page
+        entries = board.top(page_size, (page - 1) * page_size)
+
+    LOGGER.info(f"Returning {len(entries)} of {board.size()} leaderboard entries")
+
+    out = LeaderboardOutput.parse_obj({'data':entries,'total':board.size(),'users':board.n_users(),'page':page})
+
+    add_output(out)
+
+    return True
+
 @query()
 def format_in_card(payload: FormatInCardPayload) -> bool:
 
@@ -1060,16 +1265,14 @@ def format_in_card(payload: FormatInCardPayload) -> bool:
             add_output(msg)
             return False
 
-        if cartridge.tapes is not None and len(cartridge.tapes) > 0:
-            all_tapes.extend(cartridge.tapes)
-        all_tapes.extend(rule.tapes)
         if rule.allow_tapes and payload.tapes is not None and len(payload.tapes) > 0:
             all_tapes.extend(payload.tapes)
 
-        if rule.in_card is not None and len(rule.in_card) > 0:
-            all_incards.append(rule.in_card)
         if rule.allow_in_card and payload.in_card is not None and len(payload.in_card) > 0:
             all_incards.append(hex2bytes(payload.in_card))
+
+        # queries don't persist the base incard
+        incard = format_rule_incard(rule, cartridge, all_incards, all_tapes, store=False)
     elif payload.cartridge_id is not None:
 
         cartridge = Cartridge.get(lambda c: c.id == payload.cartridge_id)
@@ -1080,14 +1283,13 @@ def format_in_card(payload: FormatInCardPayload) -> bool:
             add_output(msg)
             return False
 
-        if cartridge.tapes is not None and len(cartridge.tapes) > 0:
-            all_tapes.extend(cartridge.tapes)
         if payload.tapes is not None and len(payload.tapes) > 0:
             all_tapes.extend(payload.tapes)
 
         if payload.in_card is not None and len(payload.in_card) > 0:
             all_incards.append(hex2bytes(payload.in_card))
 
+        incard = format_cartridge_incard(cartridge, all_incards, all_tapes, store=False)
     else:
         if payload.tapes is not None and len(payload.tapes) > 0:
             all_tapes.extend(payload.tapes)
@@ -1095,7 +1297,7 @@ def format_in_card(payload: FormatInCardPayload) -> bool:
         if payload.in_card is not None and len(payload.in_card) > 0:
             all_incards.append(hex2bytes(payload.in_card))
 
-    incard = format_incard(all_tapes, all_incards)
+        incard = format_incard(all_tapes, all_incards)
 
     LOGGER.info(f"Returning formatted in card with len {len(incard)}")
     add_output(incard)
@@ -4,13 +4,12 @@ import json
 from web3 import Web3
 import redis
 import time
+import threading
 from typing import Optional, List, Generator
 from multiprocessing import Manager
 import logging
 from pydantic import BaseModel
-from py_expression_eval import Parser
 from enum import Enum
-import tempfile
 import traceback
 # from dotenv import load_dotenv
 
@@ -21,11 +20,16 @@ from cartesapp.utils import hex2bytes, str2bytes, bytes2hex, bytes2str
 if os.path.isdir('../core'):
     sys.path.append("..")
 
-from core.model import Bytes32List, format_bytes_list_to_incard, BoolList
+from core.model import Bytes32List, BoolList, IncardCache, format_tape_ids, \
+    extend_base_incard
 from core.admin import SetOperatorPayload
 from core.cartridge import InsertCartridgePayload, RemoveCartridgePayload, SetUnlockedCartridgePayload
-from core.tape import VerifyPayload, RulePayload, ExternalVerificationPayload, ErrorCode, DeactivateRulePayload
-from core.riv import verify_log, riv_get_cartridge_info
+from core.tape import VerifyPayload, RulePayload, ExternalVerificationPayload, ErrorCode, DeactivateRulePayload, \
+    SetRuleBudgetPayload
+from core import mics
+from core.riv import verify_log, verify_many, riv_get_cartridge_info, RivemuBudgetError
+from core.replay_cache import cached_verify_log
+from core.score import evaluate_score
 from core.core_settings import CoreSettings, generate_entropy, generate_rule_id, \
     generate_tape_id, generate_cartridge_id, generate_cartridge_id as core_generate_cartridge_id, \
     format_rule_id_from_bytes, format_cartridge_id_from_bytes, format_tape_id_from_bytes
@@ -61,6 +65,8 @@ TEST_TAPE_PATH = os.getenv('TEST_TAPE_PATH') or '../misc/test.rivlog'
 GENESIS_CARTRIDGES_PATH = os.getenv('GENESIS_CARTRIDGES_PATH') or '../misc'
 GENESIS_CARTRIDGES = os.getenv('GENESIS_CARTRIDGES')
 VERIFICATIONS_BATCH_SIZE = os.getenv('VERIFICATIONS_BATCH_SIZE') or 10
+EMULATOR_POOL_SIZE = int(os.getenv('EMULATOR_POOL_SIZE') or 0)
+EMULATOR_TIMEOUT = float(os.getenv('EMULATOR_TIMEOUT') or 0) # default time budget (seconds) for rules without one
 
 # consts
 REDIS_VERIFY_QUEUE_KEY = f"rives_verify_queue_{RIVES_VERSION}"
@@ -72,6 +78,7 @@ REDIS_CARTRIDGE_NAMES_MAP_KEY = f"rives_cartridge_names_id_map_{RIVES_VERSION}"
 REDIS_CARTRIDGE_VERSIONS_KEY = f"rives_cartridge_versions_{RIVES_VERSION}"
 REDIS_TAPES_KEY = f"rives_tapes_{RIVES_VERSION}"
 REDIS_RULES_KEY = f"rives_rules_{RIVES_VERSION}"
+REDIS_RULE_INCARDS_KEY = f"rives_rule_incards_{RIVES_VERSION}"
 REDIS_VERIFY_OUTPUT_QUEUE_KEY = f"rives_verify_output_queue_{RIVES_VERSION}"
 REDIS_VERIFY_OUTPUT_TEMP_QUEUE_KEY = f"rives_verify_output_temp_queue_{RIVES_VERSION}"
 REDIS_ERROR_VERIFICATION_KEY = f"rives_error_verification_{RIVES_VERSION}"
@@ -94,6 +101,7 @@ class InputType(str, Enum):
     remove_cartridge = "remove_cartridge"
     set_operator = "set_operator"
     deactivate_rule = "deactivate_rule"
+    set_rule_budget = "set_rule_budget"
     unknown = "unknown"
     error = "error"
     none = "none"
@@ -113,6 +121,8 @@ class Rule(BaseModel):
     allow_in_card:      bool
     save_tapes:         bool
     save_out_cards:     bool
+    max_frames:         Optional[int]
+    max_time:           Optional[int]
 
 class ExtendedVerifyPayload(BaseModel):
     rule_id:        abi.Bytes32
@@ -146,6 +156,12 @@ class ExtendedDeactivateRulePayload(BaseModel):
     rule_id:                abi.Bytes32
     sender:                 abi.Address
 
+class ExtendedSetRuleBudgetPayload(BaseModel):
+    rule_id:                abi.Bytes32
+    max_frames:             abi.UInt
+    max_time:               abi.UInt
+    sender:                 abi.Address
+
 class ExternalVerificationOutput(BaseModel):
     tape_id:            str
     score:              int
@@ -191,6 +207,10 @@ class HashMap:
         if cls.db.get(k1) is None: return None
         return cls.db[k1].get(k2)
     @classmethod
+    def hmget(cls,k1,k2s):
+        if cls.db.get(k1) is None: return [None for _ in k2s]
+        return [cls.db[k1].get(k2) for k2 in k2s]
+    @classmethod
     def hexists(cls,k1,k2):
         return cls.db.get(k1) is not None and cls.db[k1].get(k2)
     @classmethod
@@ -343,10 +363,28 @@ class Storage:
             })
             cls.store.hset(REDIS_RULES_KEY,rule_id,json.dumps(rule_dict))
 
+    @classmethod
+    def update_rule(cls,rule_id,rule):
+        rule_dict = rule.dict()
+        rule_dict.update({
+            "in_card":rule.in_card.hex(),
+            "tapes":[t.hex() for t in rule.tapes]
+        })
+        cls.store.hset(REDIS_RULES_KEY,rule_id,json.dumps(rule_dict))
+
     @classmethod
     def remove_rule(cls,rule_id: str) -> bytes:
+        cls.store.hdel(REDIS_RULE_INCARDS_KEY,rule_id)
         return cls.store.hdel(REDIS_RULES_KEY,rule_id)
 
+    @classmethod
+    def set_rule_incard(cls,rule_id: str,incard: bytes):
+        cls.store.hset(REDIS_RULE_INCARDS_KEY,rule_id,incard)
+
+    @classmethod
+    def get_rule_incard(cls,rule_id: str) -> bytes:
+        return cls.store.hget(REDIS_RULE_INCARDS_KEY,rule_id)
+
     # @classmethod
     # def exist_cartridge(cls,cartridge_id):
     #     return cls.store.hexists(REDIS_CARTRIDGES_KEY,cartridge_id)
@@ -360,6 +398,11 @@ class Storage:
     def get_tape(cls,tape_id: str) -> bytes:
         return cls.store.hget(REDIS_TAPES_KEY,tape_id)
 
+    @classmethod
+    def get_tapes(cls,tape_ids: List[str]) -> List[bytes]:
+        if len(tape_ids) == 0: return []
+        return cls.store.hmget(REDIS_TAPES_KEY,tape_ids)
+
     @classmethod
     def push_verification(cls,data):
         return cls.store.lpush(REDIS_VERIFY_QUEUE_KEY, data)
@@ -397,6 +440,26 @@ class Storage:
         return cls.store.lrem(REDIS_VERIFY_OUTPUT_TEMP_QUEUE_KEY,1,serialized_data)
 
 
+class EmulatorPool:
+    """Bounds the number of emulator runs at the same time, each run is its own rivemu process"""
+    slots = None
+    def __new__(cls, max_workers = EMULATOR_POOL_SIZE):
+        if cls.slots is None and max_workers > 0:
+            cls.slots = threading.BoundedSemaphore(max_workers)
+        return cls
+
+    @classmethod
+    def verify_log(cls, *args, **kwargs) -> dict[str,bytes]:
+        if cls.slots is None:
+            return verify_log(*args, **kwargs)
+        with cls.slots:
+            return verify_log(*args, **kwargs)
+
+    @classmethod
+    def close(cls):
+        cls.slots = None
+
+
 def deserialize_verification(serialized_data: bytes) -> ExtendedVerifyPayload:
     return abi.decode_to_model(data=serialized_data, model=ExtendedVerifyPayload)
 
@@ -410,7 +473,8 @@ def riv_verification(cartridge_data:bytes,args:str,in_card:bytes):
     with open(TEST_TAPE_PATH,'rb') as test_replay_file:
         test_replay = test_replay_file.read()
     try:
-        verification_output = verify_log(cartridge_data,test_replay,args,in_card)
+        verification_output = cached_verify_log(cartridge_data,test_replay,args,in_card,
+                                                verify_function=EmulatorPool.verify_log)
     except Exception as e:
         LOGGER.warning(e)
         traceback.print_exc()
@@ -442,15 +506,15 @@ def rule_verification(cartridge_data:bytes, rule: Rule, formatted_in_card: bytes
             return None
 
         try:
-            parser = Parser()
-            score = parser.parse(rule.score_function).evaluate(outcard_json)
+            score = evaluate_score(rule.score_function,outcard_json)
         except Exception as e:
             LOGGER.error(f"Couldn't parse score: {e}")
             return None
 
     return rule
 
-def tape_verification(payload: ExtendedVerifyPayload) -> ExternalVerificationOutput:
+def prepare_tape_verification(payload: ExtendedVerifyPayload) -> dict | None:
+    # returns the emulator job for the tape, or the output when it is rejected before running
     sender = payload.sender
     timestamp = payload.timestamp
     input_index = payload.input_index
@@ -510,30 +574,49 @@ def tape_verification(payload: ExtendedVerifyPayload) -> ExternalVerificationOut
     LOGGER.info(f"Verifying tape...")
     try:
 
-        cartridge_info_json = Storage.get_cartridge_info(cartridge_id)
-
-        all_tapes = []
-        cartridge_tapes = cartridge_info_json.get("tapes")
-        if cartridge_tapes is not None and len(cartridge_tapes) > 0:
-            all_tapes.extend(cartridge_tapes)
-        if rule.tapes is not None and len(rule.tapes) > 0:
-            all_tapes.extend(map(lambda x: format_tape_id_from_bytes(x), rule.tapes))
+        payload_tapes = []
         if rule.allow_tapes and len(payload.tapes) > 0:
-            all_tapes.extend(map(lambda x: format_tape_id_from_bytes(x), payload.tapes))
+            payload_tapes.extend(map(lambda x: format_tape_id_from_bytes(x), payload.tapes))
 
-        all_incards = []
-        if rule.in_card is not None and len(rule.in_card) > 0:
-            all_incards.append(rule.in_card)
+        payload_incards = []
         if rule.allow_in_card and len(payload.in_card) > 0:
-           all_incards.append(payload.in_card)
-        incard = format_incard(all_tapes, all_incards)
+           payload_incards.append(payload.in_card)
 
-        verification_output = verify_log(cartridge_data,payload.tape,rule.args,incard,entropy=entropy)
+        n_head = 1 if rule.in_card is not None and len(rule.in_card) > 0 else 0
+        incard = extend_base_incard(get_rule_base_incard(payload_rule,rule),n_head,payload_incards,
+                                    format_tapes_to_byte_list(payload_tapes))
     except Exception as e:
         msg = f"Couldn't verify tape: {e}"
         LOGGER.error(msg)
         Storage.add_error(input_index,msg)
         out_params["error_code"] = ErrorCode.VERIFICATION_ERROR.value
+        return {"output": ExternalVerificationOutput.parse_obj(out_params)}
+
+    job = {
+        "cartridge": cartridge_data,
+        "cartridge_id": cartridge_id,
+        "log": payload.tape,
+        "riv_args": rule.args,
+        "in_card": incard,
+        "entropy": entropy,
+        "max_frames": rule.max_frames or None,
+        "timeout": rule.max_time or EMULATOR_TIMEOUT or None,
+        "rule_id": format_rule_id_from_bytes(payload.rule_id),
+    }
+    return {"rule": rule, "out_params": out_params, "job": job}
+
+def finish_tape_verification(payload: ExtendedVerifyPayload, verification: dict, verification_output: dict | None,
+                             verification_error: str | None = None, budget_exceeded: bool = False) -> ExternalVerificationOutput:
+    input_index = payload.input_index
+    rule = verification['rule']
+    out_params = verification['out_params']
+    tape_id = out_params['tape_id']
+
+    if verification_error is not None:
+        msg = f"Couldn't verify tape: {verification_error}"
+        LOGGER.error(msg)
+        Storage.add_error(input_index,msg)
+        out_params["error_code"] = ErrorCode.BUDGET_EXCEEDED.value if budget_exceeded else ErrorCode.VERIFICATION_ERROR.value
         return ExternalVerificationOutput.parse_obj(out_params)
 
     outcard_raw = verification_output.get('outcard')
@@ -558,8 +641,7 @@ def tape_verification(payload: ExtendedVerifyPayload) -> ExternalVerificationOut
     if rule.score_function is not None and len(rule.score_function) > 0 and outcard_format == b"JSON":
         try:
             outcard_json = json.loads(bytes2str(outcard_raw[4:]))
-            parser = Parser()
-            score = parser.parse(rule.score_function).evaluate(outcard_json)
+            score = evaluate_score(rule.score_function,outcard_json)
         except Exception as e:
             msg = f"Couldn't load/parse score from json: {e}"
             LOGGER.error(msg)
@@ -586,6 +668,34 @@ def tape_verification(payload: ExtendedVerifyPayload) -> ExternalVerificationOut
     Storage.add_tape(tape_id,outcard_raw)
     return ExternalVerificationOutput.parse_obj(out_params)
 
+def tape_verification(payload: ExtendedVerifyPayload) -> ExternalVerificationOutput:
+    verification = prepare_tape_verification(payload)
+    if verification is None: return None
+    if verification.get("output") is not None: return verification["output"]
+
+    job = verification['job']
+    try:
+        verification_output = EmulatorPool.verify_log(job['cartridge'],job['log'],job['riv_args'],job['in_card'],
+                                                      entropy=job['entropy'],max_frames=job['max_frames'],timeout=job['timeout'],
+                                                      rule_id=job['rule_id'])
+    except RivemuBudgetError as e:
+        return finish_tape_verification(payload,verification,None,str(e),budget_exceeded=True)
+    except Exception as e:
+        return finish_tape_verification(payload,verification,None,str(e))
+    return finish_tape_verification(payload,verification,verification_output)
+
+def tape_verifications(payloads: List[ExtendedVerifyPayload], max_workers: int = 1) -> List[ExternalVerificationOutput]:
+    # verifies a batch of tapes, grouping the emulator runs by cartridge
+    verifications = [prepare_tape_verification(payload) for payload in payloads]
+    outs = [v.get("output") if v is not None else None for v in verifications]
+
+    pending = [i for i,v in enumerate(verifications) if v is not None and v.get("output") is None]
+    verify_function = EmulatorPool.verify_log if EmulatorPool.slots is not None else None
+    results = verify_many([verifications[i]['job'] for i in pending],max_workers,verify_function)
+    for i,result in zip(pending,results):
+        outs[i] = finish_tape_verification(payloads[i],verifications[i],result['outputs'],result['error'],result['budget_exceeded'])
+    return outs
+
 class VerificationSender:
     input_box_abi = []
     w3 = None
@@ -718,6 +828,13 @@ class InputFinder:
         )
         self.deactivate_rule_header = deactivate_rule_header.to_bytes()
 
+        set_rule_budget_abi_types = abi.get_abi_types_from_model(SetRuleBudgetPayload)
+        set_rule_budget_header = ABIFunctionSelectorHeader(
+            function=f"core.set_rule_budget",
+            argument_types=set_rule_budget_abi_types
+        )
+        self.set_rule_budget_header = set_rule_budget_header.to_bytes()
+
         # TODO: check for normal verification to process and store the outcard without sending the results
 
         self.timeout = timeout
@@ -856,6 +973,15 @@ class InputFinder:
                         extended_payload.rule_id = format_rule_id_from_bytes(extended_payload.rule_id)
                     
                         yield InputData(type=InputType.deactivate_rule,data=extended_payload,last_input_block=last_input_block)
+                    elif header == self.set_rule_budget_header:
+                        # LOGGER.info(f"set rule budget entry")
+                        payload_dict = abi.decode_to_model(data=input_payload, model=SetRuleBudgetPayload).dict()
+                        payload_dict['sender'] = sender
+
+                        extended_payload = ExtendedSetRuleBudgetPayload.parse_obj(payload_dict)
+                        extended_payload.rule_id = format_rule_id_from_bytes(extended_payload.rule_id)
+
+                        yield InputData(type=InputType.set_rule_budget,data=extended_payload,last_input_block=last_input_block)
                     else:
                         # LOGGER.info(f"non processed entry")
                         yield InputData(type=InputType.unknown,data=None,last_input_block=last_input_block)
@@ -931,6 +1057,8 @@ def initialize_storage_with_genesis_data():
                     "allow_in_card": False,
                     "save_tapes": False,
                     "save_out_cards": False,
+                    "max_frames": int(CoreSettings().genesis_rules[genesis_rule_cartridge].get("max_frames") or 0),
+                    "max_time": int(CoreSettings().genesis_rules[genesis_rule_cartridge].get("max_time") or 0),
                 }
                 rule = Rule.parse_obj(rule_conf_dict)
                 add_rule(rule)
@@ -950,6 +1078,17 @@ def verify_payload(payload: ExtendedVerifyPayload) -> bool:
 
     return status
 
+def verify_payloads(payloads: List[ExtendedVerifyPayload], max_workers: int = 1) -> List[bool]:
+    all_status = []
+    for out in tape_verifications(payloads,max_workers):
+        status = False
+        if out is not None:
+            Storage.push_output(out.json())
+            status = True
+        all_status.append(status)
+
+    return all_status
+
 def add_locked_cartridge(cartridge_id: str,cartridge_data: bytes, sender: str):
 
     if Storage.get_cartridge_locked_data(cartridge_id) is not None:
@@ -1004,15 +1143,7 @@ def add_cartridge(cartridge_id: str,cartridge_data: bytes, sender: str):
             LOGGER.warning(f"Sender not allowed")
             return
 
-    cartridge_temp = tempfile.NamedTemporaryFile()
-    cartridge_file = cartridge_temp.file
-
-    cartridge_file.write(cartridge_data)
-    cartridge_file.flush()
-
-    cartridge_info = riv_get_cartridge_info(cartridge_temp.name)
-    
-    cartridge_temp.close()
+    cartridge_info = riv_get_cartridge_info(cartridge_data,cartridge_id)
 
     # process in card
     cartridge_info_json = json.loads(cartridge_info)
@@ -1118,14 +1249,7 @@ def add_rule(rule: Rule):
     
 
     # process in card
-    cartridge_info_json = Storage.get_cartridge_info(cartridge_id)
-
-    all_tapes = []
-    cartridge_tapes = cartridge_info_json.get("tapes")
-    if cartridge_tapes is not None and len(cartridge_tapes) > 0:
-        all_tapes.extend(cartridge_tapes)
-    all_tapes.extend(map(lambda x: format_tape_id_from_bytes(x), rule.tapes))
-    in_card = format_incard(all_tapes, [rule.in_card])
+    in_card = extend_base_incard(get_rule_base_incard(rule_id,rule,store=False),0,[],[])
 
     out = rule_verification(cartridge_data,rule,in_card)
     if out is not None:
@@ -1156,6 +1280,20 @@ def deactivate_rule(rule_id: str, sender:str):
     
     Storage.remove_rule(rule_id)
 
+def set_rule_budget(rule_id: str, max_frames: int, max_time: int, sender:str):
+    rule = Storage.get_rule(rule_id)
+    if rule is None:
+        LOGGER.warning(f"Couldn't find rule")
+        return
+
+    if sender != rule.sender and sender != Storage.get_operator_address():
+        LOGGER.warning(f"Sender not allowed")
+        return
+
+    rule.max_frames = max_frames if max_frames > 0 else None
+    rule.max_time = max_time if max_time > 0 else None
+    Storage.update_rule(rule_id,rule)
+
 def push_verification(extended_verification: ExtendedVerifyPayload):
     Storage.push_verification(abi.encode_model(extended_verification))
 
@@ -1167,21 +1305,43 @@ def _normalize_hex(orig: str) -> str:
         result = result[2:]
     return result
 
+incard_cache = IncardCache()
+
 def format_incard(tape_ids: List[str],incards: List[bytes]) -> bytes:
+    tape_ids = list(tape_ids)
+    key = IncardCache.make_key(tape_ids,incards)
+    incard = incard_cache.get(key)
+    if incard is not None: return incard
+
     incard_data_list = []
     for incard in incards:
         if len(incard) > 0: incard_data_list.append(incard)
-    incard_data_list.extend(format_tapes_to_byte_list(tape_ids))
-    return format_bytes_list_to_incard(incard_data_list)
-    
+    tapes_data_list = format_tapes_to_byte_list(tape_ids)
+    incard_data_list.extend(tapes_data_list)
+    incard = mics.encode(incard_data_list)
+    # stored out cards never change, but a missing tape may be added by another verifier
+    if len(tapes_data_list) == len(tape_ids): incard_cache.put(key,incard)
+    return incard
+
+def get_rule_base_incard(rule_id: str, rule: Rule, store: bool = True) -> bytes:
+    # rule incard and cartridge and rule tape out cards, see core.model.extend_base_incard
+    base = Storage.get_rule_incard(rule_id)
+    if base is not None: return base
+
+    tape_ids = []
+    cartridge_tapes = Storage.get_cartridge_info(_normalize_hex(rule.cartridge_id)).get("tapes")
+    if cartridge_tapes is not None and len(cartridge_tapes) > 0:
+        tape_ids.extend(cartridge_tapes)
+    if rule.tapes is not None and len(rule.tapes) > 0:
+        tape_ids.extend(map(lambda x: format_tape_id_from_bytes(x), rule.tapes))
+    outcards = format_tapes_to_byte_list(tape_ids)
+    base = extend_base_incard(b'',0,[rule.in_card or b''],outcards,container=True)
+    if store and len(outcards) == len(tape_ids): Storage.set_rule_incard(rule_id,base)
+    return base
+
 def format_tapes_to_byte_list(tape_ids: List[str]) -> List[bytes]:
     tapes_data_list = []
-    for t in tape_ids:
-        tape_id = t[2:] if t.startswith('0x') else t
-        outcard = Storage.get_tape(tape_id)
+    for outcard in Storage.get_tapes(format_tape_ids(tape_ids)):
         if outcard is None or len(outcard) == 0: continue
         tapes_data_list.append(outcard)
-        # outcard = TapeHash.get_outcard(tape_id)
-        # if outcard is None or len(outcard) == 0: continue
-        # tapes_data_list.append(outcard)
     return tapes_data_list
@@ -2,15 +2,16 @@ import sys
 import time
 import typer
 from typing import Optional, List, Annotated
-from multiprocessing import Process, Pool, Manager, Event
+from multiprocessing import Process, Manager, Event
 import logging
 import math
 import traceback
 
 from common import ExtendedVerifyPayload, Storage, Rule, DbType, VerificationSender, InputFinder, InputType, \
     initialize_storage_with_genesis_data, add_cartridge, remove_cartridge, add_rule, set_operator, push_verification, \
-    add_locked_cartridge, set_unlocked_cartridges, verify_payload, deserialize_verification, deserialize_output, \
-    deactivate_rule, generate_cartridge_id, VERIFICATIONS_BATCH_SIZE
+    add_locked_cartridge, set_unlocked_cartridges, verify_payloads, deserialize_verification, deserialize_output, \
+    deactivate_rule, set_rule_budget, generate_cartridge_id, EmulatorPool, VERIFICATIONS_BATCH_SIZE, EMULATOR_POOL_SIZE
+from core.riv_stats import get_emulator_stats
 
 
 LOGGER = logging.getLogger("external_verifier")
@@ -66,6 +67,9 @@ class Enqueuer(Process):
             elif new_input.type == InputType.deactivate_rule:
                 LOGGER.info(f"deactivate rule entry")
                 deactivate_rule(new_input.data.rule_id,new_input.data.sender)
+            elif new_input.type == InputType.set_rule_budget:
+                LOGGER.info(f"set rule budget entry")
+                set_rule_budget(new_input.data.rule_id,new_input.data.max_frames,new_input.data.max_time,new_input.data.sender)
             elif new_input.type == InputType.rule:
                 LOGGER.info(f"new rule entry")
                 rule: Rule = new_input.data
@@ -79,10 +83,6 @@ class Enqueuer(Process):
 
             Storage.set_processed_block(new_input.last_input_block)
 
-def deserialize_and_verify(data: bytes):
-    verify_payload(deserialize_verification(data))
-    Storage.remove_processing_verification(data)
-
 class Verifier(Process):
     timeout = None
     pool_size = None
@@ -95,6 +95,15 @@ class Verifier(Process):
         self.cancel_event = cancel_event
 
     def run(self):
+        # with the emulator pool the emulator runs of all verifications are bounded by its size
+        if EMULATOR_POOL_SIZE > 0:
+            EmulatorPool(EMULATOR_POOL_SIZE)
+        try:
+            self.verify_batches()
+        finally:
+            EmulatorPool.close()
+
+    def verify_batches(self):
         while True:
             if self.cancel_event.is_set(): break
             try:
@@ -110,11 +119,13 @@ class Verifier(Process):
                         all_data.append(data)
                 if len(all_data) > 0:
                     LOGGER.info(f"verifiying {len(all_data)} tapes")
-                    with Pool(len(all_data)) as pool:
-                        # result = pool.map_async(verify_payload, all_data)
-                        # result.wait()
-                        all_status = pool.map(deserialize_and_verify,all_data)
-                        LOGGER.info(f"batch processing status {all_status}")
+                    # emulator runs are grouped by cartridge and run in parallel threads
+                    all_status = verify_payloads([deserialize_verification(data) for data in all_data],len(all_data))
+                    LOGGER.info(f"batch processing status {all_status}")
+                    for data in all_data:
+                        Storage.remove_processing_verification(data)
+                    get_emulator_stats().log_report("cartridge")
+                    get_emulator_stats().log_report("rule")
             except Exception as e:
                 LOGGER.error(e)
                 traceback.print_exc()
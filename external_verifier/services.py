@@ -1,7 +1,7 @@
 
 import re
 import pickle
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel, validator
 from dagster import sensor, op, job, define_asset_job, asset, run_status_sensor, asset_sensor, multi_asset_sensor,\
     RunRequest, Config, RunConfig, SensorEvaluationContext, SkipReason, OpExecutionContext, AssetExecutionContext, \
@@ -14,7 +14,7 @@ from cartesapp.utils import hex2bytes, str2bytes, bytes2hex, bytes2str
 
 from common import ExtendedVerifyPayload, Storage, Rule, DbType, VerificationSender, InputFinder, InputType, ExternalVerificationOutput, \
     tape_verification, add_cartridge, remove_cartridge, set_operator, add_rule, initialize_storage_with_genesis_data, generate_cartridge_id, \
-    set_unlocked_cartridges, add_locked_cartridge, deactivate_rule, VERIFICATIONS_BATCH_SIZE
+    set_unlocked_cartridges, add_locked_cartridge, deactivate_rule, set_rule_budget, VERIFICATIONS_BATCH_SIZE
 
 
 ###
@@ -46,6 +46,8 @@ class RuleConfig(Config):
     allow_in_card:      bool
     save_tapes:         bool
     save_out_cards:     bool
+    max_frames:         Optional[int]
+    max_time:           Optional[int]
 
 class CartridgeConfig(Config):
     id:                 str
@@ -69,6 +71,12 @@ class DeactivateRuleConfig(Config):
     rule_id:                str
     sender:                 str
 
+class SetRuleBudgetConfig(Config):
+    rule_id:                str
+    max_frames:             int
+    max_time:               int
+    sender:                 str
+
 class ExternalVerificationOutputsConfig(Config):
     outputs: str
 
@@ -110,6 +118,7 @@ set_cartridge_unlocks_input_partition = DynamicPartitionsDefinition(name="cartri
 remove_cartridges_input_partition = DynamicPartitionsDefinition(name="remove_cartridges")
 set_operators_input_partition = DynamicPartitionsDefinition(name="set_operators")
 deactivate_rules_input_partition = DynamicPartitionsDefinition(name="deactivate_rules")
+set_rule_budgets_input_partition = DynamicPartitionsDefinition(name="set_rule_budgets")
 
 
 @asset(partitions_def=inputs_partition,key=["verify_input"])
@@ -234,6 +243,19 @@ deactivate_rule_job = define_asset_job(
     partitions_def=deactivate_rules_input_partition
 )
 
+@asset(partitions_def=set_rule_budgets_input_partition, key=["set_rule_budget"])
+def set_rule_budget_asset(context: OpExecutionContext, config: SetRuleBudgetConfig):
+    context.log.info(f"Setting budget of rule {config.rule_id}")
+
+    set_rule_budget(config.rule_id, config.max_frames, config.max_time, config.sender)
+    context.log.info(f"rule {config.rule_id} budget set")
+
+set_rule_budget_job = define_asset_job(
+    name="set_rule_budget_job",
+    selection=AssetSelection.assets(set_rule_budget_asset),
+    partitions_def=set_rule_budgets_input_partition
+)
+
 
 @op
 def submit_verification_op(context: OpExecutionContext, config: ExternalVerificationOutputsConfig):
@@ -281,7 +303,7 @@ def initialization_sensor(context: SensorEvaluationContext):
     )
     context.update_cursor(run_key)
 
-@sensor(jobs=[verify_asset_job,add_cartridge_job,add_rule_job,remove_cartridge_job,set_operator_job,set_cartridge_unlocks_job,deactivate_rule_job])
+@sensor(jobs=[verify_asset_job,add_cartridge_job,add_rule_job,remove_cartridge_job,set_operator_job,set_cartridge_unlocks_job,deactivate_rule_job,set_rule_budget_job])
 def inputs_sensor(context: SensorEvaluationContext):
     cursor = context.cursor or None
     if cursor is not None: cursor = int(cursor) + 1
@@ -299,6 +321,7 @@ def inputs_sensor(context: SensorEvaluationContext):
     remove_cartridges_partition_keys = []
     set_operators_partition_keys = []
     deactivate_rules_partition_keys = []
+    set_rule_budgets_partition_keys = []
 
 
     blocks = []
@@ -392,6 +415,19 @@ def inputs_sensor(context: SensorEvaluationContext):
                     ops={"deactivate_rule":DeactivateRuleConfig(**{"rule_id":rule_id,"sender":new_input.data.sender}),}
                 )
             ))
+        elif new_input.type == InputType.set_rule_budget:
+            context.log.info(f"set rule budget entry")
+            rule_id = new_input.data.rule_id
+            key = f"set_rule_budget_{rule_id}_{new_input.last_input_block}"
+            set_rule_budgets_partition_keys.append(key)
+            run_requests.append(RunRequest(
+                job_name="set_rule_budget_job",
+                partition_key=key,
+                run_config=RunConfig(
+                    ops={"set_rule_budget":SetRuleBudgetConfig(**{"rule_id":rule_id,"max_frames":new_input.data.max_frames,
+                        "max_time":new_input.data.max_time,"sender":new_input.data.sender}),}
+                )
+            ))
         elif new_input.type == InputType.rule:
             context.log.info(f"new rule entry")
             rule: Rule = new_input.data
@@ -483,6 +519,11 @@ def inputs_sensor(context: SensorEvaluationContext):
             deactivate_rules_input_partition.build_add_request(deactivate_rules_partition_keys)
         )
 
+    if set_rule_budgets_partition_keys:
+        dynamic_partition_requests.append(
+            set_rule_budgets_input_partition.build_add_request(set_rule_budgets_partition_keys)
+        )
+
     return SensorResult(
         run_requests=run_requests,
         dynamic_partitions_requests=dynamic_partition_requests,
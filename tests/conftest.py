@@ -0,0 +1,54 @@
+"""
+Shared fixtures of the emulator tests.
+"""
+import os
+import sys
+
+import pytest
+
+
+###
+# Stand-in emulator
+
+CARTRIDGE_PATH = os.path.abspath("misc/snake.sqfs")
+
+# each log byte is a frame, the outputs derive from the frames that ran and all the other inputs
+FAKE_RIVEMU = '''#!{python}
+import os, sys, time, signal
+from hashlib import sha256
+args = dict(a[1:].split('=', 1) if '=' in a else (a[1:], '') for a in sys.argv[1:])
+log = open(args['verify'], 'rb').read()
+if log == b'fail':
+    sys.stderr.write('invalid log')
+    sys.exit(1)
+if log == b'sleep':
+    time.sleep(30)
+if log == b'killed':
+    os.kill(os.getpid(), signal.SIGKILL)
+frames = len(log) if 'stop-frame' not in args else min(len(log), int(args['stop-frame']))
+if log != b'quiet':
+    sys.stderr.write('[RIVEMU] frame %d\\n' % frames)
+incard = open(args['load-incard'], 'rb').read() if 'load-incard' in args else b''
+h = sha256(open(args['cartridge'], 'rb').read())
+for v in [log[:frames], incard, args.get('args', '').encode(), args.get('entropy', '').encode()]:
+    h.update(sha256(v).digest())
+open(args['save-outcard'], 'wb').write(b'card' + h.digest())
+open(args['save-outhash'], 'w').write(h.hexdigest())
+if 'save-outhist' in args:
+    open(args['save-outhist'], 'wb').write(b'hist' + h.digest())
+if 'save-screenshot' in args:
+    open(args['save-screenshot'], 'wb').write(b'png' + h.digest())
+'''
+
+@pytest.fixture()
+def rivemu(tmp_path, monkeypatch) -> str:
+    from core.core_settings import CoreSettings
+    from core.riv import invalidate_emulator_resolutions
+
+    path = tmp_path / "rivemu"
+    path.write_text(FAKE_RIVEMU.format(python=sys.executable))
+    path.chmod(0o755)
+    monkeypatch.setattr(CoreSettings(), 'rivemu_path', str(path))
+    invalidate_emulator_resolutions()
+    yield str(path)
+    invalidate_emulator_resolutions()
@@ -3,6 +3,9 @@ Acceptance tests for the application requirements.
 """
 import json
 import os
+import base64
+import sqlite3
+from urllib.parse import quote
 
 import pytest
 
@@ -11,11 +14,21 @@ from cartesi.abi import encode_model, get_abi_types_from_model, decode_to_model
 from cartesi.models import ABIFunctionSelectorHeader
 
 from cartesapp.manager import Manager
+from cartesapp.storage import helpers
 from cartesapp.utils import hex2bytes, str2bytes
 
 from core.core_settings import generate_cartridge_id, generate_rule_id
-from core.cartridge import InserCartridgePayload, CartridgeInfo, CartridgesOutput, RemoveCartridgePayload
-from core.tape import VerifyPayload, VerificationOutput, RulePayload
+from core.cartridge import InserCartridgePayload, CartridgeInfo, CartridgesOutput, CartridgeFieldsOutput, RemoveCartridgePayload
+from core.tape import VerifyPayload, VerificationOutput, RulePayload, SetRuleBudgetPayload, AwardWinnerTapesPayload, TapesOutput, \
+    TapeFieldsOutput, RuleFieldsOutput, RulesOutput, RuleTagsOutput
+from core.pagination import parse_order, keyset_page, encode_cursor
+from core.projection import parse_fields, field_columns, select_columns, column_rows, project
+from core.leaderboard import get_leaderboards, get_leaderboard
+from core.model import Rule, Tape, Cartridge, CartridgeCover, migrate_legacy_covers, ADDED_COLUMNS, add_missing_columns, added_columns, backfill_added_columns, \
+    incard_cache, format_incard, format_bytes_list_to_incard, invalidate_incards, has_uncommitted_changes, \
+    reference_incard_tapes, RuleTag, get_rule_tag_index, filter_rules_by_tags, filter_tapes_by_tags, \
+    get_name_index, name_candidates
+import core.model as model
 
 import logging
 logger = logging.getLogger(__name__)
@@ -104,7 +117,7 @@ def test_should_fail_insert_cartridge_error_data(
     report = bytes.fromhex(report[2:])
     report = report.decode('utf-8')
 
-    assert report.startswith("Couldn't insert cartridge: Error getting info: FATAL ERROR: Can't find a valid SQUASHFS superblock")
+    assert report.startswith("Couldn't insert cartridge: Error getting info: Can't find a valid SQUASHFS superblock")
 
 
 @pytest.fixture()
@@ -522,6 +535,583 @@ def test_should_pass_verify_cartridge2(
 # TODO: test tape verification non-standard rule correct
 # TODO: test tape verification out of dates
 
+def send_set_rule_budget(dapp_client: TestClient, rule_id: str, max_frames: int, max_time: int, msg_sender: str):
+    header = ABIFunctionSelectorHeader(
+        function="core.set_rule_budget",
+        argument_types=get_abi_types_from_model(SetRuleBudgetPayload)
+    ).to_bytes()
+
+    model = SetRuleBudgetPayload(rule_id=hex2bytes(rule_id), max_frames=max_frames, max_time=max_time)
+    hex_payload = '0x' + (header + encode_model(model, packed=False)).hex()
+    dapp_client.send_advance(hex_payload=hex_payload, msg_sender=msg_sender)
+
+def test_rule_payload_should_keep_create_rule_abi():
+    # budgets are set with set_rule_budget, the create_rule payload is unchanged
+    assert 'max_frames' not in RulePayload.__fields__
+    assert 'max_time' not in RulePayload.__fields__
+
+@pytest.mark.order(after=["test_should_insert_cartridge1"])
+def test_should_fail_set_budget_unknown_rule(dapp_client: TestClient):
+    send_set_rule_budget(dapp_client, generate_rule_id(hex2bytes(CARTRIDGE1_ID),str2bytes('random name')), 100, 0,
+                         USER2_ADDRESS)
+
+    assert not dapp_client.rollup.status
+
+    report = dapp_client.rollup.reports[-1]['data']['payload']
+    report = bytes.fromhex(report[2:]).decode('utf-8')
+    assert report.startswith("rule") and report.endswith("doesn't exist")
+
+@pytest.mark.order(after=["test_should_pass_verify_cartridge2"])
+def test_should_set_rule_budget(dapp_client: TestClient):
+    rule_id = generate_rule_id(hex2bytes(CARTRIDGE2_ID),str2bytes('default'))
+
+    send_set_rule_budget(dapp_client, rule_id, 600, 10, USER2_ADDRESS)
+    assert dapp_client.rollup.status
+    with helpers.db_session:
+        rule = Rule[rule_id]
+        assert rule.max_frames == 600
+        assert rule.max_time == 10
+
+    # 0 removes the limits
+    send_set_rule_budget(dapp_client, rule_id, 0, 0, USER2_ADDRESS)
+    assert dapp_client.rollup.status
+    with helpers.db_session:
+        rule = Rule[rule_id]
+        assert rule.max_frames is None
+        assert rule.max_time is None
+
+def test_should_add_missing_columns(tmp_path):
+    # tables created before the columns existed
+    connection = sqlite3.connect(tmp_path / "old.sqlite")
+    for table in ADDED_COLUMNS:
+        connection.execute(f'CREATE TABLE "{table}" ("id" VARCHAR(64) NOT NULL PRIMARY KEY)')
+    add_missing_columns(None, connection)
+    add_missing_columns(None, connection)
+    for table, columns in ADDED_COLUMNS.items():
+        existing = [row[1] for row in connection.execute(f'PRAGMA table_info("{table}")')]
+        assert existing == ['id'] + list(columns.keys())
+
+def test_should_have_added_columns(dapp_client: TestClient):
+    with helpers.db_session:
+        connection = Rule._database_.get_connection()
+        for table, columns in ADDED_COLUMNS.items():
+            existing = [row[1] for row in connection.execute(f'PRAGMA table_info("{table}")')]
+            assert all(column in existing for column in columns)
+
+def backfill_columns(columns: list[tuple[str,str]]):
+    added_columns.update(columns)
+    try:
+        backfill_added_columns()
+    finally:
+        added_columns.clear()
+
+@pytest.mark.order(after="test_should_pass_verify_cartridge2")
+def test_should_backfill_rule_tag_names(dapp_client: TestClient):
+    rule_id = generate_rule_id(hex2bytes(CARTRIDGE2_ID),str2bytes('default'))
+    with helpers.db_session:
+        expected = sorted(Rule[rule_id].tag_names)
+        assert len(expected) > 0
+        # as it was before the column existed
+        Rule[rule_id].tag_names = []
+
+    backfill_columns([("Rule", "tag_names")])
+    with helpers.db_session:
+        assert sorted(Rule[rule_id].tag_names) == expected
+
+@pytest.mark.order(after="test_should_pass_verify_cartridge2")
+def test_should_backfill_activity_columns(dapp_client: TestClient):
+    rule_id = generate_rule_id(hex2bytes(CARTRIDGE2_ID),str2bytes('default'))
+    with helpers.db_session:
+        rule = Rule[rule_id]
+        cartridge = Cartridge[CARTRIDGE2_ID]
+        expected = (rule.n_tapes, rule.n_verified, rule.n_players, rule.best_score, cartridge.n_tapes)
+        assert rule.n_tapes > 0
+        tape = Tape.select(lambda t: t.rule_id == rule_id and t.verified).first()
+        # rows as they were before the columns existed
+        rule.n_tapes = rule.n_verified = rule.n_players = rule.best_score = None
+        cartridge.n_tapes = None
+        tape.error_code = None
+        tape_id = tape.id
+
+    backfill_columns([("Rule", "n_tapes"), ("Tape", "error_code")])
+    with helpers.db_session:
+        rule = Rule[rule_id]
+        assert (rule.n_tapes, rule.n_verified, rule.n_players, rule.best_score, Cartridge[CARTRIDGE2_ID].n_tapes) == expected
+        assert Tape[tape_id].error_code == 0
+
+@pytest.mark.order(after="test_should_pass_verify_cartridge2")
+def test_should_invalidate_base_incards_of_referenced_tapes(dapp_client: TestClient):
+    rule_id = generate_rule_id(hex2bytes(CARTRIDGE2_ID),str2bytes('default'))
+    other_rule_id = generate_rule_id(hex2bytes(CARTRIDGE1_ID),str2bytes('default'))
+    cartridge_tape_id = 'ab' * 32
+    rule_tape_id = '0x' + 'ef' * 32
+    with helpers.db_session:
+        reference_incard_tapes(Cartridge[CARTRIDGE2_ID], [cartridge_tape_id])
+        reference_incard_tapes(Rule[other_rule_id], [rule_tape_id])
+        for entity in (Cartridge[CARTRIDGE2_ID], Rule[rule_id], Rule[other_rule_id]):
+            entity.base_incard = b'base'
+
+    with helpers.db_session:
+        invalidate_incards([rule_tape_id])
+        assert Rule[other_rule_id].base_incard is None
+        assert Rule[rule_id].base_incard == b'base'
+        assert Cartridge[CARTRIDGE2_ID].base_incard == b'base'
+
+    with helpers.db_session:
+        # the rules of the cartridge extend its base incard
+        invalidate_incards([cartridge_tape_id])
+        assert Cartridge[CARTRIDGE2_ID].base_incard is None
+        assert Rule[rule_id].base_incard is None
+
+
+###
+# Cover Tests
+
+def send_cartridge_cover(dapp_client: TestClient, cover_id: str) -> list:
+    n_reports = len(dapp_client.rollup.reports)
+    path = f"core/cartridge_cover?id={cover_id}"
+    dapp_client.send_inspect(hex_payload='0x' + path.encode('ascii').hex())
+    assert dapp_client.rollup.status
+    return [bytes.fromhex(r['data']['payload'][2:]) for r in dapp_client.rollup.reports[n_reports:]]
+
+@pytest.mark.order(after="test_should_insert_cartridge1")
+def test_should_retrieve_cartridge_cover(dapp_client: TestClient):
+    with helpers.db_session:
+        cover_id = Cartridge[CARTRIDGE1_ID].cover_id
+    assert len(cover_id) > 0
+
+    reports = send_cartridge_cover(dapp_client, cover_id)
+    assert base64.b64decode(reports[-1]).startswith(b'\x89PNG')
+
+def test_should_not_retrieve_missing_cover(dapp_client: TestClient):
+    reports = send_cartridge_cover(dapp_client, '00' * 32)
+    assert all(len(r) == 0 for r in reports)
+
+@pytest.mark.order(after="test_should_insert_cartridge2")
+def test_should_migrate_legacy_covers(dapp_client: TestClient):
+    with helpers.db_session:
+        connection = Cartridge._database_.get_connection()
+        if "cover" not in [row[1] for row in connection.execute('PRAGMA table_info("Cartridge")')]:
+            connection.execute('ALTER TABLE "Cartridge" ADD COLUMN "cover" BLOB')
+        cartridge = Cartridge[CARTRIDGE2_ID]
+        previous_cover_id = cartridge.cover_id
+        # a row from before the cover store
+        cartridge.cover_id = None
+        helpers.flush()
+        connection.execute('UPDATE "Cartridge" SET "cover" = ? WHERE "id" = ?', (b'legacy cover', CARTRIDGE2_ID))
+
+    with helpers.db_session:
+        assert migrate_legacy_covers() == 1
+    with helpers.db_session:
+        assert migrate_legacy_covers() == 0
+        cover_id = Cartridge[CARTRIDGE2_ID].cover_id
+        assert CartridgeCover[cover_id].encoded == base64.b64encode(b'legacy cover').decode('ascii')
+        connection = Cartridge._database_.get_connection()
+        assert connection.execute('SELECT "cover" FROM "Cartridge" WHERE "id" = ?', (CARTRIDGE2_ID,)).fetchone()[0] is None
+
+        Cartridge[CARTRIDGE2_ID].cover_id = previous_cover_id
+        CartridgeCover[cover_id].delete()
+
+
+###
+# Incard Cache Tests
+
+INCARD_TAPE_ID = 'cd' * 32
+
+def insert_incard_tape(out_card: bytes):
+    Tape(id=INCARD_TAPE_ID, cartridge_id=CARTRIDGE1_ID, rule_id='incard-test', user_address=USER2_ADDRESS.lower(),
+         timestamp=0, input_index=-1, out_card=out_card)
+    invalidate_incards([INCARD_TAPE_ID])
+
+def test_should_not_cache_uncommitted_incards(dapp_client: TestClient):
+    incard_cache.clear()
+    with helpers.db_session:
+        insert_incard_tape(b'uncommitted')
+        assert has_uncommitted_changes()
+        assert format_incard([INCARD_TAPE_ID],[b'']) == format_bytes_list_to_incard([b'uncommitted'])
+        helpers.rollback()
+    assert len(incard_cache.entries) == 0
+
+    with helpers.db_session:
+        assert not has_uncommitted_changes()
+        assert format_incard([INCARD_TAPE_ID],[b'']) == format_bytes_list_to_incard([])
+    assert len(incard_cache.entries) == 1
+
+@pytest.mark.order(after="test_should_not_cache_uncommitted_incards")
+def test_should_keep_committed_incards_on_rollback(dapp_client: TestClient):
+    incard_cache.clear()
+    with helpers.db_session:
+        insert_incard_tape(b'first')
+    with helpers.db_session:
+        assert format_incard([INCARD_TAPE_ID],[b'']) == format_bytes_list_to_incard([b'first'])
+
+    with helpers.db_session:
+        Tape[INCARD_TAPE_ID].out_card = b'second'
+        invalidate_incards([INCARD_TAPE_ID])
+        assert format_incard([INCARD_TAPE_ID],[b'']) == format_bytes_list_to_incard([b'second'])
+        helpers.rollback()
+
+    with helpers.db_session:
+        assert format_incard([INCARD_TAPE_ID],[b'']) == format_bytes_list_to_incard([b'first'])
+        Tape[INCARD_TAPE_ID].out_card = b'second'
+        invalidate_incards([INCARD_TAPE_ID])
+    with helpers.db_session:
+        assert format_incard([INCARD_TAPE_ID],[b'']) == format_bytes_list_to_incard([b'second'])
+        Tape[INCARD_TAPE_ID].delete()
+        invalidate_incards([INCARD_TAPE_ID])
+    assert len(incard_cache.entries) == 0
+
+
+###
+# Leaderboard Tests
+
+LEADERBOARD_RULE_ID = 'ab' * 32
+
+def insert_scored_tape(tape_id: str, rule_id: str, score: int, input_index: int):
+    Tape(id=tape_id, cartridge_id=CARTRIDGE1_ID, rule_id=rule_id, user_address=USER2_ADDRESS.lower(),
+         timestamp=0, input_index=input_index, verified=True, score=score)
+
+def test_should_award_top_scores(dapp_client: TestClient):
+    scores = [5, 30, 20, 10]
+    with helpers.db_session:
+        Rule(id=LEADERBOARD_RULE_ID, name='leaderboard-test', cartridge_id=CARTRIDGE1_ID, created_by=USER2_ADDRESS.lower(),
+             created_at=0, input_index=-1, score_function='score', start=0, end=1)
+        for i, score in enumerate(scores):
+            insert_scored_tape(f"{i:064x}", LEADERBOARD_RULE_ID, score, i)
+
+    header = ABIFunctionSelectorHeader(
+        function="core.award_winners",
+        argument_types=get_abi_types_from_model(AwardWinnerTapesPayload)
+    ).to_bytes()
+    model = AwardWinnerTapesPayload(rule_id=hex2bytes(LEADERBOARD_RULE_ID), tapes_to_award=2)
+    hex_payload = '0x' + (header + encode_model(model, packed=False)).hex()
+    dapp_client.send_advance(hex_payload=hex_payload, msg_sender=USER2_ADDRESS)
+
+    assert dapp_client.rollup.status
+    with helpers.db_session:
+        ranks = [Tape[f"{i:064x}"].rank for i in range(len(scores))]
+    assert ranks == [None, 1, 2, None]
+
+def test_should_update_leaderboard_after_commit(dapp_client: TestClient):
+    rule_id = 'leaderboard-rollback'
+    tape_id = 'ef' * 32
+    get_leaderboards().clear()
+    with helpers.db_session:
+        assert get_leaderboard(rule_id).size() == 0
+
+    with helpers.db_session:
+        insert_scored_tape(tape_id, rule_id, 10, 0)
+        get_leaderboards().update_tape(rule_id, tape_id)
+        # the session sees its own tape, the cached board doesn't
+        assert get_leaderboard(rule_id).size() == 1
+        assert get_leaderboards().boards[rule_id].size() == 0
+        helpers.rollback()
+    with helpers.db_session:
+        assert get_leaderboard(rule_id).size() == 0
+
+    with helpers.db_session:
+        insert_scored_tape(tape_id, rule_id, 10, 0)
+        get_leaderboards().update_tape(rule_id, tape_id)
+    with helpers.db_session:
+        assert get_leaderboard(rule_id).top(1)[0]['tape_id'] == tape_id
+
+    with helpers.db_session:
+        Tape[tape_id].score = 20
+        get_leaderboards().update_tape(rule_id, tape_id)
+        helpers.rollback()
+    with helpers.db_session:
+        assert get_leaderboard(rule_id).tape_entry(tape_id)['score'] == 10
+        Tape[tape_id].delete()
+        get_leaderboards().update_tape(rule_id, tape_id)
+    with helpers.db_session:
+        assert get_leaderboard(rule_id).size() == 0
+
+
+###
+# Pagination Tests
+
+PAGINATION_RULE_ID = 'pagination-test'
+# (score, timestamp), None scores sort last in desc order
+PAGINATION_TAPES = [(3, 10), (1, 20), (3, 30), (2, 40), (None, 50), (2, 60), (3, 70)]
+
+def pagination_tape_id(i: int) -> str:
+    return f"{0xa0 + i:02x}" * 32
+
+def send_inspect_report(dapp_client: TestClient, path: str) -> dict:
+    dapp_client.send_inspect(hex_payload='0x' + path.encode('ascii').hex())
+    report = dapp_client.rollup.reports[-1]['data']['payload']
+    return json.loads(bytes.fromhex(report[2:]).decode('utf-8'))
+
+def test_should_paginate_with_cursor(dapp_client: TestClient):
+    with helpers.db_session:
+        for i, (score, timestamp) in enumerate(PAGINATION_TAPES):
+            Tape(id=pagination_tape_id(i), cartridge_id=CARTRIDGE1_ID, rule_id=PAGINATION_RULE_ID, user_address=USER2_ADDRESS.lower(),
+                 timestamp=timestamp, input_index=i, verified=score is not None, score=score)
+    expected = [pagination_tape_id(i) for i in sorted(range(len(PAGINATION_TAPES)),
+        key=lambda i: (PAGINATION_TAPES[i][0] is None, -(PAGINATION_TAPES[i][0] or 0), pagination_tape_id(i)))]
+
+    with helpers.db_session:
+        query = Tape.select(lambda t: t.rule_id == PAGINATION_RULE_ID)
+        order = parse_order(Tape, 'score', 'desc')
+        assert order == [('score', True), ('id', False)]
+        tape_ids = []
+        cursor = ''
+        while cursor is not None:
+            tapes, cursor = keyset_page(query, Tape, order, cursor, 2)
+            assert len(tapes) <= 2
+            tape_ids.extend(t.id for t in tapes)
+        assert tape_ids == expected
+
+        # several order keys keep their directions
+        order = parse_order(Tape, 'score,timestamp', 'asc,desc')
+        tapes, _ = keyset_page(query, Tape, order, '', len(PAGINATION_TAPES))
+        assert [t.timestamp for t in tapes] == [50, 20, 60, 40, 70, 30, 10]
+
+        _, cursor = keyset_page(query, Tape, parse_order(Tape, 'score', 'desc'), '', 3)
+
+    report = send_inspect_report(dapp_client,
+        f"core/tapes?rule_id={PAGINATION_RULE_ID}&order_by=score&order_dir=desc&page_size=3&with_total=false&cursor={quote(cursor)}")
+    assert dapp_client.rollup.status
+    output = TapesOutput.parse_obj(report)
+    assert [t.id for t in output.data] == expected[3:6]
+    assert output.total is None
+    assert output.next_cursor is not None
+
+    report = send_inspect_report(dapp_client,
+        f"core/tapes?rule_id={PAGINATION_RULE_ID}&order_by=score&order_dir=desc&page_size=3&cursor={quote(output.next_cursor)}")
+    output = TapesOutput.parse_obj(report)
+    assert [t.id for t in output.data] == expected[6:]
+    assert output.total == len(PAGINATION_TAPES)
+    assert output.next_cursor is None
+
+@pytest.mark.order(after="test_should_paginate_with_cursor")
+def test_should_page_like_offset_pagination(dapp_client: TestClient):
+    with helpers.db_session:
+        query = Tape.select(lambda t: t.rule_id == PAGINATION_RULE_ID)
+        order = parse_order(Tape, 'timestamp', 'desc')
+        offset_ids = [t.id for t in query.order_by(helpers.desc(Tape.timestamp)).page(2, 3)]
+        _, cursor = keyset_page(query, Tape, order, '', 3)
+        tapes, _ = keyset_page(query, Tape, order, cursor, 3)
+        assert [t.id for t in tapes] == offset_ids
+
+@pytest.mark.parametrize("order_by,cursor", [
+    ("in_card", ""),
+    ("score;", ""),
+    ("score", "not-a-cursor"),
+    ("score", encode_cursor([1])),
+])
+def test_should_fail_invalid_cursor_page(dapp_client: TestClient, order_by: str, cursor: str):
+    send_inspect_report(dapp_client, f"core/tapes?rule_id={PAGINATION_RULE_ID}&order_by={quote(order_by)}&cursor={quote(cursor)}")
+    assert not dapp_client.rollup.status
+
+
+###
+# Projection Tests
+
+def test_should_parse_fields():
+    assert parse_fields(Tape, ['score', 'id', 'score']) == ['id', 'score']
+    assert parse_fields(Rule, ['tags'], ['tags']) == ['id', 'tags']
+    assert field_columns(Rule, ['id', 'tags'], ['tag_names']) == ['id', 'tag_names']
+    for fields in (['missing'], ['tags'], ['incard_tapes'], ['x.id']):
+        with pytest.raises(Exception, match="Invalid field"):
+            parse_fields(Rule, fields)
+
+@pytest.mark.order(after="test_should_paginate_with_cursor")
+def test_should_project_fields(dapp_client: TestClient):
+    with helpers.db_session:
+        Tape[pagination_tape_id(0)].out_card = b'projected'
+    with helpers.db_session:
+        query = Tape.select(lambda t: t.rule_id == PAGINATION_RULE_ID).order_by(helpers.desc(Tape.timestamp))
+        tape_ids = [t.id for t in query]
+    with helpers.db_session:
+        columns = field_columns(Tape, ['id', 'score', 'out_card'])
+        columns_query = select_columns(query, columns)
+        # only the columns asked for are read, and no tape is loaded
+        assert len(columns_query.get_sql().split('FROM')[0].split(',')) == len(columns)
+        result = project(column_rows(list(columns_query), columns), ['id', 'score', 'out_card'])
+        assert [r['id'] for r in result] == tape_ids
+        assert all(list(r.keys()) == ['id', 'score', 'out_card'] for r in result)
+        assert result[-1]['out_card'] == b'projected'
+        assert len(Tape._database_._get_cache().indexes.get(Tape._pk_attrs_, {})) == 0
+
+        order = parse_order(Tape, 'timestamp', 'desc')
+        rows, cursor = keyset_page(query, Tape, order, '', 3, ['id'])
+        rows += keyset_page(query, Tape, order, cursor, 10, ['id'])[0]
+        assert [r['id'] for r in rows] == tape_ids
+
+    report = send_inspect_report(dapp_client,
+        f"core/tapes?rule_id={PAGINATION_RULE_ID}&order_by=timestamp&fields=user_address&fields=score")
+    assert dapp_client.rollup.status
+    output = TapeFieldsOutput.parse_obj(report)
+    assert output.total == len(PAGINATION_TAPES)
+    assert [d['score'] for d in output.data] == [score for score, _ in PAGINATION_TAPES]
+    assert all(set(d.keys()) == {'id', 'user_address', 'score'} for d in output.data)
+
+@pytest.mark.order(after="test_should_insert_cartridge1")
+def test_should_project_computed_fields(dapp_client: TestClient):
+    report = send_inspect_report(dapp_client, f"core/rules?cartridge_id={CARTRIDGE1_ID}&fields=name&fields=tags")
+    assert dapp_client.rollup.status
+    output = RuleFieldsOutput.parse_obj(report)
+    assert len(output.data) > 0
+    assert all(set(d.keys()) == {'id', 'name', 'tags'} and isinstance(d['tags'], list) for d in output.data)
+
+    report = send_inspect_report(dapp_client, f"core/cartridges?ids={CARTRIDGE1_ID}&fields=name&fields=cover&cover_format=id")
+    assert dapp_client.rollup.status
+    output = CartridgeFieldsOutput.parse_obj(report)
+    with helpers.db_session:
+        cartridge = Cartridge[CARTRIDGE1_ID]
+        assert output.data == [{'id': CARTRIDGE1_ID, 'name': cartridge.name, 'cover': cartridge.cover_id}]
+
+@pytest.mark.parametrize("path", [
+    "core/tapes?fields=missing",
+    "core/rules?fields=tapes_data",
+    "core/cartridges?fields=tags",
+])
+def test_should_fail_invalid_fields(dapp_client: TestClient, path: str):
+    send_inspect_report(dapp_client, path)
+    assert not dapp_client.rollup.status
+
+
+###
+# Tag Filter Tests
+
+TAG_CARTRIDGE_ID = 'tag-test'
+TAG_RULES = {'tag-rule-1': ['a', 'b'], 'tag-rule-2': ['a'], 'tag-rule-3': ['d']}
+
+def insert_tagged_rule(rule_id: str, tags: list[str]):
+    rule = Rule(id=rule_id, name=rule_id, cartridge_id=TAG_CARTRIDGE_ID, created_by=USER2_ADDRESS.lower(),
+                created_at=0, input_index=-1, tag_names=tags)
+    for tag in tags:
+        rule_tag = RuleTag.get(lambda t: t.name == tag and t.cartridge_id == TAG_CARTRIDGE_ID)
+        if rule_tag is None: rule_tag = RuleTag(name=tag, cartridge_id=TAG_CARTRIDGE_ID)
+        rule_tag.rules.add(rule)
+    Tape(id=rule_id, cartridge_id=TAG_CARTRIDGE_ID, rule_id=rule_id, user_address=USER2_ADDRESS.lower(), timestamp=0, input_index=-1)
+
+def tagged_ids(tags: list[str], match_any: bool = False) -> tuple[list[str],list[str]]:
+    rules_query = filter_rules_by_tags(Rule.select(lambda r: r.cartridge_id == TAG_CARTRIDGE_ID), tags, match_any)
+    tapes_query = filter_tapes_by_tags(Tape.select(lambda t: t.cartridge_id == TAG_CARTRIDGE_ID), tags, match_any)
+    return sorted(r.id for r in rules_query), sorted(t.id for t in tapes_query)
+
+@pytest.mark.parametrize("max_ids", [model.TAG_FILTER_MAX_IDS, 0])
+def test_should_filter_by_tags(dapp_client: TestClient, monkeypatch, max_ids: int):
+    # the index for small matches, a join with the tag tables for larger ones
+    with helpers.db_session:
+        if Rule.get(id='tag-rule-1') is None:
+            for rule_id, tags in TAG_RULES.items(): insert_tagged_rule(rule_id, tags)
+    get_rule_tag_index().clear()
+    monkeypatch.setattr(model, 'TAG_FILTER_MAX_IDS', max_ids)
+
+    with helpers.db_session:
+        assert tagged_ids(['a', 'b']) == (['tag-rule-1'], ['tag-rule-1'])
+        assert tagged_ids(['a']) == (['tag-rule-1', 'tag-rule-2'], ['tag-rule-1', 'tag-rule-2'])
+        assert tagged_ids(['b', 'd'], match_any=True) == (['tag-rule-1', 'tag-rule-3'], ['tag-rule-1', 'tag-rule-3'])
+        assert tagged_ids(['a', 'd']) == ([], [])
+        assert tagged_ids(['missing']) == ([], [])
+
+@pytest.mark.order(after="test_should_filter_by_tags")
+def test_should_update_tag_index_after_commit(dapp_client: TestClient):
+    with helpers.db_session:
+        assert tagged_ids(['d']) == (['tag-rule-3'], ['tag-rule-3'])
+
+    with helpers.db_session:
+        RuleTag[TAG_CARTRIDGE_ID, 'd'].rules.add(Rule['tag-rule-2'])
+        get_rule_tag_index().update('tag-rule-2')
+        # the session filters with its own changes
+        assert tagged_ids(['d']) == (['tag-rule-2', 'tag-rule-3'], ['tag-rule-2', 'tag-rule-3'])
+        helpers.rollback()
+    with helpers.db_session:
+        assert tagged_ids(['d']) == (['tag-rule-3'], ['tag-rule-3'])
+
+    with helpers.db_session:
+        RuleTag[TAG_CARTRIDGE_ID, 'd'].rules.add(Rule['tag-rule-2'])
+        get_rule_tag_index().update('tag-rule-2')
+    with helpers.db_session:
+        assert tagged_ids(['d']) == (['tag-rule-2', 'tag-rule-3'], ['tag-rule-2', 'tag-rule-3'])
+        assert sorted(get_rule_tag_index().match(['d'])) == ['tag-rule-2', 'tag-rule-3']
+        RuleTag[TAG_CARTRIDGE_ID, 'd'].rules.remove(Rule['tag-rule-2'])
+        get_rule_tag_index().update('tag-rule-2')
+
+
+###
+# Name Filter Tests
+
+NAME_RULE_ID = 'name-test-rule'
+
+@pytest.mark.order(after="test_should_filter_by_tags")
+def test_should_filter_names_with_like(dapp_client: TestClient):
+    with helpers.db_session:
+        assert set(name_candidates('rule', 'tag-rule')) >= set(TAG_RULES)
+
+    # the candidates narrow the like filter, which keeps its case handling
+    report = send_inspect_report(dapp_client, f"core/rules?cartridge_id={TAG_CARTRIDGE_ID}&name=TAG-RULE-2")
+    assert dapp_client.rollup.status
+    assert [r.id for r in RulesOutput.parse_obj(report).data] == ['tag-rule-2']
+
+    report = send_inspect_report(dapp_client, f"core/rule_tags?cartridge_id={TAG_CARTRIDGE_ID}&name=a")
+    assert sorted(RuleTagsOutput.parse_obj(report).tags) == ['a']
+
+@pytest.mark.order(after="test_should_filter_names_with_like")
+def test_should_update_name_index_after_commit(dapp_client: TestClient):
+    with helpers.db_session:
+        Rule(id=NAME_RULE_ID, name='Renamed Rule', cartridge_id=TAG_CARTRIDGE_ID, created_by=USER2_ADDRESS.lower(),
+             created_at=0, input_index=-1)
+        get_name_index('rule').update(NAME_RULE_ID)
+        # the session filters without the index
+        assert name_candidates('rule', 'renamed') is None
+        assert [r.id for r in Rule.select(lambda r: 'renamed' in r.name)] == [NAME_RULE_ID]
+        helpers.rollback()
+    with helpers.db_session:
+        assert name_candidates('rule', 'renamed') == []
+
+    with helpers.db_session:
+        Rule(id=NAME_RULE_ID, name='Renamed Rule', cartridge_id=TAG_CARTRIDGE_ID, created_by=USER2_ADDRESS.lower(),
+             created_at=0, input_index=-1)
+        get_name_index('rule').update(NAME_RULE_ID)
+    with helpers.db_session:
+        assert name_candidates('rule', 'renamed') == [NAME_RULE_ID]
+        Rule[NAME_RULE_ID].delete()
+        get_name_index('rule').update(NAME_RULE_ID)
+    with helpers.db_session:
+        assert name_candidates('rule', 'renamed') == []
+
+@pytest.mark.order(after="test_should_filter_by_tags")
+def test_should_not_narrow_common_names(dapp_client: TestClient, monkeypatch):
+    monkeypatch.setattr(model, 'NAME_FILTER_MAX_IDS', 2)
+    with helpers.db_session:
+        assert name_candidates('rule', 'tag-rule') is None
+        assert name_candidates('rule', 'tag-rule-1') == ['tag-rule-1']
+
+
+###
+# Query Plan Tests
+
+def query_plan(query) -> str:
+    sql = query.get_sql()
+    connection = Tape._database_.get_connection()
+    return ' '.join(row[3] for row in connection.execute(f"EXPLAIN QUERY PLAN {sql}", ['x'] * sql.count('?')))
+
+@pytest.mark.parametrize("query_name,index_name", [
+    ("leaderboard", "idx_tape__rule_id_verified_score"),
+    ("unverified_rule_tapes", "idx_tape__rule_id_verified_score"),
+    ("rule_player_tapes", "idx_tape__rule_id_user_address"),
+    ("cartridge_player_tapes", "idx_tape__cartridge_id_user_address"),
+    ("cartridge_latest_tapes", "idx_tape__cartridge_id_timestamp"),
+    ("duplicate_rule", "idx_rule__cartridge_id_name"),
+])
+def test_hot_query_should_use_index(dapp_client: TestClient, query_name: str, index_name: str):
+    rule_id = cartridge_id = user_address = name = 'x'
+    with helpers.db_session:
+        queries = {
+            "leaderboard": helpers.select((t.id, t.user_address, t.score, t.input_index) for t in Tape
+                if t.rule_id == rule_id and t.verified == True and t.score is not None),
+            "unverified_rule_tapes": helpers.select(t for t in Tape if t.rule_id == rule_id and (not t.verified or t.score is None)),
+            "rule_player_tapes": helpers.select(t for t in Tape if t.rule_id == rule_id and t.user_address == user_address),
+            "cartridge_player_tapes": helpers.select(t for t in Tape if t.cartridge_id == cartridge_id and t.user_address == user_address),
+            "cartridge_latest_tapes": Tape.select(lambda t: t.cartridge_id == cartridge_id).order_by(helpers.desc(Tape.timestamp)),
+            "duplicate_rule": helpers.select(r for r in Rule if r.cartridge_id == cartridge_id and r.name == name),
+        }
+        assert index_name in query_plan(queries[query_name])
+
 
 # @pytest.fixture()
 # def rives_antcopter_replay1_payload_wrong_outhash() -> bytes:
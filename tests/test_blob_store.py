@@ -0,0 +1,176 @@
+"""
+Tests for the chunked cartridge store.
+"""
+import os
+import random
+
+import pytest
+
+from core.blob_store import CartridgeBlobStore, CartridgeReader, chunk_boundaries
+from core.core_settings import generate_cartridge_id
+
+
+###
+# Setup tests variables
+
+def random_data(seed: int, size: int = 300*1024) -> bytes:
+    return random.Random(seed).randbytes(size)
+
+@pytest.fixture()
+def store(tmp_path) -> CartridgeBlobStore:
+    return CartridgeBlobStore(str(tmp_path / "cartridges"))
+
+def stored_chunks(store: CartridgeBlobStore) -> set[str]:
+    return set(f for _, _, files in os.walk(f"{store.root}/chunks") for f in files)
+
+def put(store: CartridgeBlobStore, data: bytes) -> str:
+    cartridge_id = generate_cartridge_id(data)
+    store.put(cartridge_id, data)
+    return cartridge_id
+
+
+###
+# Chunking tests
+
+def test_should_cut_content_defined_chunks():
+    data = random_data(0)
+    boundaries = chunk_boundaries(data)
+    assert boundaries[0][0] == 0 and boundaries[-1][1] == len(data)
+    assert all(a[1] == b[0] for a, b in zip(boundaries, boundaries[1:]))
+    assert len(boundaries) > 1
+
+    # an insertion only changes the chunks around it
+    inserted = data[:150*1024] + b'inserted' + data[150*1024:]
+    chunks = set(data[s:e] for s, e in boundaries)
+    inserted_chunks = set(inserted[s:e] for s, e in chunk_boundaries(inserted))
+    assert len(inserted_chunks - chunks) <= 2
+
+
+###
+# Reader tests
+
+def test_should_read_stored_cartridge(store: CartridgeBlobStore):
+    data = random_data(1)
+    cartridge_id = put(store, data)
+
+    with store.read(cartridge_id) as reader:
+        assert isinstance(reader, CartridgeReader)
+        assert len(reader) == len(data)
+        assert len(reader.views) == len(store.get_manifest(cartridge_id)['chunks'])
+        assert b''.join(reader.views) == data
+        assert reader.read() == data
+    assert store.verify(cartridge_id)
+
+def test_should_read_in_parts(store: CartridgeBlobStore):
+    data = random_data(2)
+    cartridge_id = put(store, data)
+
+    with store.read(cartridge_id) as reader:
+        parts = []
+        # reads cross the chunk boundaries
+        while True:
+            part = reader.read(10000)
+            if len(part) == 0: break
+            parts.append(part)
+        assert b''.join(parts) == data
+
+    with store.read(cartridge_id) as reader:
+        assert reader.read(5) == data[:5]
+        assert reader.read() == data[5:]
+
+def test_should_close_reader(store: CartridgeBlobStore):
+    cartridge_id = put(store, random_data(3))
+    reader = store.read(cartridge_id)
+    reader.close()
+    assert reader.closed
+    assert reader.views == []
+    with pytest.raises(ValueError):
+        reader.read()
+
+def test_should_read_after_remove(store: CartridgeBlobStore):
+    data = random_data(4)
+    cartridge_id = put(store, data)
+    with store.read(cartridge_id) as reader:
+        store.remove(cartridge_id)
+        assert not store.exists(cartridge_id)
+        assert reader.read() == data
+
+def test_should_fail_read_missing_cartridge(store: CartridgeBlobStore):
+    with pytest.raises(Exception):
+        store.read('missing')
+
+def test_should_read_legacy_files(store: CartridgeBlobStore):
+    data = random_data(5, 10*1024)
+    cartridge_id = generate_cartridge_id(data)
+    with open(store.legacy_path(cartridge_id),'wb') as f: f.write(data)
+
+    assert store.exists(cartridge_id)
+    with store.read(cartridge_id) as reader:
+        assert len(reader.views) == 1
+        assert reader.read() == data
+    assert store.verify(cartridge_id)
+
+    # storing it again moves it to chunks
+    store.put(cartridge_id, data)
+    assert not os.path.exists(store.legacy_path(cartridge_id))
+    with store.read(cartridge_id) as reader:
+        assert reader.read() == data
+
+
+###
+# Refcount tests
+
+def test_should_share_chunks_between_versions(store: CartridgeBlobStore):
+    data = random_data(6)
+    version = data[:200*1024] + b'new version' + data[200*1024:]
+    cartridge_id = put(store, data)
+    version_id = put(store, version)
+
+    stats = store.stats()
+    assert stats['cartridges'] == 2
+    assert stats['stored_bytes'] < stats['logical_bytes']
+
+    store.remove(cartridge_id)
+    with store.read(version_id) as reader:
+        assert reader.read() == version
+    assert store.verify(version_id)
+
+    store.remove(version_id)
+    assert stored_chunks(store) == set()
+    assert store.refcounts == {}
+
+def test_should_count_repeated_chunks_once(store: CartridgeBlobStore):
+    data = random_data(7, 64*1024)
+    cartridge_id = put(store, data + data)
+    store.remove(cartridge_id)
+    assert stored_chunks(store) == set()
+
+def test_should_keep_chunks_when_storing_again(store: CartridgeBlobStore):
+    data = random_data(8)
+    cartridge_id = put(store, data)
+    chunks = stored_chunks(store)
+    store.put(cartridge_id, data)
+    assert stored_chunks(store) == chunks
+    with store.read(cartridge_id) as reader:
+        assert reader.read() == data
+
+def test_should_rebuild_refcounts_from_manifests(store: CartridgeBlobStore):
+    data = random_data(9)
+    version = data + b'new version'
+    cartridge_id = put(store, data)
+    version_id = put(store, version)
+
+    # another process opening the same store
+    other = CartridgeBlobStore(store.root)
+    assert other.refcounts is None
+    other.remove(cartridge_id)
+    with other.read(version_id) as reader:
+        assert reader.read() == version
+    other.remove(version_id)
+    assert stored_chunks(other) == set()
+
+def test_should_detect_corrupted_chunks(store: CartridgeBlobStore):
+    cartridge_id = put(store, random_data(10))
+    chunk_hash = store.get_manifest(cartridge_id)['chunks'][0][0]
+    with open(store.chunk_path(chunk_hash),'r+b') as f: f.write(b'corrupted')
+    assert not store.verify(cartridge_id)
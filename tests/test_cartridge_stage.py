@@ -0,0 +1,98 @@
+"""
+Tests for the staged cartridge cache.
+"""
+import os
+import threading
+
+import pytest
+
+from core.cartridge_stage import CartridgeStage
+
+
+@pytest.fixture()
+def stage(tmp_path) -> CartridgeStage:
+    return CartridgeStage(str(tmp_path / "stage"), max_bytes=100)
+
+def test_should_stage_data_once(stage: CartridgeStage):
+    path = stage.acquire('c1', cartridge_data=b'1'*10)
+    assert open(path,'rb').read() == b'1'*10
+
+    # staged entries are reused, the new data is ignored
+    assert stage.acquire('c1', cartridge_data=b'2'*10) == path
+    assert open(path,'rb').read() == b'1'*10
+    assert stage.entries['c1'].refs == 2
+    assert stage.total_bytes == 10
+
+def test_should_stage_source_path_and_materialize(stage: CartridgeStage, tmp_path):
+    source = tmp_path / "source"
+    source.write_bytes(b'source')
+    assert open(stage.acquire('c1', source_path=str(source)),'rb').read() == b'source'
+
+    def materialize(path):
+        with open(path,'wb') as f: f.write(b'materialized')
+    assert open(stage.acquire('c2', materialize=materialize),'rb').read() == b'materialized'
+
+def test_should_fail_stage_without_data(stage: CartridgeStage):
+    with pytest.raises(Exception):
+        stage.acquire('c1')
+    assert 'c1' not in stage.entries
+    assert len(stage.staging) == 0
+
+def test_should_evict_unused_in_lru_order(stage: CartridgeStage):
+    paths = {}
+    for key in ['c1','c2','c3']:
+        paths[key] = stage.acquire(key, cartridge_data=key.encode()*15)
+        stage.release(key)
+    # c1 is the most recently used
+    stage.acquire('c1')
+    stage.release('c1')
+
+    stage.acquire('c4', cartridge_data=b'c4'*15)
+    stage.release('c4')
+
+    assert list(stage.entries.keys()) == ['c3','c1','c4']
+    assert not os.path.exists(paths['c2'])
+    assert stage.total_bytes == 90
+
+def test_should_not_evict_entries_in_use(stage: CartridgeStage):
+    path = stage.acquire('big', cartridge_data=b'b'*150)
+    stage.acquire('small', cartridge_data=b's'*10)
+    stage.release('small')
+
+    # over budget, but big is still referenced
+    assert os.path.exists(path)
+    assert 'big' in stage.entries
+    assert 'small' not in stage.entries
+
+    with pytest.raises(Exception):
+        stage.remove('big')
+
+    stage.release('big')
+    assert 'big' not in stage.entries
+    assert not os.path.exists(path)
+    assert stage.total_bytes == 0
+
+def test_should_stage_key_once_concurrently(stage: CartridgeStage):
+    started = threading.Event()
+    proceed = threading.Event()
+    calls = []
+
+    def materialize(path):
+        calls.append(path)
+        started.set()
+        proceed.wait()
+        with open(path,'wb') as f: f.write(b'data')
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(stage.acquire('c1', materialize=materialize))) for _ in range(4)]
+    threads[0].start()
+    started.wait()
+    # the stage lock is free while the first thread writes the file
+    assert stage.acquire('other', cartridge_data=b'o') is not None
+    for t in threads[1:]: t.start()
+    proceed.set()
+    for t in threads: t.join()
+
+    assert len(calls) == 1
+    assert len(set(results)) == 1
+    assert stage.entries['c1'].refs == 4
@@ -0,0 +1,107 @@
+"""
+Tests for the cover ids and thumbnails.
+"""
+import zlib
+import struct
+import base64
+
+import pytest
+
+from core.cover import generate_cover_id, encode_cover, make_cover_thumbnail, read_png_chunks, unfilter_png_rows, \
+    write_png_chunk, PNG_SIGNATURE, COVER_THUMBNAIL_MAX_SIZE
+
+
+###
+# Setup tests variables
+
+def make_png(width: int, height: int, depth: int, color_type: int, pixel, filter_type: int = 0,
+             extra_chunks: list[tuple[bytes,bytes]] = []) -> bytes:
+    # pixel(x, y) returns the samples of a pixel, packed into bytes by depth
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+    raw = b''
+    for y in range(height):
+        bits = []
+        for x in range(width):
+            bits.extend(pixel(x, y))
+        if depth >= 8:
+            row = b''.join(v.to_bytes(depth // 8, 'big') for v in bits)
+        else:
+            row = bytearray((width * channels * depth + 7) // 8)
+            for i, v in enumerate(bits):
+                row[i * depth // 8] |= v << (8 - depth - (i * depth) % 8)
+            row = bytes(row)
+        if filter_type == 1:
+            bpp = max(1, channels * depth // 8)
+            row = bytes((row[i] - (row[i - bpp] if i >= bpp else 0)) & 0xff for i in range(len(row)))
+        raw += bytes([filter_type]) + row
+    header = struct.pack('>IIBBBBB', width, height, depth, color_type, 0, 0, 0)
+    chunks = [write_png_chunk(b'IHDR', header)] + [write_png_chunk(t, d) for t, d in extra_chunks]
+    return PNG_SIGNATURE + b''.join(chunks) + write_png_chunk(b'IDAT', zlib.compress(raw)) + write_png_chunk(b'IEND', b'')
+
+def decode_png(data: bytes) -> tuple[dict, list[bytearray]]:
+    chunks = read_png_chunks(data)
+    width, height, depth, color_type, _, _, _ = struct.unpack('>IIBBBBB', chunks[0][1])
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+    raw = zlib.decompress(b''.join(d for t, d in chunks if t == b'IDAT'))
+    stride = (width * channels * depth + 7) // 8
+    header = {"width": width, "height": height, "depth": depth, "color_type": color_type,
+              "chunks": [t for t, _ in chunks]}
+    return header, unfilter_png_rows(raw, height, stride, max(1, channels * depth // 8))
+
+
+###
+# Ids and encoding
+
+def test_should_generate_content_ids():
+    assert generate_cover_id(b'cover') == generate_cover_id(b'cover')
+    assert generate_cover_id(b'cover') != generate_cover_id(b'other')
+    assert len(generate_cover_id(b'cover')) == 64
+
+def test_should_encode_base64():
+    assert base64.b64decode(encode_cover(b'\x89PNG cover')) == b'\x89PNG cover'
+
+
+###
+# Thumbnails
+
+@pytest.mark.parametrize("filter_type", [0, 1])
+def test_should_downscale_rgb(filter_type: int):
+    pixel = lambda x, y: ((x * x + y * 31) % 256, (x * y) % 256, (x ^ y) % 256)
+    cover = make_png(512, 256, 8, 2, pixel, filter_type)
+    header, rows = decode_png(make_cover_thumbnail(cover))
+
+    assert (header["width"], header["height"], header["depth"], header["color_type"]) == (128, 64, 8, 2)
+    # nearest neighbor, every 4th pixel
+    for y in (0, 10, 63):
+        for x in (0, 50, 127):
+            assert tuple(rows[y][x * 3:x * 3 + 3]) == pixel(x * 4, y * 4)
+
+def test_should_unpack_sub_byte_grayscale():
+    cover = make_png(256, 256, 1, 0, lambda x, y: ((x // 8 + y // 8) % 2,))
+    header, rows = decode_png(make_cover_thumbnail(cover))
+
+    assert (header["width"], header["height"], header["depth"], header["color_type"]) == (128, 128, 8, 0)
+    assert rows[0][0] == 0 and rows[0][4] == 255
+
+def test_should_keep_palette():
+    palette = bytes([0, 0, 0, 255, 0, 0, 0, 255, 0, 0, 0, 255])
+    cover = make_png(300, 200, 4, 3, lambda x, y: (x % 3,), extra_chunks=[(b'PLTE', palette)])
+    thumbnail = make_cover_thumbnail(cover)
+    header, rows = decode_png(thumbnail)
+
+    assert header["width"] == COVER_THUMBNAIL_MAX_SIZE and header["height"] == 85
+    assert b'PLTE' in header["chunks"]
+    assert dict(read_png_chunks(thumbnail))[b'PLTE'] == palette
+    assert set(rows[0]) <= {0, 1, 2}
+
+def test_should_not_make_thumbnail_of_small_covers():
+    assert make_cover_thumbnail(make_png(128, 64, 8, 2, lambda x, y: (x, y, 0))) is None
+
+@pytest.mark.parametrize("cover", [
+    b'',
+    b'not a png',
+    PNG_SIGNATURE + b'\0' * 20,
+    make_png(256, 256, 8, 2, lambda x, y: (0, 0, 0))[:100],
+])
+def test_should_not_make_thumbnail_of_invalid_covers(cover: bytes):
+    assert make_cover_thumbnail(cover) is None
@@ -0,0 +1,29 @@
+"""
+Smoke test that the external verifier service imports, it is run as a script
+from its own dir.
+"""
+import os
+import sys
+import importlib.util
+
+import pytest
+
+EXTERNAL_VERIFIER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'external_verifier')
+
+
+###
+# Import tests
+
+def test_should_import_external_verifier(monkeypatch):
+    for module in ("typer", "web3", "redis"):
+        pytest.importorskip(module)
+    # as the script does, with common next to it
+    monkeypatch.syspath_prepend(EXTERNAL_VERIFIER_PATH)
+    monkeypatch.delitem(sys.modules, "common", raising=False)
+    spec = importlib.util.spec_from_file_location("external_verifier.external_verifier",
+                                                  os.path.join(EXTERNAL_VERIFIER_PATH, "external_verifier.py"))
+    external_verifier = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(external_verifier)
+
+    assert callable(external_verifier.get_emulator_stats)
+    assert external_verifier.Verifier is not None
@@ -0,0 +1,153 @@
+"""
+Tests for the sorted keys and the leaderboard entries against sorting all the
+tapes.
+"""
+import random
+
+import pytest
+
+from core.leaderboard import SortedKeys, Leaderboard
+
+
+###
+# Setup tests variables
+
+def random_keys(n: int, seed: int = 0) -> list[tuple]:
+    rng = random.Random(seed)
+    return [(-rng.randint(0, 50), rng.randint(0, 1000), f"{i:064x}") for i in range(n)]
+
+def sorted_entries(tapes: dict) -> list[tuple]:
+    # tapes of tape_id -> (user_address, score, input_index), sorted the slow way
+    return sorted(tapes.items(), key=lambda t: (-t[1][1], t[1][2], t[0]))
+
+
+###
+# Sorted keys
+
+def test_should_keep_keys_sorted():
+    keys = SortedKeys(bucket_size=4)
+    expected = []
+    rng = random.Random(1)
+    for key in random_keys(300):
+        keys.add(key)
+        expected.append(key)
+        if rng.random() < 0.3:
+            removed = expected.pop(rng.randrange(len(expected)))
+            keys.remove(removed)
+    expected.sort()
+
+    assert list(keys) == expected
+    assert len(keys) == len(expected)
+    assert all(len(bucket) <= 8 for bucket in keys.buckets)
+    assert keys.maxes == [bucket[-1] for bucket in keys.buckets]
+
+def test_should_index_and_slice():
+    expected = sorted(random_keys(100))
+    keys = SortedKeys(expected, bucket_size=8)
+
+    for i, key in enumerate(expected):
+        assert keys.index(key) == i
+        assert key in keys
+    assert keys.index((1,)) == len(expected)
+    assert (0, 0, 'missing') not in keys
+    for start, stop in [(0, 10), (5, 37), (95, 120), (120, 130), (0, 0)]:
+        assert keys.slice(start, stop) == expected[start:stop]
+
+def test_should_fail_to_remove_missing_key():
+    keys = SortedKeys(random_keys(10))
+    with pytest.raises(KeyError):
+        keys.remove((1, 1, 'missing'))
+
+def test_should_split_buckets():
+    keys = SortedKeys(bucket_size=4)
+    for i in range(100): keys.add((i,))
+    assert len(keys.buckets) > 1
+    assert all(len(bucket) <= 8 for bucket in keys.buckets)
+    assert list(keys) == [(i,) for i in range(100)]
+
+
+###
+# Leaderboard
+
+def test_should_rank_tapes_and_users():
+    rng = random.Random(2)
+    users = [f"0x{i:040x}" for i in range(7)]
+    tapes = dict((f"{i:064x}", (rng.choice(users), rng.randint(0, 20), i)) for i in range(200))
+    board = Leaderboard("rule")
+    board.load([(tape_id, *tape) for tape_id, tape in tapes.items()])
+
+    # random updates and removes
+    for i in range(300):
+        tape_id = f"{rng.randrange(250):064x}"
+        if rng.random() < 0.3:
+            board.remove(tape_id)
+            tapes.pop(tape_id, None)
+        else:
+            tapes[tape_id] = (rng.choice(users), rng.randint(0, 20), rng.randint(0, 1000))
+            board.update(tape_id, *tapes[tape_id])
+
+    ordered = sorted_entries(tapes)
+    assert board.size() == len(ordered)
+    assert [e['tape_id'] for e in board.top(len(ordered))] == [t[0] for t in ordered]
+    assert [e['tape_id'] for e in board.top(10, 20)] == [t[0] for t in ordered[20:30]]
+    for rank, (tape_id, (user_address, score, input_index)) in enumerate(ordered, 1):
+        assert board.tape_entry(tape_id) == {
+            "rank": rank, "tape_id": tape_id, "user_address": user_address, "score": score, "input_index": input_index}
+
+    user_best = {}
+    for tape_id, (user_address, _, _) in ordered:
+        user_best.setdefault(user_address, tape_id)
+    assert board.n_users() == len(user_best)
+    for rank, (user_address, tape_id) in enumerate(user_best.items(), 1):
+        assert board.user_rank(user_address) == rank
+        assert board.user_entry(user_address)['tape_id'] == tape_id
+
+def test_should_break_ties_by_earliest_input():
+    board = Leaderboard("rule")
+    board.update("b", "user1", 10, 5)
+    board.update("a", "user2", 10, 7)
+    board.update("c", "user3", 10, 5)
+    board.update("d", "user3", 12, 9)
+
+    assert [e['tape_id'] for e in board.top(4)] == ["d", "b", "c", "a"]
+    assert board.user_rank("user3") == 1
+
+def test_should_fall_back_to_next_user_tape():
+    board = Leaderboard("rule")
+    board.update("a", "user1", 30, 1)
+    board.update("b", "user1", 20, 2)
+    board.update("c", "user2", 25, 3)
+    assert board.user_rank("user2") == 2
+
+    board.remove("a")
+    assert board.user_entry("user1")['tape_id'] == "b"
+    assert board.user_rank("user2") == 1
+    board.remove("b")
+    assert board.user_entry("user1") is None
+    assert board.n_users() == 1
+    board.remove("missing")
+    assert board.size() == 1
+
+def test_should_keep_top_of_truncated_board():
+    rng = random.Random(3)
+    users = [f"0x{i:040x}" for i in range(5)]
+    tapes = dict((f"{i:064x}", (rng.choice(users), rng.randint(0, 50), i)) for i in range(100))
+    ordered = sorted_entries(tapes)
+    board = Leaderboard("rule", max_size=10)
+    top = ordered[:10]
+    board.load([(tape_id, *tape) for tape_id, tape in top], bound=Leaderboard.make_key(top[-1][0], *top[-1][1][1:]))
+    assert board.truncated()
+
+    for i in range(200):
+        tape_id = f"{rng.randrange(120):064x}"
+        tapes[tape_id] = (rng.choice(users), rng.randint(0, 60), rng.randint(0, 1000))
+        board.update(tape_id, *tapes[tape_id])
+        assert board.held() <= 20
+
+    # the tapes held are the top of all the tapes, ranked as among all of them
+    ordered = sorted_entries(tapes)
+    held = [e['tape_id'] for e in board.top(board.held())]
+    assert held == [t[0] for t in ordered[:len(held)]]
+    assert all(Leaderboard.make_key(t[0], *t[1][1:]) > board.bound for t in ordered[len(held):])
+    for tape_id, _ in ordered[len(held):]:
+        assert board.tape_entry(tape_id) is None
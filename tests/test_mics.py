@@ -0,0 +1,90 @@
+"""
+Tests for the MICS incard container.
+"""
+import pytest
+
+from core import mics
+
+
+###
+# Setup tests variables
+
+# containers made by the incard formatting this codec replaced
+GOLDEN_CONTAINERS = [
+    ([b'abc', b'12345678', b''],
+     '4d4943530000000300000020000000030000002800000008000000300000000061626320202020203132333435363738'),
+    ([b'card' * 3, b'\x00\x01'],
+     '4d49435300000002000000180000000c0000002800000002636172646361726463617264202020200001202020202020'),
+]
+
+
+###
+# Encoder tests
+
+@pytest.mark.parametrize("data_list,golden", GOLDEN_CONTAINERS)
+def test_should_encode_golden_containers(data_list: list[bytes], golden: str):
+    assert mics.encode(data_list) == bytes.fromhex(golden)
+    assert mics.encoded_size([len(d) for d in data_list]) == len(bytes.fromhex(golden))
+
+def test_should_pass_single_incard_as_is():
+    assert mics.encode([]) == b''
+    assert mics.encode([b'incard']) == b'incard'
+    assert mics.encode([memoryview(b'incard')]) == b'incard'
+    assert mics.encoded_size([]) == 0
+    assert mics.encoded_size([6]) == 6
+
+def test_should_encode_forced_container():
+    data = mics.encode([b'incard'], container=True)
+    assert mics.is_container(data)
+    assert [bytes(v) for v in mics.decode(data)] == [b'incard']
+    assert mics.encode([], container=True) == b'MICS\0\0\0\0'
+
+def test_should_encode_memoryview_slices():
+    data = bytes.fromhex(GOLDEN_CONTAINERS[0][1])
+    assert mics.encode(list(mics.iter_entries(data))) == data
+
+
+###
+# Decoder tests
+
+@pytest.mark.parametrize("data_list,golden", GOLDEN_CONTAINERS)
+def test_should_decode_golden_containers(data_list: list[bytes], golden: str):
+    data = bytes.fromhex(golden)
+    mics.validate(data)
+    assert [bytes(v) for v in mics.decode(data)] == data_list
+
+def test_should_decode_plain_incards():
+    assert mics.decode(b'') == []
+    assert [bytes(v) for v in mics.decode(b'incard')] == [b'incard']
+
+def test_should_decode_without_copies():
+    data = bytearray(mics.encode([b'first', b'second']))
+    first = mics.decode(data)[0]
+    data[mics.read_entries(data)[0][0]] = ord('F')
+    assert bytes(first) == b'First'
+
+
+###
+# Validator tests
+
+def container_with_entries(entries: list[tuple[int,int]], size: int) -> bytes:
+    header = b'MICS' + len(entries).to_bytes(4,'big')
+    for offset, length in entries:
+        header += offset.to_bytes(4,'big') + length.to_bytes(4,'big')
+    return header.ljust(size)
+
+@pytest.mark.parametrize("data,message", [
+    (b'MICS', "too short"),
+    (b'MICX\0\0\0\1' + b' ' * 16, "magic"),
+    (b'MICS\0\0\0\3' + b' ' * 8, "truncated"),
+    (container_with_entries([(20, 4)], 32), "not aligned"),
+    (container_with_entries([(8, 4)], 32), "overlaps"),
+    (container_with_entries([(16, 8), (16, 8)], 40), "overlaps"),
+    (container_with_entries([(16, 20)], 32), "out of bounds"),
+])
+def test_should_reject_invalid_containers(data: bytes, message: str):
+    with pytest.raises(mics.MicsError, match=message):
+        mics.validate(data)
+    if mics.is_container(data):
+        with pytest.raises(mics.MicsError):
+            mics.decode(data)
@@ -0,0 +1,72 @@
+"""
+Tests that the trigram candidates only narrow a substring search: every name
+the like match would return is a candidate.
+"""
+import random
+
+import pytest
+
+from core.name_index import NameIndex, name_trigrams
+
+from .test_tag_index import Marks
+
+
+###
+# Setup tests variables
+
+NAMES = ["Antcopter", "ANT Farm", "Particles", "Snake", "snake 2", "Straße", "ΟΔΟΣ", "ΟΔΟΣΑ", "οδοσ", "Ring", "rınG", "x"]
+
+def like_match(substring: str, name: str) -> bool:
+    # sqlite like: case insensitive for ascii only
+    def fold(s: str) -> str: return ''.join(c.lower() if c.isascii() else c for c in s)
+    return fold(substring) in fold(name)
+
+def name_index(names: dict) -> NameIndex:
+    return NameIndex(lambda keys: [(key, name) for key, name in names.items() if keys is None or key in keys], Marks())
+
+
+###
+# Candidates
+
+@pytest.mark.parametrize("substring", ["ant", "ANT", "cop", "nake", "SNAKE 2", "straße", "ΔΟΣ", "ΟΔΟ", "δοσ", "ing", "rın"])
+def test_should_narrow_to_a_superset_of_the_matches(substring: str):
+    names = dict((f"id{i}", name) for i, name in enumerate(NAMES))
+    candidates = name_index(names).candidates(substring)
+    assert candidates is not None
+    matches = [key for key, name in names.items() if like_match(substring, name)]
+    assert set(matches) <= set(candidates)
+    assert len(candidates) < len(names)
+
+def test_should_narrow_random_names():
+    rng = random.Random(4)
+    names = dict((f"id{i}", ''.join(rng.choice("abcAB ") for _ in range(rng.randint(0, 12)))) for i in range(500))
+    index = name_index(names)
+    for _ in range(200):
+        name = rng.choice(list(names.values()))
+        start = rng.randint(0, len(name))
+        substring = name[start:start + rng.randint(3, 6)]
+        candidates = index.candidates(substring)
+        if len(name_trigrams(substring)) == 0:
+            assert candidates is None
+            continue
+        assert set(key for key, name in names.items() if like_match(substring, name)) <= set(candidates)
+
+def test_should_not_narrow_short_or_common_substrings():
+    names = dict((f"id{i}", f"cartridge {i}") for i in range(20))
+    index = name_index(names)
+    assert index.candidates("ca") is None
+    assert index.candidates("") is None
+    assert index.candidates("cartridge", max_size=10) is None
+    assert len(index.candidates("cartridge", max_size=20)) == 20
+
+def test_should_refresh_names_once_settled():
+    names = {"id1": "Antcopter"}
+    index = name_index(names)
+    assert index.candidates("copter") == ["id1"]
+
+    names["id1"] = "rejected_id1"
+    index.update("id1")
+    assert index.candidates("copter") == ["id1"]
+    index.marks.settle()
+    assert index.candidates("copter") == []
+    assert index.candidates("rejected") == ["id1"]
@@ -0,0 +1,255 @@
+"""
+Tests for the replay cache.
+"""
+import os
+import threading
+
+import pytest
+
+from core.replay_cache import ReplayCache, encode_entry, decode_entry
+
+from .conftest import CARTRIDGE_PATH
+
+
+###
+# Setup tests variables
+
+class FakeEmulator:
+    def __init__(self):
+        self.calls = 0
+        self.emulator = "0.3.0:aaaa"
+        self.lock = threading.Lock()
+
+    def key(self, cartridge) -> str:
+        return self.emulator
+
+    def verify(self, cartridge, log, riv_args, in_card, entropy=None, frame=None, get_outhist=False, get_screenshot=False):
+        with self.lock: self.calls += 1
+        return {
+            "outcard": b'outcard-' + log,
+            "outhash": b'\x01' * 32,
+            "outhist": b'hist' if get_outhist else b'',
+            "screenshot": b'png' if get_screenshot else b'',
+        }
+
+@pytest.fixture()
+def emulator() -> FakeEmulator:
+    return FakeEmulator()
+
+def make_cache(emulator: FakeEmulator, cache_dir: str | None = None, max_bytes: int = 1024,
+               memory_max_bytes: int = 1024) -> ReplayCache:
+    return ReplayCache(cache_dir, max_bytes, memory_max_bytes, emulator_key_function=emulator.key)
+
+def verify(cache: ReplayCache, emulator: FakeEmulator, log: bytes = b'log', **kwargs) -> dict[str,bytes]:
+    return cache.verify_log('cartridge', log, '', b'', verify_function=emulator.verify, **kwargs)
+
+
+###
+# Cache tests
+
+def test_should_hit_same_replay(emulator: FakeEmulator):
+    cache = make_cache(emulator)
+    first = verify(cache, emulator)
+    second = verify(cache, emulator)
+
+    assert emulator.calls == 1
+    assert second['outcard'] == first['outcard']
+    assert second['outhash'] == first['outhash']
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+def test_should_miss_different_inputs(emulator: FakeEmulator):
+    cache = make_cache(emulator)
+    verify(cache, emulator)
+    verify(cache, emulator, log=b'other log')
+    verify(cache, emulator, frame=10)
+    verify(cache, emulator, entropy='player')
+    verify(cache, emulator, get_outhist=True)
+
+    assert emulator.calls == 5
+    assert cache.stats()['hits'] == 0
+
+def test_should_not_cache_screenshots(emulator: FakeEmulator):
+    cache = make_cache(emulator)
+    assert verify(cache, emulator, get_screenshot=True)['screenshot'] == b'png'
+    assert verify(cache, emulator, get_screenshot=True)['screenshot'] == b'png'
+    assert emulator.calls == 2
+
+def test_should_invalidate_with_emulator(emulator: FakeEmulator):
+    cache = make_cache(emulator)
+    verify(cache, emulator)
+
+    # another binary of the same riv version
+    emulator.emulator = "0.3.0:bbbb"
+    verify(cache, emulator)
+    assert emulator.calls == 2
+
+    # another riv version
+    emulator.emulator = "0.3.1:bbbb"
+    verify(cache, emulator)
+    assert emulator.calls == 3
+
+def test_should_invalidate_on_clear(emulator: FakeEmulator, tmp_path):
+    cache = make_cache(emulator, str(tmp_path / "cache"))
+    verify(cache, emulator)
+    cache.clear()
+
+    assert len(os.listdir(tmp_path / "cache")) == 0
+    verify(cache, emulator)
+    assert emulator.calls == 2
+
+def test_should_coalesce_concurrent_replays(emulator: FakeEmulator):
+    cache = make_cache(emulator)
+    started = threading.Event()
+    proceed = threading.Event()
+
+    def slow_verify(*args, **kwargs):
+        started.set()
+        proceed.wait()
+        return emulator.verify(*args, **kwargs)
+
+    results = []
+    def run():
+        results.append(cache.verify_log('cartridge', b'log', '', b'', verify_function=slow_verify))
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    threads[0].start()
+    started.wait()
+    for t in threads[1:]: t.start()
+    # the followers are either waiting the leader or will hit the stored outputs
+    proceed.set()
+    for t in threads: t.join()
+
+    assert emulator.calls == 1
+    assert len(results) == 4
+    assert all(r['outcard'] == b'outcard-log' for r in results)
+    assert cache.stats()['misses'] == 1
+
+def test_should_share_errors_with_coalesced_replays(emulator: FakeEmulator):
+    cache = make_cache(emulator)
+    def failed_verify(*args, **kwargs):
+        raise Exception("emulator error")
+    with pytest.raises(Exception, match="emulator error"):
+        cache.verify_log('cartridge', b'log', '', b'', verify_function=failed_verify)
+    # errors aren't cached
+    verify(cache, emulator)
+    assert emulator.calls == 1
+
+def test_should_evict_memory_in_lru_order(emulator: FakeEmulator):
+    # each entry takes 32 bytes of outhash plus the outcard
+    cache = make_cache(emulator, memory_max_bytes=150)
+    for log in [b'l1', b'l2', b'l3']:
+        verify(cache, emulator, log=log)
+    verify(cache, emulator, log=b'l1')
+    verify(cache, emulator, log=b'l4')
+
+    assert cache.stats()['memory_entries'] == 3
+    assert cache.stats()['memory_bytes'] <= 150
+    calls = emulator.calls
+    verify(cache, emulator, log=b'l1')
+    assert emulator.calls == calls
+    verify(cache, emulator, log=b'l2')
+    assert emulator.calls == calls + 1
+
+
+def test_should_verify_batches_through_the_cache(rivemu: str):
+    cache = ReplayCache(None, 1 << 20, 1 << 20)
+    jobs = [
+        {"cartridge": CARTRIDGE_PATH, "log": b'a' * 3},
+        {"cartridge": CARTRIDGE_PATH, "log": b'b' * 3},
+        {"cartridge": CARTRIDGE_PATH, "log": b'fail'},
+    ]
+    first = cache.verify_many(jobs)
+    assert first[0]['error'] is None and first[1]['error'] is None
+    assert 'invalid log' in first[2]['error']
+    assert cache.stats()['misses'] == 3
+
+    # only the failed job and the screenshot run again
+    second = cache.verify_many(jobs + [{"cartridge": CARTRIDGE_PATH, "log": b'a' * 3, "get_screenshot": True}])
+    assert [r['outputs']['outhash'] for r in second[:2]] == [r['outputs']['outhash'] for r in first[:2]]
+    assert second[3]['outputs']['screenshot'] != b''
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 4
+    assert cache.verify_log(CARTRIDGE_PATH, b'b' * 3, '', b'')['outhash'] == first[1]['outputs']['outhash']
+    assert cache.stats()['hits'] == 3
+
+
+###
+# Disk store
+
+def test_should_reload_from_disk(emulator: FakeEmulator, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    verify(make_cache(emulator, cache_dir), emulator, get_outhist=True)
+
+    other = make_cache(emulator, cache_dir)
+    outputs = verify(other, emulator, get_outhist=True)
+    assert emulator.calls == 1
+    assert outputs['outhist'] == b'hist'
+    assert other.stats()['disk_entries'] == 1
+
+def test_should_evict_disk_in_lru_order(emulator: FakeEmulator, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    entry_size = len(encode_entry({"outcard": b'outcard-l1', "outhash": b'\x01' * 32, "outhist": b''}))
+    cache = make_cache(emulator, cache_dir, max_bytes=2 * entry_size, memory_max_bytes=0)
+    for log in [b'l1', b'l2', b'l3']:
+        verify(cache, emulator, log=log)
+
+    assert cache.stats()['disk_entries'] == 2
+    assert len(os.listdir(cache_dir)) == 2
+    verify(cache, emulator, log=b'l1')
+    assert emulator.calls == 4
+
+def test_should_use_private_cache_dir(emulator: FakeEmulator, tmp_path):
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir(mode=0o777)
+    os.chmod(cache_dir, 0o777)
+    cache = make_cache(emulator, str(cache_dir))
+    verify(cache, emulator)
+
+    assert cache.cache_dir == str(cache_dir)
+    assert os.stat(cache_dir).st_mode & 0o777 == 0o700
+    assert all(os.stat(f.path).st_mode & 0o077 == 0 for f in os.scandir(cache_dir))
+
+def test_should_reject_invalid_cache_dir(emulator: FakeEmulator, tmp_path):
+    target = tmp_path / "target"
+    target.mkdir()
+    link = tmp_path / "link"
+    link.symlink_to(target)
+    assert make_cache(emulator, str(link)).cache_dir is None
+
+    not_dir = tmp_path / "file"
+    not_dir.write_bytes(b'')
+    assert make_cache(emulator, str(not_dir)).cache_dir is None
+
+@pytest.mark.skipif(os.getuid() != 0, reason="needs to create a directory of another user")
+def test_should_reject_cache_dir_of_other_user(emulator: FakeEmulator, tmp_path):
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir(mode=0o700)
+    os.chown(cache_dir, 65534, 65534)
+    assert make_cache(emulator, str(cache_dir)).cache_dir is None
+
+def test_should_drop_corrupted_entries(emulator: FakeEmulator, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    cache = make_cache(emulator, cache_dir, memory_max_bytes=0)
+    verify(cache, emulator)
+    for f in os.scandir(cache_dir):
+        with open(f.path,'r+b') as fd: fd.truncate(f.stat().st_size - 1)
+
+    verify(cache, emulator)
+    assert emulator.calls == 2
+
+
+###
+# Entry format
+
+def test_should_encode_entries():
+    entry = {"outcard": b'card', "outhash": b'\x00' * 32, "outhist": b''}
+    assert decode_entry(encode_entry(entry)) == entry
+
+    data = encode_entry(entry)
+    with pytest.raises(Exception):
+        decode_entry(data[:-1])
+    with pytest.raises(Exception):
+        decode_entry(data + b'\0')
+    with pytest.raises(Exception):
+        decode_entry(b'\x80\x04' + data)
@@ -0,0 +1,81 @@
+"""
+Tests for the emulator time and frame budgets, using a stand-in emulator.
+"""
+import asyncio
+
+import pytest
+
+from core.riv import verify_log, verify_many, RivemuTimeoutError, RivemuFrameBudgetError
+from core.riv_async import verify_log_async
+
+from .conftest import CARTRIDGE_PATH
+
+
+###
+# Time budget
+
+def test_should_timeout(rivemu: str):
+    with pytest.raises(RivemuTimeoutError):
+        verify_log(CARTRIDGE_PATH, b'sleep', '', b'', timeout=0.5)
+
+def test_should_not_report_external_kill_as_timeout(rivemu: str):
+    # the watchdog didn't fire, so a SIGKILL from elsewhere is a plain emulator error
+    with pytest.raises(Exception) as e:
+        verify_log(CARTRIDGE_PATH, b'killed', '', b'', timeout=30)
+    assert not isinstance(e.value, RivemuTimeoutError)
+
+
+###
+# Frame budget
+
+@pytest.mark.parametrize("max_frames", [10, 11])
+def test_should_accept_logs_within_frame_budget(rivemu: str, max_frames: int):
+    outputs = verify_log(CARTRIDGE_PATH, b'a' * 10, '', b'', max_frames=max_frames)
+    assert outputs['stats']['frames'] == 10
+    assert outputs == verify_log(CARTRIDGE_PATH, b'a' * 10, '', b'') | {"stats": outputs['stats']}
+
+def test_should_reject_logs_over_frame_budget(rivemu: str):
+    with pytest.raises(RivemuFrameBudgetError):
+        verify_log(CARTRIDGE_PATH, b'a' * 10, '', b'', max_frames=9)
+    with pytest.raises(RivemuFrameBudgetError):
+        asyncio.run(verify_log_async(CARTRIDGE_PATH, b'a' * 10, '', b'', max_frames=9))
+    assert asyncio.run(verify_log_async(CARTRIDGE_PATH, b'a' * 10, '', b'', max_frames=10))['stats']['frames'] == 10
+
+def test_should_keep_stop_frame_within_budget(rivemu: str):
+    # an earlier stop frame isn't over the budget
+    outputs = verify_log(CARTRIDGE_PATH, b'a' * 10, '', b'', frame=5, max_frames=9)
+    assert outputs['stats']['frames'] == 5
+
+def test_should_reject_budgeted_logs_without_frame_report(rivemu: str):
+    # the emulator printed no frame count, so the run may have reached the stop frame past the budget
+    assert verify_log(CARTRIDGE_PATH, b'quiet', '', b'')['stats']['frames'] is None
+    with pytest.raises(RivemuFrameBudgetError):
+        verify_log(CARTRIDGE_PATH, b'quiet', '', b'', max_frames=2)
+    with pytest.raises(RivemuFrameBudgetError):
+        verify_log(CARTRIDGE_PATH, b'quiet', '', b'', max_frames=10)
+    with pytest.raises(RivemuFrameBudgetError):
+        asyncio.run(verify_log_async(CARTRIDGE_PATH, b'quiet', '', b'', max_frames=10))
+    results = verify_many([{"cartridge": CARTRIDGE_PATH, "log": b'quiet', "max_frames": 10}])
+    assert results[0]['outputs'] is None and results[0]['budget_exceeded']
+
+def test_should_accept_stop_frame_within_budget_without_frame_report(rivemu: str):
+    outputs = verify_log(CARTRIDGE_PATH, b'quiet', '', b'', frame=2, max_frames=2)
+    assert outputs['stats']['frames'] is None
+
+
+###
+# Batches
+
+def test_should_flag_exceeded_budgets_in_batches(rivemu: str):
+    jobs = [
+        {"cartridge": CARTRIDGE_PATH, "log": b'a' * 10, "max_frames": 10},
+        {"cartridge": CARTRIDGE_PATH, "log": b'a' * 10, "max_frames": 9},
+        {"cartridge": CARTRIDGE_PATH, "log": b'sleep', "timeout": 0.5},
+        {"cartridge": CARTRIDGE_PATH, "log": b'fail'},
+    ]
+    results = verify_many(jobs, max_workers=2)
+
+    assert results[0]['error'] is None and not results[0]['budget_exceeded']
+    assert results[1]['outputs'] is None and results[1]['budget_exceeded']
+    assert results[2]['outputs'] is None and results[2]['budget_exceeded']
+    assert 'invalid log' in results[3]['error'] and not results[3]['budget_exceeded']
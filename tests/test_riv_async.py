@@ -0,0 +1,102 @@
+"""
+Tests for the async verification against the sync one and the run stats, using a
+stand-in emulator.
+"""
+import os
+import asyncio
+
+import pytest
+
+from core.riv import verify_log, RivemuTimeoutError
+from core.riv_async import verify_log_async, AsyncVerifier
+from core.riv_stats import get_emulator_stats
+
+from .conftest import CARTRIDGE_PATH
+
+
+###
+# Setup tests variables
+
+def outputs_without_stats(outputs: dict) -> dict:
+    return dict((k,v) for k,v in outputs.items() if k != 'stats')
+
+
+###
+# Parity tests
+
+@pytest.mark.parametrize("kwargs", [
+    {},
+    {"in_card": b'incard', "riv_args": "-level 2"},
+    {"entropy": "player", "frame": 10},
+    {"get_outhist": True},
+    {"get_screenshot": True},
+])
+def test_should_match_sync_outputs(rivemu: str, kwargs: dict):
+    args = {"log": b'log', "riv_args": '', "in_card": b''} | kwargs
+    sync_outputs = verify_log(CARTRIDGE_PATH, **args)
+    async_outputs = asyncio.run(verify_log_async(CARTRIDGE_PATH, **args))
+
+    assert len(sync_outputs['outcard']) > 0
+    assert outputs_without_stats(async_outputs) == outputs_without_stats(sync_outputs)
+
+def test_should_match_sync_outputs_from_bytes(rivemu: str):
+    with open(CARTRIDGE_PATH,'rb') as f: cartridge_data = f.read()
+    sync_outputs = verify_log(cartridge_data, b'log', '', b'')
+    async_outputs = asyncio.run(verify_log_async(cartridge_data, b'log', '', b''))
+    assert outputs_without_stats(async_outputs) == outputs_without_stats(sync_outputs)
+
+def test_should_verify_concurrently(rivemu: str):
+    async def run():
+        verifier = AsyncVerifier(max_concurrency=2)
+        return await asyncio.gather(*[verifier.verify_log(CARTRIDGE_PATH, f"log{i}".encode(), '', b'') for i in range(6)])
+
+    async_outputs = asyncio.run(run())
+    for i, outputs in enumerate(async_outputs):
+        sync_outputs = verify_log(CARTRIDGE_PATH, f"log{i}".encode(), '', b'')
+        assert outputs_without_stats(outputs) == outputs_without_stats(sync_outputs)
+    assert len(set(o['outcard'] for o in async_outputs)) == 6
+
+
+###
+# Errors
+
+def test_should_fail_like_sync(rivemu: str):
+    with pytest.raises(Exception, match="invalid log"):
+        verify_log(CARTRIDGE_PATH, b'fail', '', b'')
+    with pytest.raises(Exception, match="invalid log"):
+        asyncio.run(verify_log_async(CARTRIDGE_PATH, b'fail', '', b''))
+
+def test_should_timeout(rivemu: str):
+    with pytest.raises(RivemuTimeoutError):
+        asyncio.run(verify_log_async(CARTRIDGE_PATH, b'sleep', '', b'', timeout=0.5))
+
+def test_should_reject_invalid_concurrency():
+    with pytest.raises(Exception):
+        AsyncVerifier(max_concurrency=0)
+
+
+###
+# Run stats
+
+def test_should_record_run_stats_once(rivemu: str):
+    stats = get_emulator_stats()
+    stats.runs["cartridge"].pop(os.path.basename(CARTRIDGE_PATH), None)
+    stats.runs["rule"].pop("rule-stats", None)
+
+    verify_log(CARTRIDGE_PATH, b'log', '', b'', rule_id="rule-stats")
+    asyncio.run(verify_log_async(CARTRIDGE_PATH, b'log', '', b'', rule_id="rule-stats"))
+    verify_log(CARTRIDGE_PATH, b'log', '', b'')
+
+    assert stats.percentiles("cartridge", os.path.basename(CARTRIDGE_PATH))['runs'] == 3
+    assert stats.percentiles("rule", "rule-stats")['runs'] == 2
+
+def test_should_report_emulator_frames(rivemu: str):
+    # the frames the emulator ran, not the stop frame
+    outputs = verify_log(CARTRIDGE_PATH, b'a' * 7, '', b'', frame=100)
+    assert outputs['stats']['frames'] == 7
+    outputs = asyncio.run(verify_log_async(CARTRIDGE_PATH, b'a' * 7, '', b'', frame=100))
+    assert outputs['stats']['frames'] == 7
+
+    outputs = verify_log(CARTRIDGE_PATH, b'quiet', '', b'', frame=100)
+    assert outputs['stats']['frames'] is None
+    assert outputs['stats']['wall_time'] > 0
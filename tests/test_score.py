@@ -0,0 +1,128 @@
+"""
+Tests for the score functions, batch scoring must agree with the scalar evaluator.
+"""
+import json
+import random
+
+import pytest
+
+from core import score
+from core.score import ScoreFunction, get_score_function, score_outcards
+
+
+###
+# Setup tests variables
+
+EXPRESSIONS = [
+    "score",
+    "score + 10 * level",
+    "score - level",
+    "-score + 2",
+    "score / level",
+    "score % level",
+    "score ^ 2",
+    "level ** 3 - score",
+    "(score + level) * (score - level) / 3",
+    "max(score, level)",
+    "abs(level) + score",
+]
+
+def scalar_scores(function: ScoreFunction, values_list: list) -> list:
+    scores = []
+    for values in values_list:
+        try:
+            scores.append(function.evaluate(values))
+        except Exception:
+            scores.append(None)
+    return scores
+
+def random_values(rng: random.Random, kind: str) -> dict:
+    if kind == 'int': return {"score": rng.randint(-10**6, 10**6), "level": rng.randint(-20, 20)}
+    if kind == 'float': return {"score": rng.uniform(-10**6, 10**6), "level": rng.uniform(-20, 20)}
+    if kind == 'mixed': return {"score": rng.randint(-10**6, 10**6), "level": rng.uniform(-20, 20)}
+    return {"score": rng.randint(-10**18, 10**18), "level": rng.randint(-10**9, 10**9)}
+
+def same_scores(batch: list, scalar: list) -> bool:
+    # same values and same types, an int score can't become a float
+    return all(type(b) is type(s) and (b == s or b != b and s != s) for b, s in zip(batch, scalar)) and len(batch) == len(scalar)
+
+
+###
+# Batch scoring tests
+
+@pytest.mark.parametrize("expression", EXPRESSIONS)
+@pytest.mark.parametrize("kind", ['int', 'float', 'mixed', 'big'])
+def test_batch_should_match_scalar(expression: str, kind: str):
+    rng = random.Random(f"{expression}-{kind}")
+    function = ScoreFunction(expression)
+    values_list = [random_values(rng, kind) for _ in range(200)]
+    assert same_scores(function.evaluate_many(values_list), scalar_scores(function, values_list))
+
+@pytest.mark.parametrize("expression", EXPRESSIONS)
+def test_batch_should_match_scalar_on_edge_values(expression: str):
+    function = ScoreFunction(expression)
+    values_list = [
+        {"score": 1, "level": 0},
+        {"score": 0.0, "level": 0.0},
+        {"score": 2**62, "level": 2},
+        {"score": 2**53 + 1, "level": 1.5},
+        {"score": 1e308, "level": 10.0},
+        {"score": -7, "level": 3},
+        {"score": 7, "level": -3},
+        {"score": 3, "level": 100},
+        {"score": True, "level": 1},
+        {"score": "100", "level": 1},
+        {"score": None, "level": 1},
+        {"score": 1},
+        {},
+        None,
+        [1, 2],
+    ] * 2
+    assert same_scores(function.evaluate_many(values_list), scalar_scores(function, values_list))
+
+def test_should_evaluate_batches_on_columns(monkeypatch):
+    function = ScoreFunction("score + 10 * level")
+    batches = []
+    evaluate_columns = function._evaluate_columns
+    monkeypatch.setattr(function, '_evaluate_columns', lambda values_list: batches.append(len(values_list)) or evaluate_columns(values_list))
+    rng = random.Random(0)
+    values_list = [random_values(rng, 'int') for _ in range(10)] + [random_values(rng, 'float') for _ in range(5)]
+    assert same_scores(function.evaluate_many(values_list), scalar_scores(function, values_list))
+    assert sorted(batches) == [5, 10]
+
+def test_should_score_single_rows_like_scalar():
+    function = ScoreFunction("score * 2")
+    assert function.evaluate_many([{"score": 3}]) == [6]
+    assert function.evaluate_many([]) == []
+
+def test_should_not_vectorize_functions_and_constants():
+    assert ScoreFunction("score + 1").vectorizable
+    assert not ScoreFunction("max(score, 1)").vectorizable
+    assert not ScoreFunction("1 + 2").vectorizable
+
+def test_should_score_outcards():
+    outcards = [
+        b'JSON' + json.dumps({"score": 10}).encode(),
+        b'JSON' + json.dumps({"score": 20}).encode(),
+        b'JSON{invalid',
+        b'TEXTscore',
+        None,
+    ]
+    assert score_outcards("score * 2", outcards) == [20, 40, None, None, None]
+
+
+###
+# Compiled function cache
+
+def test_should_cache_compiled_functions(monkeypatch):
+    monkeypatch.setattr(score, 'SCORE_FUNCTION_CACHE_SIZE', 2)
+    score._score_function_cache.clear()
+
+    first = get_score_function("score + 1")
+    assert get_score_function("score + 1") is first
+    get_score_function("score + 2")
+    get_score_function("score + 1")
+    get_score_function("score + 3")
+
+    assert list(score._score_function_cache.keys()) == ["score + 1", "score + 3"]
+    assert get_score_function("score + 1") is first
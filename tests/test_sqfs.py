@@ -0,0 +1,133 @@
+"""
+Tests for the SquashFS reader against the cartridges in misc.
+"""
+import json
+import struct
+
+import pytest
+
+from core.sqfs import SquashFsImage, SquashFsError, read_squashfs_files
+
+
+###
+# Setup tests variables
+
+# cartridge: (files in the root, elf file)
+CARTRIDGES = {
+    '2048':      (['.riv', 'game2048.elf', 'info.json'], 'game2048.elf'),
+    'antcopter': (['.riv', 'antcopter.elf', 'info.json'], 'antcopter.elf'),
+    'breakout':  (['breakout', 'info.json'], 'breakout'),
+    'monky':     (['.riv', 'info.json', 'monky.elf'], 'monky.elf'),
+    'particles': (['.riv', 'particles.elf'], 'particles.elf'),
+    'snake':     (['.riv', 'info.json', 'snake.elf'], 'snake.elf'),
+    'tetrix':    (['.riv', 'info.json', 'tetrix.elf'], 'tetrix.elf'),
+}
+
+def cartridge_path(name: str) -> str:
+    return f"misc/{name}.sqfs"
+
+def read_cartridge(name: str) -> bytes:
+    with open(cartridge_path(name), 'rb') as f:
+        return f.read()
+
+def root_files(image: SquashFsImage) -> list[str]:
+    return sorted(image._list_directory(image._read_inode(image.superblock['root_inode'])).keys())
+
+def check_elf(data: bytes):
+    # the headers point to the end of the file, so they check the last data block or fragment
+    assert data[:4] == b'\x7fELF'
+    assert data[4] == 2 # 64 bits
+    phoff, shoff = struct.unpack_from('<QQ', data, 0x20)
+    phentsize, phnum, shentsize, shnum, shstrndx = struct.unpack_from('<HHHHH', data, 0x36)
+    assert phnum > 0 and phoff + phentsize * phnum <= len(data)
+    segments_end = 0
+    for i in range(phnum):
+        offset, = struct.unpack_from('<Q', data, phoff + i * phentsize + 0x08)
+        filesz, = struct.unpack_from('<Q', data, phoff + i * phentsize + 0x20)
+        segments_end = max(segments_end, offset + filesz)
+    assert segments_end <= len(data)
+    if shnum == 0: return # stripped
+    assert shoff + shentsize * shnum == len(data)
+    name_offset, name_size = struct.unpack_from('<QQ', data, shoff + shstrndx * shentsize + 0x18)
+    assert b'.text' in data[name_offset:name_offset + name_size]
+
+###
+# Reader tests
+
+@pytest.mark.parametrize("name", CARTRIDGES.keys())
+def test_should_list_root(name: str):
+    image = SquashFsImage(read_cartridge(name))
+    assert image.superblock['magic'] == 0x73717368
+    assert root_files(image) == CARTRIDGES[name][0]
+
+@pytest.mark.parametrize("name", CARTRIDGES.keys())
+def test_should_read_metadata_files(name: str):
+    files = read_squashfs_files(read_cartridge(name), ['/info.json', '/.riv', '/cover.png'])
+
+    if 'info.json' in CARTRIDGES[name][0]:
+        info = json.loads(files['/info.json'])
+        assert len(info['name']) > 0
+    else:
+        assert files['/info.json'] is None
+
+    if '.riv' in CARTRIDGES[name][0]:
+        assert files['/.riv'].strip() == b'0.3.0'
+    else:
+        assert files['/.riv'] is None
+
+    assert files['/cover.png'] is None
+
+@pytest.mark.parametrize("name", CARTRIDGES.keys())
+def test_should_read_whole_files(name: str):
+    image = SquashFsImage(read_cartridge(name))
+    elf_file = CARTRIDGES[name][1]
+    data = image.read_file(f"/{elf_file}")
+    assert len(data) == image.lookup(f"/{elf_file}")['file_size']
+    check_elf(data)
+
+def test_should_read_multi_block_file():
+    # monky spans more than one data block
+    image = SquashFsImage(read_cartridge('monky'))
+    data = image.read_file('/monky.elf')
+    assert len(data) > image.superblock['block_size']
+    check_elf(data)
+
+@pytest.mark.parametrize("name", CARTRIDGES.keys())
+def test_should_read_same_from_bytes_and_path(name: str):
+    paths = ['/info.json', '/.riv', f"/{CARTRIDGES[name][1]}"]
+    assert read_squashfs_files(read_cartridge(name), paths) == read_squashfs_files(cartridge_path(name), paths)
+
+def test_should_not_find_missing_paths():
+    image = SquashFsImage(read_cartridge('snake'))
+    assert image.read_file('/missing') is None
+    assert image.read_file('/info.json/inside') is None
+    # directories aren't files
+    assert image.read_file('/') is None
+    assert image.lookup('/')['type'] in (1, 8)
+
+
+###
+# Invalid images
+
+def test_should_fail_invalid_superblock():
+    with pytest.raises(SquashFsError, match="Can't find a valid SQUASHFS superblock"):
+        SquashFsImage(b'\0' + read_cartridge('snake'))
+
+def test_should_fail_empty_image(tmp_path):
+    empty = tmp_path / "empty.sqfs"
+    empty.write_bytes(b'')
+    with pytest.raises(SquashFsError):
+        read_squashfs_files(str(empty), ['/info.json'])
+    with pytest.raises(SquashFsError):
+        read_squashfs_files(b'', ['/info.json'])
+
+def test_should_fail_invalid_image_file(tmp_path):
+    invalid = tmp_path / "invalid.sqfs"
+    invalid.write_bytes(b'\0' * 4096)
+    with pytest.raises(SquashFsError):
+        read_squashfs_files(str(invalid), ['/info.json'])
+
+def test_should_fail_truncated_image():
+    data = read_cartridge('monky')
+    with pytest.raises(Exception):
+        read_squashfs_files(data[:len(data) // 2], ['/monky.elf'])
@@ -0,0 +1,135 @@
+"""
+Tests for the tag bitmaps against python sets and for the tag index refreshing
+entities from the tables only once their changes settle.
+"""
+import random
+
+import pytest
+
+from core.tag_index import Bitmap, TagIndex, BITMAP_ARRAY_MAX_SIZE
+
+
+###
+# Setup tests variables
+
+class Marks:
+    # stand-in for model.SessionMarks, keys settle when the test says so
+    def __init__(self):
+        self.marks = {}
+
+    def mark(self, key):
+        self.marks[key] = False
+
+    def settle(self):
+        for key in self.marks: self.marks[key] = True
+
+    def pop_settled(self) -> list:
+        keys = [key for key, settled in self.marks.items() if settled]
+        for key in keys: del self.marks[key]
+        return keys
+
+    def __len__(self) -> int:
+        return len(self.marks)
+
+    def clear(self):
+        self.marks.clear()
+
+class Tables:
+    # stand-in for the tag tables, with the queries the index ran
+    def __init__(self, entity_tags: dict):
+        self.entity_tags = entity_tags
+        self.loads = []
+
+    def load(self, entity_ids: list | None) -> list[tuple[str,str]]:
+        self.loads.append(entity_ids)
+        return [(entity_id, tag) for entity_id, tags in self.entity_tags.items()
+                if entity_ids is None or entity_id in entity_ids for tag in tags]
+
+def random_values(n: int, max_value: int, seed: int) -> set[int]:
+    rng = random.Random(seed)
+    return set(rng.randrange(max_value) for _ in range(n))
+
+
+###
+# Bitmap
+
+@pytest.mark.parametrize("n,max_value", [
+    (10, 100),
+    (3 * BITMAP_ARRAY_MAX_SIZE, 1 << 16), # dense containers
+    (2000, 1 << 20),                      # many sparse containers
+])
+def test_should_match_set_operations(n: int, max_value: int):
+    a_values = random_values(n, max_value, 1)
+    b_values = random_values(n, max_value, 2)
+    a, b = Bitmap(a_values), Bitmap(b_values)
+
+    assert list(a) == sorted(a_values)
+    assert len(a) == len(a_values)
+    assert list(a & b) == sorted(a_values & b_values)
+    assert list(a | b) == sorted(a_values | b_values)
+    assert all(value in a for value in a_values)
+    assert not any(value in a for value in b_values - a_values)
+
+def test_should_discard_values():
+    values = random_values(3 * BITMAP_ARRAY_MAX_SIZE, 1 << 16, 3)
+    bitmap = Bitmap(values)
+    assert isinstance(bitmap.containers[0], int)
+    for value in sorted(values)[:2 * BITMAP_ARRAY_MAX_SIZE + 1]:
+        bitmap.discard(value)
+        values.discard(value)
+    assert not isinstance(bitmap.containers[0], int)
+    assert list(bitmap) == sorted(values)
+    for value in list(values): bitmap.discard(value)
+    assert len(bitmap.containers) == 0
+
+
+###
+# Tag index
+
+def test_should_match_all_or_any_tags():
+    tables = Tables({"c1": ["arcade", "retro"], "c2": ["arcade"], "c3": ["puzzle"]})
+    index = TagIndex(tables.load, Marks())
+
+    assert sorted(index.match(["arcade", "retro"])) == ["c1"]
+    assert sorted(index.match(["arcade", "retro"], match_any=True)) == ["c1", "c2"]
+    assert sorted(index.match(["arcade", "puzzle"], match_any=True)) == ["c1", "c2", "c3"]
+    assert index.match(["arcade", "missing"]) == []
+    assert index.match([]) == []
+    assert index.match(["arcade"], max_size=1) is None
+    assert tables.loads == [None]
+
+def test_should_refresh_entities_once_settled():
+    marks = Marks()
+    tables = Tables({"c1": ["arcade"], "c2": ["arcade"]})
+    index = TagIndex(tables.load, marks)
+    assert sorted(index.match(["arcade"])) == ["c1", "c2"]
+
+    # changed in a session still open, or rolled back later
+    tables.entity_tags["c1"] = ["puzzle"]
+    tables.entity_tags["c3"] = ["arcade"]
+    index.update("c1")
+    index.update("c3")
+    assert sorted(index.match(["arcade"])) == ["c1", "c2"]
+    assert len(marks) == 2
+
+    # read back as committed
+    del tables.entity_tags["c2"]
+    index.update("c2")
+    marks.settle()
+    assert sorted(index.match(["arcade"])) == ["c3"]
+    assert index.match(["puzzle"]) == ["c1"]
+    assert sorted(tables.loads[-1]) == ["c1", "c2", "c3"]
+    assert len(marks) == 0
+
+def test_should_not_mark_before_loading():
+    marks = Marks()
+    tables = Tables({"c1": ["arcade"]})
+    index = TagIndex(tables.load, marks)
+    index.update("c1")
+    assert len(marks) == 0
+
+    tables.entity_tags["c2"] = ["arcade"]
+    assert sorted(index.match(["arcade"])) == ["c1", "c2"]
+    index.update("c2")
+    index.clear()
+    assert len(marks) == 0